@@ -126,15 +126,18 @@ setup(
     #     'dev': ['check-manifest'],
     #     'test': ['coverage'],
     # },
+    extras_require={
+        'arrow': ['pyarrow'],   # the binary protocol of the Pandas SQL server
+    },
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.
     #
     # If using Python 2.6 or earlier, then these have to be included in
     # MANIFEST.in as well.
-    # package_data={  # Optional
-    #     'sample': ['package_data.dat'],
-    # },
+    package_data={
+        'verdict.pandas_sql': ['loadtest_queries.json'],    # the query mix of the load test
+    },
 
     # Although 'package_data' is the preferred approach, in some case you may
     # need to place data files outside of your packages. See:
@@ -154,6 +157,7 @@ setup(
         'console_scripts': [
             # 'verdict-server=verdict.server:main',
             'pandas-sql-server=verdict.pandas_sql.pandas_sql_server:main',
+            'pandas-sql-loadtest=verdict.pandas_sql.loadtest:main',
         ],
     },
 
@@ -0,0 +1,164 @@
+import json
+import queue
+import redis
+import time
+from unittest import mock
+from verdict.core import cache as cache_module
+from verdict.core.cache import CacheManager
+
+
+class FakePubSub(object):
+    """Delivers the messages (or raises the exceptions) put into its queue."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.handlers = {}
+        self.closed = False
+
+    def psubscribe(self, **handlers):
+        self.handlers.update(handlers)
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            message = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if isinstance(message, BaseException):
+            raise message
+        self.handlers[next(iter(self.handlers))](message)
+
+    def run_in_thread(self, sleep_time=0.0, daemon=False, exception_handler=None):
+        thread = redis.client.PubSubWorkerThread(self, 0.01, daemon=daemon,
+                                                 exception_handler=exception_handler)
+        thread.start()
+        return thread
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRedis(object):
+    """The commands CacheManager uses on the cache meta; counts the reads."""
+
+    def __init__(self, host=None, events='KA'):
+        self.data = {}
+        self.events = events
+        self.reads = 0
+        self.pubsubs = []
+
+    def config_get(self, name):
+        return {name: self.events}
+
+    def config_set(self, name, value):
+        raise AssertionError("The server configuration must not be changed")
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        self.pubsubs.append(FakePubSub())
+        return self.pubsubs[-1]
+
+    def get(self, key):
+        self.reads += 1
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self.reads += 1
+        return [self.data.get(k) for k in keys]
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, b'0')) + 1).encode('utf-8')
+
+    def notify(self, key):
+        """Sends the keyspace notification of the key to the subscribers."""
+        for pubsub in self.pubsubs:
+            pubsub.queue.put({'channel': f'__keyspace@0__:{key}'.encode('utf-8'), 'data': b'set'})
+
+
+def cache_manager(events='KA'):
+    with mock.patch.object(cache_module.redis, 'Redis', lambda host: FakeRedis(host, events)):
+        return CacheManager(preload_cache=False)
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_cache_meta_notifications():
+    cache = cache_manager()
+    r = cache.r
+    try:
+        assert cache._watching_cache_meta()
+
+        cache.store_cache_meta('s1', {'a': 1})
+        assert cache.get_cache_meta('s1') == {'a': 1}
+        reads = r.reads
+        # served without a round trip, even after the revalidation interval
+        time.sleep(CacheManager.CACHE_META_REVALIDATE_SECONDS + 0.1)
+        assert cache.get_cache_meta('s1') == {'a': 1}
+        assert r.reads == reads
+
+        # changed by another process
+        r.set(cache.cache_meta_id('s1'), json.dumps({'a': 2}).encode('utf-8'))
+        r.incr(cache.cache_meta_version_id('s1'))
+        r.notify(cache.cache_meta_id('s1'))
+        assert wait_until(lambda: cache.get_cache_meta('s1') == {'a': 2})
+    finally:
+        cache.close()
+
+    # close() stops the watcher
+    assert not cache._watching_cache_meta()
+    assert r.pubsubs[0].closed
+
+
+def test_cache_meta_watcher_failure():
+    cache = cache_manager()
+    r = cache.r
+    try:
+        cache.store_cache_meta('s1', {'a': 1})
+        assert cache.get_cache_meta('s1') == {'a': 1}
+
+        # a change whose notification is lost with the connection
+        r.set(cache.cache_meta_id('s1'), json.dumps({'a': 2}).encode('utf-8'))
+        r.incr(cache.cache_meta_version_id('s1'))
+        r.pubsubs[0].queue.put(redis.exceptions.ConnectionError("lost"))
+        assert wait_until(lambda: not cache._watching_cache_meta())
+        assert r.pubsubs[0].closed
+
+        # every cached meta has been invalidated
+        assert cache.get_cache_meta('s1') == {'a': 2}
+
+        # from then on, revalidated by the version
+        reads = r.reads
+        assert cache.get_cache_meta('s1') == {'a': 2}
+        assert r.reads == reads
+        r.set(cache.cache_meta_id('s1'), json.dumps({'a': 3}).encode('utf-8'))
+        r.incr(cache.cache_meta_version_id('s1'))
+        time.sleep(CacheManager.CACHE_META_REVALIDATE_SECONDS + 0.1)
+        assert cache.get_cache_meta('s1') == {'a': 3}
+    finally:
+        cache.close()
+
+
+def test_cache_meta_without_notifications():
+    # not enabled on the server; not enabled by the manager either
+    cache = cache_manager(events='')
+    r = cache.r
+    try:
+        assert cache._meta_watcher is None
+        assert r.pubsubs == []
+        cache.store_cache_meta('s1', {'a': 1})
+        assert cache.get_cache_meta('s1') == {'a': 1}
+        r.set(cache.cache_meta_id('s1'), json.dumps({'a': 2}).encode('utf-8'))
+        r.incr(cache.cache_meta_version_id('s1'))
+        time.sleep(CacheManager.CACHE_META_REVALIDATE_SECONDS + 0.1)
+        assert cache.get_cache_meta('s1') == {'a': 2}
+    finally:
+        cache.close()
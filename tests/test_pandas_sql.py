@@ -1,5 +1,63 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import numpy as np
 import os
+import pandas as pd
+import pickle
+import tempfile
+import threading
+import time
 from verdict.pandas_sql import *
+from verdict.pandas_sql import pandas_sql_server
+from verdict.pandas_sql.advisor import IndexAdvisor
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# A pickled DataFrame of shipmethod and cost
+SHIPCOST_PATH = os.path.join(THIS_DIR, 'resources/test_df_shipcost')
+
+SUM_COST = {"sum_cost": {"op": "sum", "arg": ["attr cost"]}}
+
+
+def _source(source):
+    return f"table {source}" if isinstance(source, str) else source
+
+
+def agg_query(source, agg=SUM_COST, groupby=None):
+    """
+    @param source  A table name or a query
+    @param groupby  The names of the grouping columns, if any
+    """
+    source = _source(source)
+    if groupby is not None:
+        source = {"op": "groupby", "arg": [f"attr {c}" for c in groupby], "source": source}
+    return {"op": "agg", "arg": agg, "source": source}
+
+
+def select_query(source, op, column, value):
+    return {"op": "select", "arg": {"op": op, "arg": [f"attr {column}", value]},
+            "source": _source(source)}
+
+
+# sum(cost) by shipmethod
+SHIPCOST_QUERY = agg_query('shipcost', groupby=['shipmethod'])
+
+
+@contextlib.contextmanager
+def running_server(pd_sql=None):
+    """Runs the server in a thread, with the given engine if any."""
+    saved = pandas_sql_server.pandas_sql_instance[0]
+    if pd_sql is not None:
+        pandas_sql_server.pandas_sql_instance[0] = pd_sql
+    pandas_server_start(in_thread=True)
+    try:
+        yield
+    finally:
+        pandas_server_stop()
+        pandas_sql_server.pandas_sql_instance[0] = saved
 
 
 
@@ -58,5 +116,832 @@ def test_load_and_query_via_server():
     result = pd_sql_client.execute(json_query)
     print(result)
 
+    results = pd_sql_client.execute_many([json_query, json_query])
+    assert len(results) == 2
+    assert results[0].equals(result)
+
+    pd_sql_client.drop_table('shipcost')
+    pd_sql_client.drop_table('shipcost')    # an absent table is ignored by default
+    pd_sql_client.load_table('shipcost', df_path)
+
     pandas_server_stop()
 
+
+
+def test_execute_many():
+    pd_sql = PandasSQL()
+    df = pd.DataFrame({
+        'shipmethod': ['air', 'ship', 'air', 'truck', 'ship'],
+        'cost': [10.0, 5.0, 7.0, 3.0, 1.0],
+        'weight': [1, 2, 3, 4, 5],
+    })
+    pd_sql.register_table('shipments', df)
+
+    heavy = select_query('shipments', 'gt', 'weight', 1)
+    queries = [
+        agg_query(heavy, groupby=['shipmethod']),
+        agg_query(heavy, {"avg_weight": {"op": "avg", "arg": ["attr weight"]},
+                          "count": {"op": "count", "arg": []}}, groupby=['shipmethod']),
+        agg_query('shipments', {"sum_weight": {"op": "sum", "arg": ["attr weight"]}}),
+    ]
+    results = pd_sql.execute_many(queries)
+    assert len(results) == len(queries)
+    for query, result in zip(queries, results):
+        expected = pd_sql.execute(query)
+        assert list(result.columns) == list(expected.columns)
+        assert result.reset_index(drop=True).equals(expected.reset_index(drop=True))
+
+    # the identical queries share the scan, not their results
+    first, second = pd_sql.execute_many([heavy, heavy])
+    first['cost'] = 0.0
+    assert second['cost'].tolist() == [5.0, 7.0, 3.0, 1.0]
+    assert pd_sql.get_df('shipments')['cost'].tolist() == df['cost'].tolist()
+
+
+def test_execute_many_with_errors():
+    pd_sql = PandasSQL()
+    pd_sql.register_table('shipments', pd.DataFrame({'cost': [1.0, 2.0]}))
+    queries = [
+        agg_query('shipments'),
+        agg_query('shipments', {"s": {"op": "sum", "arg": ["attr price"]}}),
+        agg_query('missing'),
+        agg_query('shipments', groupby=['missing']),
+        agg_query('shipments'),
+    ]
+    results = pd_sql.execute_many(queries, return_exceptions=True)
+    assert results[0]['sum_cost'][0] == 3.0
+    assert isinstance(results[1], ValueError)
+    # failed in the planning
+    assert isinstance(results[2], Exception) and isinstance(results[3], Exception)
+    assert results[4].equals(results[0])
+    try:
+        pd_sql.execute_many(queries[2:])
+        assert False, "the failure is not raised"
+    except Exception:
+        pass
+
+
+def test_sharded_execute():
+    df = pd.DataFrame({
+        'shipmethod': ['air', 'ship', 'air', 'truck', 'ship', 'air', 'rail'],
+        'cost': [10.0, 5.0, 7.0, 3.0, 1.0, 2.0, 4.0],
+        'weight': [1, 2, 3, 4, 5, 6, 7],
+    })
+    pd_sql = PandasSQL()
+    pd_sql.register_table('shipments', df)
+    sharded = ShardedPandasSQL(num_shards=3)
+    sharded.register_table('shipments', df, part_col='shipmethod')
+
+    def check(query, results):
+        expected = pd_sql.execute(query).sort_values('shipmethod').reset_index(drop=True)
+        for result in results:
+            result = result.sort_values('shipmethod').reset_index(drop=True)
+            assert list(result.columns) == list(expected.columns)
+            pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    try:
+        json_query = agg_query('shipments', {
+            "sum_cost": {"op": "sum", "arg": ["attr cost"]},
+            "avg_weight": {"op": "avg", "arg": ["attr weight"]},
+            "count": {"op": "count", "arg": []},
+        }, groupby=['shipmethod'])
+        check(json_query, [sharded.execute(json_query)])
+
+        # many queries are in flight on the workers at once
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            check(json_query, executor.map(sharded.execute, [json_query] * 8))
+
+        total_query = agg_query('shipments')
+        pd.testing.assert_frame_equal(sharded.execute(total_query), pd_sql.execute(total_query),
+                                      check_dtype=False)
+
+        # the workers read the columnar files too, each only its own rows
+        from verdict.pandas_sql.columnar import write_table_file
+        from verdict.pandas_sql.pandas_sql_shard import partition_frame, read_partition
+        path = os.path.join(tempfile.mkdtemp(), 'shipments')
+        write_table_file(df, path)
+        for part_col in [None, 'shipmethod']:
+            for i in range(3):
+                pd.testing.assert_frame_equal(read_partition(path, part_col, i, 3),
+                    partition_frame(df, part_col, i, 3).reset_index(drop=True))
+        sharded.load_table('shipments', path, part_col='shipmethod', replace=True)
+        check(json_query, [sharded.execute(json_query)])
+
+        # the error of a worker is raised in the coordinator
+        try:
+            sharded._scatter('no_such_method', [()] * 3)
+            assert False
+        except AttributeError:
+            pass
+        assert sharded.execute(total_query) is not None
+    finally:
+        sharded.close()
+
+
+def test_cube():
+    df = pd.DataFrame({
+        'shipmethod': ['air', 'ship', 'air', 'truck', 'ship', 'air'],
+        'region': ['east', 'west', 'west', 'east', 'east', 'east'],
+        'cost': [10.0, 5.0, 7.0, 3.0, None, 2.0],
+        'weight': [1, 2, 3, 4, 5, 6],
+    })
+    pd_sql = PandasSQL()
+    pd_sql.register_table('shipments', df)
+    plain = PandasSQL()
+    plain.register_table('shipments', df)
+    assert pd_sql.create_cube('shipments', ['shipmethod', 'region']) == 5
+
+    json_query = agg_query(select_query('shipments', 'eq', 'region', 'east'), {
+        "sum_cost": {"op": "sum", "arg": ["attr cost"]},
+        "avg_cost": {"op": "avg", "arg": ["attr cost"]},
+        "count_cost": {"op": "count", "arg": ["attr cost"]},
+        "count": {"op": "count", "arg": []},
+    }, groupby=['shipmethod'])
+    pd.testing.assert_frame_equal(pd_sql.execute(json_query), plain.execute(json_query),
+                                  check_dtype=False)
+
+    # the cube is rebuilt when the table is replaced
+    df2 = df[df['weight'] > 2]
+    pd_sql.drop_table('shipments')
+    pd_sql.register_table('shipments', df2)
+    plain.drop_table('shipments')
+    plain.register_table('shipments', df2)
+    assert pd_sql.cubes('shipments') == [(['region', 'shipmethod'], 4)]
+    pd.testing.assert_frame_equal(pd_sql.execute(json_query), plain.execute(json_query),
+                                  check_dtype=False)
+
+
+def test_index_advisor():
+    orders = pd.DataFrame({
+        'orderkey': list(range(100)),
+        'custkey': [i % 10 for i in range(100)],
+        'price': [float(i) for i in range(100)],
+    })
+    customers = pd.DataFrame({
+        'c_custkey': list(range(10)),
+        'c_region': ['east', 'west'] * 5,
+    })
+    pd_sql = PandasSQL()
+    plain = PandasSQL()
+    for engine in [pd_sql, plain]:
+        engine.register_table('orders', orders)
+        engine.register_table('customers', customers)
+    pd_sql._advisor = IndexAdvisor(pd_sql, memory_budget=10**6)
+
+    filter_query = agg_query({
+        "op": "select",
+        "arg": {"op": "and", "arg": [
+            {"op": "geq", "arg": ["attr orderkey", 20]},
+            {"op": "lt", "arg": ["attr orderkey", 30]}]},
+        "source": "table orders"
+    }, {"sum_price": {"op": "sum", "arg": ["attr price"]}})
+    join_query = agg_query({
+        "op": "join",
+        "arg": {
+            "join_to": select_query('customers', 'eq', 'c_custkey', 3),
+            "left_on": "attr custkey",
+            "right_on": "attr c_custkey",
+            "join_type": "inner"
+        },
+        "source": "table orders"
+    }, {"count": {"op": "count", "arg": []}})
+    for i in range(3):
+        pd_sql.execute(filter_query)
+        pd_sql.execute(join_query)
+    decisions = pd_sql._advisor.advise()
+    built = set([(d['table'], d['columns'][0]) for d in decisions if d['action'] == 'build'])
+    assert ('orders', 'orderkey') in built
+    assert ('orders', 'custkey') in built
+    assert 'orderkey' in pd_sql._indexes['orders']
+
+    for query in [filter_query, join_query]:
+        pd.testing.assert_frame_equal(pd_sql.execute(query), plain.execute(query))
+    assert len(pd_sql.advisor_report()['structures']) >= 2
+
+    # unused structures are dropped (the queries above count for the next round)
+    for i in range(4):
+        pd_sql._advisor.advise()
+    assert pd_sql.advisor_report()['structures'] == []
+    assert pd_sql._indexes['orders'] == {}
+
+
+def test_execute_prefix():
+    pd_sql = PandasSQL()
+    pd_sql.register_table('shipments', pd.DataFrame({'cost': [float(i) for i in range(100)]}))
+    json_query = agg_query(select_query('shipments', 'geq', 'cost', 5),
+                           dict(SUM_COST, count={"op": "count", "arg": []}))
+    result = pd_sql.execute(json_query, fraction=0.1)
+    assert result['count'][0] == 5
+    assert result['sum_cost'][0] == sum(range(5, 10))
+    assert pd_sql.execute(json_query)['count'][0] == 95
+
+
+def test_protocols_via_server():
+    with running_server():
+        results = []
+        for protocol in ['arrow', 'json']:
+            pd_sql_client = PandasSQLClient(protocol=protocol)
+            pd_sql_client.load_table('shipcost', SHIPCOST_PATH)
+            results.append(pd_sql_client.execute(SHIPCOST_QUERY))
+            try:
+                pd_sql_client.execute(agg_query('shipcost', {"s": {"op": "sum",
+                                                                   "arg": ["attr price"]}}))
+                assert False
+            except ValueError:
+                pass
+        pd.testing.assert_frame_equal(results[0], results[1])
+
+
+def test_async_client():
+    async def run_queries():
+        client = await AsyncPandasSQLClient().connect()
+        try:
+            await client.load_table('shipcost', SHIPCOST_PATH)
+            return await asyncio.gather(*[client.execute(SHIPCOST_QUERY) for i in range(10)])
+        finally:
+            client.close()
+
+    with running_server():
+        results = asyncio.run(run_queries())
+        expected = PandasSQLClient().execute(SHIPCOST_QUERY)
+        assert len(results) == 10
+        for result in results:
+            pd.testing.assert_frame_equal(result, expected)
+
+
+def test_shm_transport():
+    from verdict.pandas_sql.protocol import ARROW_CONTENT_TYPE, PICKLE_CONTENT_TYPE, \
+                                            encode_response, segment_to_frame
+    from verdict.pandas_sql.shm import SHM_DIR, SEGMENT_PREFIX
+
+    def segments():
+        return [f for f in os.listdir(SHM_DIR) if f.startswith(SEGMENT_PREFIX)]
+
+    with running_server():
+        before = segments()
+        shm_client = PandasSQLClient(transport='shm')
+        shm_client.load_table('shipcost', SHIPCOST_PATH)
+        result = shm_client.execute(SHIPCOST_QUERY)
+        results = shm_client.execute_many([SHIPCOST_QUERY, SHIPCOST_QUERY])
+        expected = PandasSQLClient(transport='http').execute(SHIPCOST_QUERY)
+        pd.testing.assert_frame_equal(result, expected)
+        pd.testing.assert_frame_equal(results[1], expected)
+        # the consumed segments are removed
+        assert segments() == before
+
+    # the segments of a response that falls back to pickle are removed
+    content_type, _ = encode_response([expected, {1, 2}], ARROW_CONTENT_TYPE, 'shm')
+    assert content_type == PICKLE_CONTENT_TYPE
+    assert segments() == before
+
+    # a client never removes a file that is not a segment
+    try:
+        segment_to_frame(SHIPCOST_PATH)
+        assert False
+    except ValueError:
+        pass
+    assert os.path.exists(SHIPCOST_PATH)
+
+
+def test_prefork_catalog():
+    from verdict.pandas_sql.pandas_sql_prefork import PreforkPandasSQL
+
+    pd_sql = PandasSQL()
+    pd_sql.load_table('shipcost', SHIPCOST_PATH)
+    expected = pd_sql.execute(SHIPCOST_QUERY)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        # two workers sharing the catalog
+        worker1 = PreforkPandasSQL(data_dir)
+        worker2 = PreforkPandasSQL(data_dir)
+        worker1.load_table('shipcost', SHIPCOST_PATH)
+        pd.testing.assert_frame_equal(worker2.execute(SHIPCOST_QUERY), expected)
+
+        worker2.create_cube('shipcost', ['shipmethod'])
+        assert len(worker1.cubes('shipcost')) == 1
+        pd.testing.assert_frame_equal(worker1.execute(SHIPCOST_QUERY), expected)
+
+        # a new version replaces the table in every worker; the old one is removed once no worker
+        # holds it
+        old_dirs = set(os.listdir(data_dir))
+        worker1.load_table('shipcost', SHIPCOST_PATH, replace=True)
+        assert old_dirs < set(os.listdir(data_dir))
+        pd.testing.assert_frame_equal(worker2.execute(SHIPCOST_QUERY), expected)
+        assert worker2._pandas_sql.table_version('shipcost') == 2
+        new_dirs = set(os.listdir(data_dir))
+        assert len(new_dirs - old_dirs) == 1 and len(new_dirs) == len(old_dirs)
+
+        worker2.drop_table('shipcost')
+        try:
+            worker1.execute(SHIPCOST_QUERY)
+            assert False, "the dropped table is still visible"
+        except KeyError:
+            pass
+
+
+def test_admission_control():
+    from verdict.pandas_sql.admission import AdmissionController, ServerOverloadedError
+
+    controller = AdmissionController(max_workers=1, max_queue=2, client_limit=1)
+    gate = threading.Event()
+    order = []
+
+    def job(name):
+        def run():
+            gate.wait()
+            order.append(name)
+            return name
+        return run
+
+    blocker = controller.submit(job('blocker'), 'interactive', 'c0')
+    while controller.stats()["running"] == 0:
+        pass
+    load = controller.submit(job('load'), 'load', 'c1')
+    stream = controller.submit(job('stream'), 'stream', 'c2')
+
+    # the queue is full: a lower priority is rejected; a higher one displaces the lowest
+    try:
+        controller.submit(job('load2'), 'load', 'c3')
+        assert False, "the request is not shed"
+    except ServerOverloadedError:
+        pass
+    interactive = controller.submit(job('interactive'), 'interactive', 'c4')
+    try:
+        load.result()
+        assert False, "the request is not displaced"
+    except ServerOverloadedError:
+        pass
+
+    gate.set()
+    assert interactive.result() == 'interactive'
+    assert stream.result() == 'stream'
+    assert blocker.result() == 'blocker'
+    assert order == ['blocker', 'interactive', 'stream']
+    assert controller.stats()["shed"] == 2
+
+    # the server sheds with a retryable status
+    saved = pandas_sql_server.admission_controller[0]
+    pandas_sql_server.admission_controller[0] = AdmissionController(max_workers=1, max_queue=0)
+    gate.clear()
+    try:
+        with running_server():
+            try:
+                pandas_sql_server.admission_controller[0].submit(job('busy'), 'load', 'c0')
+                client = PandasSQLClient(max_retries=1)
+                client.advisor_report()
+                client.execute({"op": "project", "arg": {}, "source": "table t"})
+                assert False, "the request is not shed"
+            except ServerOverloadedError as e:
+                assert e.retry_after > 0
+            finally:
+                gate.set()
+    finally:
+        pandas_sql_server.admission_controller[0] = saved
+
+
+def test_batch_via_server():
+    json_query = agg_query('shipcost_batch', groupby=['shipmethod'])
+    bad_query = agg_query('shipcost_batch', {"s": {"op": "sum", "arg": ["attr no_such_column"]}})
+    with running_server():
+        client = PandasSQLClient()
+        results = client.batch([
+            { "type": "load-table", "table-name": "shipcost_batch", "file-path": SHIPCOST_PATH,
+              "if-not-exists": True },
+            { "type": "json-query", "query": json_query },
+            { "type": "json-query", "query": bad_query },
+            { "type": "json-query", "query": json_query },
+            { "type": "drop-table", "table-name": "shipcost_batch" },
+            { "type": "json-query", "query": json_query },
+        ], return_exceptions=True)
+        assert results[0] > 0
+        pd.testing.assert_frame_equal(results[1], results[3])
+        assert isinstance(results[2], Exception)
+        assert results[4] == "ok"
+        # the table has been dropped by the previous item
+        assert isinstance(results[5], Exception)
+
+        try:
+            client.batch([{ "type": "json-query", "query": bad_query }])
+            assert False, "the failure is not raised"
+        except Exception:
+            pass
+
+
+def test_metrics_via_server():
+    import requests
+    from verdict.pandas_sql.pandas_sql_server import PANDAS_SQL_DEFAULT_PORT
+
+    with running_server():
+        client = PandasSQLClient()
+        row_count = client.load_table('shipcost_metrics', SHIPCOST_PATH)
+        client.execute(agg_query('shipcost_metrics'))
+
+        stats = client.stats()
+        assert stats["latencies"]["json-query"]["count"] >= 1
+        assert stats["tables"]["shipcost_metrics"]["rows"] == row_count
+        assert stats["tables"]["shipcost_metrics"]["memory"] > 0
+        assert stats["loads"]["shipcost_metrics"]["rows"] == row_count
+        assert stats["resident-memory"] > 0
+        assert client.readiness()["ready"]
+
+        r = requests.get(f'http://localhost:{PANDAS_SQL_DEFAULT_PORT}/metrics')
+        assert r.headers['Content-Type'].startswith('text/plain')
+        assert 'verdict_request_seconds_bucket{type="json-query",le="+Inf"}' in r.text
+        assert f'verdict_table_rows{{table="shipcost_metrics"}} {row_count}' in r.text
+        assert 'verdict_resident_memory_bytes' in r.text
+
+
+def test_preload():
+    from verdict.pandas_sql.columnar import write_columnar
+    from verdict.pandas_sql.preload import CachePreloader, order_files
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        paths = []
+        for i in range(6):
+            path = os.path.join(cache_dir, f'cache.t{i}')
+            pd.DataFrame({ "x": list(range(i + 1)) }).to_pickle(path)
+            os.utime(path, (1000 + i, 1000 + i))
+            paths.append(path)
+        # the most recently used first
+        assert order_files(paths, 'mru') == list(reversed(paths))
+        # a columnar table is as large as its files
+        big = os.path.join(cache_dir, 'cache.big')
+        write_columnar(pd.DataFrame({ "x": list(range(1000)) }), big)
+        assert order_files([big, paths[0]], 'smallest') == [paths[0], big]
+
+        pd_sql = PandasSQL()
+        loaded = []
+        preloader = CachePreloader(pd_sql, paths, workers=2,
+                                   on_loaded=lambda name, seconds, rows: loaded.append(name))
+        assert preloader.progress()["ready"] == False
+        preloader.ensure_loaded(['t0'])
+        assert pd_sql.get_df('t0')["x"].tolist() == [0]
+        preloader.start()
+        deadline = time.time() + 10
+        while not preloader.progress()["ready"] and time.time() < deadline:
+            time.sleep(0.01)
+        progress = preloader.progress()
+        assert progress["loaded"] == 6 and progress["failed"] == {}
+        assert sorted(loaded) == [f't{i}' for i in range(6)]
+        assert pd_sql.get_df('t5')["x"].tolist() == list(range(6))
+
+        # a missing file fails only its table
+        preloader = CachePreloader(PandasSQL(), paths + [os.path.join(cache_dir, 'cache.none')])
+        preloader.run()
+        assert list(preloader.progress()["failed"]) == ['none']
+        assert preloader.progress()["loaded"] == 6
+
+
+def test_hot_swap():
+    pd_sql = PandasSQL()
+    versions = [pd.DataFrame({ "g": [i % 3 for i in range(3000)], "x": [v] * 3000 })
+                for v in (1, 2)]
+    pd_sql.register_table('swapped', versions[0])
+    assert pd_sql.table_version('swapped') == 1
+    pd_sql.create_cube('swapped', ['g'])
+    json_query = agg_query(select_query('swapped', 'gt', 'g', -1),
+                           {"s": {"op": "sum", "arg": ["attr x"]}, "c": {"op": "count", "arg": []}})
+
+    errors = []
+    sums = set()
+    stop = threading.Event()
+
+    def query():
+        while not stop.is_set():
+            try:
+                result = pd_sql.execute(json_query)
+                sums.add((int(result["s"][0]), int(result["c"][0])))
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=query) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for i in range(20):
+        pd_sql.register_table('swapped', versions[(i + 1) % 2], replace=True)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    # never missing, never a mix of the versions
+    assert errors == []
+    assert sums <= {(3000, 3000), (6000, 3000)}
+    assert pd_sql.table_version('swapped') == 21
+    assert len(pd_sql.cubes('swapped')) == 1
+
+
+def test_compression_via_server():
+    from verdict.pandas_sql.protocol import available_codecs, compress, decompress
+
+    body = b'verdict' * 10000
+    for codec in available_codecs():
+        compressed = compress(body, codec)
+        assert len(compressed) < len(body)
+        assert bytes(decompress(compressed, codec)) == body
+
+    with running_server():
+        plain_client = PandasSQLClient(compression='none')
+        plain_client.load_table('shipcost', SHIPCOST_PATH)
+        expected = plain_client.execute(SHIPCOST_QUERY)
+        for codec in available_codecs():
+            for protocol in ['arrow', 'json']:
+                client = PandasSQLClient(protocol=protocol, transport='http', compression=codec,
+                                         compress_threshold=0)
+                assert client._codec == codec
+                pd.testing.assert_frame_equal(client.execute(SHIPCOST_QUERY), expected)
+            assert plain_client.stats()["compression"][codec]["ratio"] > 0
+
+
+def test_stream_via_server():
+    json_query = {"op": "project", "arg": {"shipmethod": "attr shipmethod", "cost": "attr cost"},
+                  "source": "table shipcost"}
+    with running_server():
+        for protocol in ['arrow', 'json']:
+            pd_sql_client = PandasSQLClient(protocol=protocol)
+            pd_sql_client.load_table('shipcost', SHIPCOST_PATH)
+            expected = pd_sql_client.execute(json_query)
+            chunks = list(pd_sql_client.execute_stream(json_query, chunk_rows=1))
+            assert len(chunks) == len(expected) and len(chunks) > 1
+            assert all(len(c) == 1 for c in chunks)
+            pd.testing.assert_frame_equal(pd.concat(chunks), expected)
+
+            # an empty result still carries the columns
+            empty_query = dict(json_query, source=select_query('shipcost', 'lt', 'cost', -1))
+            chunks = list(pd_sql_client.execute_stream(empty_query))
+            assert len(chunks) == 1 and len(chunks[0]) == 0
+            assert list(chunks[0].columns) == list(expected.columns)
+
+            try:
+                list(pd_sql_client.execute_stream(dict(json_query, arg={"p": "attr price"})))
+                assert False
+            except ValueError:
+                pass
+
+
+def test_single_flight_via_server():
+    from verdict.common.singleflight import SingleFlight
+
+    flights = SingleFlight()
+    calls = []
+    gate = threading.Event()
+
+    def slow():
+        calls.append(1)
+        gate.wait()
+        return len(calls)
+
+    threads = [threading.Thread(target=lambda: results.append(flights.do('key', slow)))
+               for _ in range(8)]
+    results = []
+    for thread in threads:
+        thread.start()
+    while flights.stats()["shared"] < 7:
+        time.sleep(0.01)
+    gate.set()
+    for thread in threads:
+        thread.join()
+    assert results == [1] * 8 and flights.stats() == { "in-flight": 0, "shared": 7 }
+
+    class SlowPandasSQL(PandasSQL):
+        executions = 0
+
+        def execute(self, query, fraction=None):
+            SlowPandasSQL.executions += 1
+            time.sleep(0.5)
+            return super().execute(query, fraction)
+
+    json_query = agg_query('shipcost')
+    with running_server(SlowPandasSQL()):
+        client = PandasSQLClient()
+        client.load_table('shipcost', SHIPCOST_PATH)
+        key = pandas_sql_server.query_key(json_query)
+        assert key == pandas_sql_server.query_key(json.loads(json.dumps(json_query)))
+
+        shared = client.stats()["flights"]["shared"]
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(client.execute(json_query)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(results) == 8 and SlowPandasSQL.executions < 8
+        assert client.stats()["flights"]["shared"] - shared == 8 - SlowPandasSQL.executions
+
+        # a replaced table is a different key
+        client.load_table('shipcost', SHIPCOST_PATH, replace=True)
+        assert pandas_sql_server.query_key(json_query) != key
+
+
+def test_loadtest():
+    from verdict.pandas_sql.loadtest import LoadGenerator, format_report, generate_tables, \
+        load_queries, parse_mix
+
+    queries = load_queries()
+    assert 'q1' in queries and 'q6' in queries
+
+    with running_server():
+        client = PandasSQLClient()
+        for name, path in generate_tables(tempfile.mkdtemp(), rows=2000).items():
+            client.load_table(name, path)
+        queries = {name: queries[name] for name in ['q1', 'q6']}
+        generator = LoadGenerator(client, queries, parse_mix('q1=3,q6', queries), concurrency=4,
+                                  rate=50, duration=1.0, memory_interval=0.2)
+        report = generator.run()
+        assert report["errors"] == {} and 40 <= report["requests"] <= 50
+        assert report["latency"]["p50"] <= report["latency"]["p95"] <= report["latency"]["p99"]
+        assert report["queries"]["q1"]["count"] > report["queries"]["q6"]["count"] > 0
+        assert len(report["memory"]) > 0 and report["memory"][0][1] > 0
+        assert 'throughput' in format_report(report)
+
+
+def test_snapshot():
+    from verdict.pandas_sql.columnar import write_columnar
+    from verdict.pandas_sql.snapshot import Snapshot, is_snapshot, write_snapshot
+
+    # read lazily; the snapshot reads its columns
+    typed = pd.DataFrame({
+        "name": ["a", None, "b", "c"],
+        "count": pd.array([1, None, 3, 4], dtype="Int64"),
+        "label": pd.array(["x", None, "y", "x"], dtype="string"),
+        "at": pd.to_datetime(["2020-01-01"] * 4).tz_localize("UTC"),
+        "kind": pd.Categorical(["p", "q", "p", "p"]),
+    })
+    typed_path = os.path.join(tempfile.mkdtemp(), 'typed')
+    write_columnar(typed, typed_path)
+
+    pd_sql = PandasSQL()
+    pd_sql.load_table('typed', typed_path, lazy=True)
+    pd_sql.load_table('shipcost', SHIPCOST_PATH)
+    pd_sql.create_cube('shipcost', ['shipmethod'])
+    assert pd_sql._build_structure(('index', 'shipcost', 'cost')) is not None
+    expected = pd_sql.execute(SHIPCOST_QUERY)
+
+    path = os.path.join(tempfile.mkdtemp(), 'snapshot')
+    write_snapshot(pd_sql, path)
+    write_snapshot(pd_sql, path)        # replaces the old one
+    assert is_snapshot(path)
+
+    restored = PandasSQL()
+    Snapshot(path).restore(restored)
+    pd.testing.assert_frame_equal(restored.get_df('shipcost'), pd_sql.get_df('shipcost'))
+    assert restored.get_df('shipcost').dtypes.equals(pd_sql.get_df('shipcost').dtypes)
+    pd.testing.assert_frame_equal(restored.get_df('typed'), typed)
+    assert restored.get_df('typed').dtypes.equals(typed.dtypes)
+    assert restored.get_df('typed').columns.dtype == typed.columns.dtype
+    assert list(restored._cubes['shipcost']) == [frozenset(['shipmethod'])]
+    assert list(restored._indexes['shipcost']) == ['cost']
+    assert restored.execute(SHIPCOST_QUERY).equals(expected)
+
+    # the server restores the snapshot at the startup
+    snapshot_options = pandas_sql_server.snapshot_options
+    snapshot_options["dir"] = path
+    try:
+        with running_server(PandasSQL()):
+            client = PandasSQLClient()
+            while not client.readiness()["ready"]:
+                time.sleep(0.01)
+            assert client.execute(SHIPCOST_QUERY).equals(expected)
+            assert client.snapshot()["tables"] == 2
+    finally:
+        snapshot_options["dir"] = None
+
+
+def test_columnar_compression_and_migration():
+    from verdict.pandas_sql.columnar import hold_table_dir, is_columnar, migrate_table_file, \
+        read_columnar, read_manifest, release_table_dir, remove_table_file, write_table_file
+
+    df = pd.DataFrame({
+        "repeated": np.zeros(10000),
+        "random": np.random.RandomState(0).rand(10000),
+        "name": ["a", None, "b", "c"] * 2500,
+    })
+    path = os.path.join(tempfile.mkdtemp(), 'table')
+    with open(path, 'wb') as f:
+        pickle.dump(df, f)
+    assert migrate_table_file(path, 'lz4')
+    assert is_columnar(path) and not migrate_table_file(path, 'lz4')
+    compressions = {c['name']: c['compression'] for c in read_manifest(path)['columns']}
+    # the random numbers do not shrink enough to give up the mapping
+    assert compressions == {"repeated": 'lz4', "random": None, "name": 'lz4'}
+    pd.testing.assert_frame_equal(read_columnar(path), df)
+    assert not read_columnar(path)["random"].to_numpy().flags.writeable     # mapped
+
+    # the strings are kept as they are, and the dtypes are restored
+    typed = pd.DataFrame({
+        0: ["a\x00", "", None, "b"],
+        1: pd.array([1, None, 3, 4], dtype="Int64"),
+        2: pd.array(["x", None, "y", "x"], dtype="string"),
+        3: pd.to_datetime(["2020-01-01"] * 4).tz_localize("UTC"),
+    })
+    typed_path = os.path.join(tempfile.mkdtemp(), 'typed')
+    write_table_file(typed, typed_path, 'lz4')
+    pd.testing.assert_frame_equal(read_columnar(typed_path), typed)
+
+    # replaced atomically by swapping a link to the new version
+    write_table_file(df.head(10), path)
+    pd.testing.assert_frame_equal(read_columnar(path), df.head(10))
+    write_table_file(df.head(5), path)
+    pd.testing.assert_frame_equal(read_columnar(path), df.head(5))
+    assert os.path.islink(path)
+    names = sorted(os.listdir(os.path.dirname(path)))
+    assert names == sorted(['table', os.readlink(path)])
+
+    # a version held by a reader outlives the replacement and the removal
+    held_path, fd = hold_table_dir(path)
+    write_table_file(df.head(3), path)
+    pd.testing.assert_frame_equal(read_columnar(path), df.head(3))
+    pd.testing.assert_frame_equal(read_columnar(held_path), df.head(5))
+    remove_table_file(path)
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(held_path)]
+    release_table_dir(path, fd)
+    assert os.listdir(os.path.dirname(path)) == []
+
+
+def test_lazy_columns():
+    from verdict.pandas_sql.columnar import write_columnar
+    from verdict.pandas_sql.lazy import referenced_columns
+
+    df = pd.read_pickle(SHIPCOST_PATH).assign(weight=[1.0, 2.0], note=['x', 'y'])
+    path = os.path.join(tempfile.mkdtemp(), 'shipcost')
+    write_columnar(df, path)
+
+    pd_sql = PandasSQL()
+    assert pd_sql.load_table('shipcost', path, lazy=True) == 2
+    assert [c for c, _ in pd_sql.columns('shipcost')] == list(df.columns)
+    assert list(pd_sql.get_df('shipcost').columns) == []
+
+    assert referenced_columns(SHIPCOST_QUERY) == ({'cost', 'shipmethod'}, False)
+    result = pd_sql.execute(SHIPCOST_QUERY)
+    assert sorted(pd_sql.get_df('shipcost').columns) == ['cost', 'shipmethod']
+    assert result['sum_cost'].sum() == df['cost'].sum()
+
+    # the cold columns are dropped and read again when used
+    assert pd_sql.evict_cold_columns(0) == 2
+    assert list(pd_sql.get_df('shipcost').columns) == []
+    assert pd_sql.execute(SHIPCOST_QUERY).equals(result)
+
+    # a query reads the columns into the version it has pinned; an eviction right after does not
+    # take them away
+    materialize_query = pd_sql._materialize_query
+
+    def materialize_and_evict(query):
+        materialize_query(query)
+        evictor = threading.Thread(target=pd_sql.evict_cold_columns, args=(0,))
+        evictor.start()
+        evictor.join()
+
+    pd_sql._materialize_query = materialize_and_evict
+    assert pd_sql.execute(SHIPCOST_QUERY).equals(result)
+    assert list(pd_sql.get_df('shipcost').columns) == []
+    del pd_sql._materialize_query
+
+    # a cube and a snapshot read the columns without keeping them
+    pd_sql.evict_cold_columns(0)
+    assert pd_sql.create_cube('shipcost', ['shipmethod']) > 0
+    pd.testing.assert_frame_equal(pd_sql.snapshot_state()["tables"]["shipcost"], df)
+    assert list(pd_sql.get_df('shipcost').columns) == []
+    pd_sql.drop_cube('shipcost')
+
+    # a query returning the rows reads all the columns
+    select = select_query('shipcost', 'gt', 'cost', 0)
+    assert referenced_columns(select) == ({'cost'}, True)
+    pd_sql.execute(select)
+    pd.testing.assert_frame_equal(pd_sql.get_df('shipcost'), df)
+
+
+def test_replace_lazy_table():
+    from verdict.pandas_sql.columnar import write_table_file
+
+    df = pd.DataFrame({"x": [1.0, 2.0, 3.0], "y": [10.0, 20.0, 30.0]})
+    table_dir = tempfile.mkdtemp()
+    path = os.path.join(table_dir, 't')
+    write_table_file(df, path)
+    sum_x = agg_query('t', {"s": {"op": "sum", "arg": ["attr x"]}})
+    sum_y = agg_query('t', {"s": {"op": "sum", "arg": ["attr y"]}})
+
+    pd_sql = PandasSQL()
+    pd_sql.load_table('t', path, lazy=True)
+    assert pd_sql.execute(sum_x)['s'][0] == 6.0
+
+    # the file is replaced between the queries; the registered table still reads its version
+    write_table_file(df * 2, path)
+    assert pd_sql.execute(sum_y)['s'][0] == 60.0
+    assert len(os.listdir(table_dir)) == 3
+
+    # a query pinning the old version reads it after the table is replaced and evicted
+    materialize_query = pd_sql._materialize_query
+
+    def replace_and_materialize(query):
+        pd_sql.load_table('t', path, replace=True, lazy=True)
+        assert pd_sql.evict_cold_columns(0) == 0
+        materialize_query(query)
+
+    pd_sql.evict_cold_columns(0)
+    pd_sql._materialize_query = replace_and_materialize
+    assert pd_sql.execute(sum_x)['s'][0] == 6.0
+    del pd_sql._materialize_query
+    assert pd_sql.execute(sum_y)['s'][0] == 120.0
+
+    # the old version has been removed once released
+    assert sorted(os.listdir(table_dir)) == sorted(['t', os.readlink(path)])
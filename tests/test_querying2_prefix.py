@@ -0,0 +1,47 @@
+from verdict.core.querying2 import Querying
+from verdict.interface import from_verdict_query
+from tests.test_cache_meta import cache_manager
+
+
+def test_cache_prefix_executions():
+    cache = cache_manager()
+    sample_id = 'test_prefix.t._rowid'
+    executions = []
+    execute = cache._cache_engine.execute
+
+    def counted_execute(query, fraction=None, **options):
+        executions.append(fraction)
+        return execute(query, fraction=fraction, **options)
+
+    cache._cache_engine.execute = counted_execute
+    try:
+        cache.store_cache_meta(sample_id, {'sampling_ratio': 0.5, 'source_name': 'base.t'})
+        cache.store_cache_data(sample_id, [(i % 10, float(i)) for i in range(1000)],
+                               [('g', 'int'), ('x', 'double')])
+        assert cache.get_cache_meta(sample_id)['row_count'] == 1000
+
+        def run(agg, groupby):
+            request = {
+                'type': 'single_agg',
+                'source': from_verdict_query('table base.t'),
+                'agg': from_verdict_query(agg),
+                'sample_info': {'base.t': [{'sample_id': sample_id, 'key_col': '_rowid'}]},
+            }
+            if len(groupby) > 0:
+                request['groupby'] = from_verdict_query([f'attr {c}' for c in groupby])
+            del executions[:]
+            result = Querying(None, cache).json(request, 0.1, False)
+            return result, list(executions)
+
+        # 100 rows are enough for the count
+        result, fractions = run({'c': {'op': 'count', 'arg': []}}, [])
+        assert fractions == [Querying.CACHE_PREFIX_FRACTION]
+        assert result['c'][0] == 2000
+
+        # not for 10 groups; the cache is scanned once
+        result, fractions = run({'c': {'op': 'count', 'arg': []}}, ['g'])
+        assert fractions == [None]
+        assert result['c'].tolist() == [200] * 10
+    finally:
+        cache.drop_cache_data(sample_id)
+        cache.close()
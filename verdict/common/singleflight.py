@@ -0,0 +1,48 @@
+import concurrent.futures
+import threading
+
+
+class SingleFlight(object):
+    """Coalesces the concurrent calls with the same key: the first caller runs the function, and
+    the others wait for its result (or its exception) instead of running it again. A call that
+    starts after the function has returned runs it anew.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}        # key -> the Future of the running call
+        self._shared_count = 0
+
+    def do(self, key, fn):
+        """
+        @param key  A hashable key; the calls with equal keys are coalesced
+        @param fn  Called with no arguments by the first caller
+        @return  fn's result
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._calls[key] = future
+            else:
+                self._shared_count += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        """@return  The number of the keys in flight and of the calls that shared a result"""
+        with self._lock:
+            return { "in-flight": len(self._calls), "shared": self._shared_count }
@@ -2,6 +2,25 @@ verdict_dir = "/usr/local/var/verdict"
 
 cache_redis_host = 'localhost'
 
+# The codec of the cache files ("lz4", "zstd", or None); see verdict.pandas_sql.columnar
+cache_compression = 'lz4'
+
+# How CacheManager.load_all_cache() loads the caches (see verdict.pandas_sql.preload)
+cache_preload_workers = 8
+
+cache_preload_order = 'mru'
+
+# The bytes the loaded caches may use (None for no limit) and the order in which the unused ones
+# are dropped beyond it: "lru" or "lfu"
+cache_memory_budget = None
+
+cache_eviction_policy = 'lru'
+
+# Whether the cache meta is invalidated by the Redis keyspace notifications (so that a cached meta
+# needs no round trip). The server must have them enabled ("notify-keyspace-events" with "K" and
+# either "A" or "g$"); they are not enabled here. Otherwise, the meta is revalidated by its version.
+cache_meta_notifications = True
+
 # No longer used
 cache_presto_host = 'localhost'
 
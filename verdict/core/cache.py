@@ -4,12 +4,20 @@ id: verdict.cache_meta.sample_id (str)
 value: {
     'sampling_ratio': double,
     'part_col_value': int,
-    'source_name': str
+    'source_name': str,
+    'row_order': 'random' (if the rows are shuffled),
+    'group_counts': { column name: the number of distinct values, ... },
+    'row_count': int (the number of rows in the cache file)
 }
 
 SET
-id: verdict.cache_data.sample_id (str)
-value: pickled pandas.DataFrame
+id: verdict.cache_meta_version.sample_id (str)
+value: int, increased whenever the cache meta is stored or dropped
+
+FILE
+path: verdict_dir/cache/sample_id
+value: the rows in the columnar format (see verdict.pandas_sql.columnar); a pickled
+       pandas.DataFrame in the older versions, which is converted when loaded
 """
 
 import concurrent.futures
@@ -17,15 +25,22 @@ import copy
 import os
 import pandas as pd
 import pdb
-import pickle
 import pathlib
 import redis
+import shutil
 import textwrap
-import uuid
+import threading
+import time
 from ..interface import *
+from ..common.singleflight import SingleFlight
 from ..common.tools import *
 from ..config import *
 from ..pandas_sql import PandasSQL, PandasSQLClient
+from ..pandas_sql.columnar import migrate_table_file, remove_table_file, write_table_file
+from ..pandas_sql.pandas_sql import prefix_length
+from ..pandas_sql.preload import order_files
+from ..pandas_sql.protocol import available_codecs
+from ..pandas_sql.cube import find_cube_pattern
 
 
 class CacheManager(object):
@@ -35,17 +50,68 @@ class CacheManager(object):
     :param server_mode:  
         If True, connects to Pandas SQL through the http connection. Otherwise, run Pandas SQL
         in the embedded mode.
+    :param memory_budget:
+        If not None, the bytes the loaded caches may use. Beyond it, the caches not used by a
+        running query are dropped (and loaded again when needed) in the order of eviction_policy.
+    :param eviction_policy:
+        "lru" (the least recently used first) or "lfu" (the least frequently used first)
     """
 
-    def __init__(self, preload_cache=True, server_mode=False):
+    # A cube is built over a set of dimensions once this many queries have grouped or filtered on
+    # exactly those dimensions.
+    CUBE_LEARNING_THRESHOLD = 10
+
+    # The maximum number of cubes per sample
+    MAX_CUBES_PER_SAMPLE = 4
+
+    EVICTION_POLICIES = ['lru', 'lfu']
+
+    # The distinct values of a column are counted in the cache meta only up to this many
+    GROUP_COUNT_LIMIT = 10000
+
+    # Without the keyspace notifications, a cached meta is checked against its version at most
+    # once per this many seconds.
+    CACHE_META_REVALIDATE_SECONDS = 1.0
+
+    # The memory of the tables in the engine is fetched at most once per this many seconds (and
+    # after a cache is loaded); evict_caches() uses the local estimates in between.
+    MEMORY_REFRESH_SECONDS = 5.0
+
+    def __init__(self, preload_cache=True, server_mode=False, memory_budget=cache_memory_budget,
+                 eviction_policy=cache_eviction_policy):
         """
-        self._cache_info is the mapping from a table name to its counter. A positive counter
-        means that the table must exist in the engine itself.
+        self._cache_info is the mapping from a table name to its counter (the number of the
+        running queries using the table), its size, and its usage. A table in it exists in the
+        engine; a table with a positive counter is never dropped.
+
+        self._cube_dims is the mapping from a table name to the list of the dimension sets (each
+        is a sorted list of column names) of its cubes.
         """
         persist_dir = os.path.join(verdict_dir, 'cache')
         pathlib.Path(persist_dir).mkdir(parents=True, exist_ok=True)
         self._persist_dir = persist_dir
+        self._compression = cache_compression if cache_compression in available_codecs() else None
         self._cache_info = {}
+        self._cache_info_lock = threading.Lock()
+        # Coalesces the concurrent loads of the same cache
+        self._load_flights = SingleFlight()
+        self._load_failures = {}
+        if eviction_policy not in CacheManager.EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy: {eviction_policy}")
+        self._memory_budget = memory_budget
+        self._eviction_policy = eviction_policy
+        # sample_id -> the bytes of its table in the engine, as of the last refresh
+        self._table_memory_estimates = {}
+        self._table_memory_refreshed = 0.0      # 0 forces a refresh
+        self._cube_dims = {}
+        self._dims_usage = {}
+        self.r = redis.Redis(host=cache_redis_host)
+        # sample_id -> (version, meta, the last time the version was checked)
+        self._meta_cache = {}
+        # sample_id -> the number of the invalidations; a meta read before one is not cached
+        self._meta_generations = {}
+        self._meta_lock = threading.Lock()
+        self._meta_watcher = self._watch_cache_meta()
         cache_host_port = cache_presto_host + ':' + cache_presto_port
         # self._cache_engine = PrestoEngine(host=cache_host_port, sample_catalog=cache_presto_catalog, 
         #                                   sample_schema=cache_presto_schema, query_concurrency=20)
@@ -58,35 +124,74 @@ class CacheManager(object):
                 log(f"Starting: loading persisted cache into an in-memory engine.")
                 self.load_all_cache()
                 log(f"Done: the cache has been all loaded.")
-        self._cache_catalog = cache_presto_catalog
-        self._cache_schema = cache_presto_schema
-        self.r = redis.Redis(host=cache_redis_host)
 
-    def load_all_cache(self):
-        """Checks the metadata and loads all cached tables.
+    def load_all_cache(self, workers=cache_preload_workers, order=cache_preload_order):
+        """Checks the metadata and loads all cached tables, workers of them at a time. A table
+        that fails to load is reported (see load_failures()) and does not stop the others.
 
+        @param order  The order of starting the loads: "mru" (the most recently used first),
+                      "smallest" (the smallest first), or "name"
         @return  The id of the loaded data
         """
         sample_ids = [key.decode('utf-8').replace(CacheManager.cache_meta_id_prefix, '') 
                         for key in self.r.keys(self.cache_meta_id("*"))]
+        filenames = {self.get_cache_filename(sid): sid for sid in sample_ids}
+        ordered = [filenames[f] for f in order_files(list(filenames), order)]
+
+        failures = {}
+        # the executor starts the jobs in the submitted order
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            jobs = {executor.submit(self.preload_cache, sid): sid for sid in ordered}
+            for job in concurrent.futures.as_completed(jobs):
+                sample_id = jobs[job]
+                try:
+                    job.result()
+                except Exception as e:
+                    failures[sample_id] = f"{type(e).__name__}: {e}"
+                    log(f"Failed to load the cache for {sample_id}: {e}", "error")
+                else:
+                    log(f"The cache has been loaded for {sample_id}", "debug")
+        self._load_failures = failures
+        return [sid for sid in ordered if sid not in failures]
+
+    def load_failures(self):
+        """@return  { sample_id: error } of the caches that the last load_all_cache() failed to
+                    load"""
+        return dict(self._load_failures)
+
+    def preload_cache(self, sample_id):
+        """Loads the cache without keeping it in use."""
+        self.increase_cache_counter(sample_id)
+        self.reduce_cache_counter(sample_id)
+        return sample_id
+
+    def execute(self, query, fraction=1.0, priority=None):
+        """The caches the query reads are kept in use (i.e., never dropped) until it finishes.
 
-        for sample_id in sample_ids:
-            self.increase_cache_counter(sample_id)
-
-        # with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        #     jobs = [executor.submit(self.increase_cache_counter, sid) for sid in sample_ids]
-        #     for job in concurrent.futures.as_completed(jobs):
-        #         try:
-        #             sample_id = job.result()
-        #         except Exception as e:
-        #             log(f"{sample_id} generated an exception: {e}", "error")
-        #         else:
-        #             log(f"The cache has been loaded for {sample_id}", "debug")
-        return sample_ids
-
-    def execute(self, query):
-        """
         @param query  A verdict query
+        @param fraction  If less than 1.0, only this fraction of the cache is processed when the
+                         query reads a single cache whose rows are stored in random order. The
+                         returned meta['ratio'] is the sampling ratio of the processed rows, and
+                         meta['fraction'] is the fraction actually processed.
+        @param priority  The priority class of the query in the Pandas SQL server (see
+                         verdict.pandas_sql.admission); ignored by the in-process engine.
+        """
+        pinned = []
+        try:
+            return self._execute(query, fraction, priority, pinned)
+        finally:
+            for sample_id in pinned:
+                self.reduce_cache_counter(sample_id)
+            if len(pinned) > 0:
+                # a failed eviction must not fail the query
+                try:
+                    self.evict_caches()
+                except Exception as e:
+                    log(f"Failed to evict the caches: {e}", "error")
+
+    def _execute(self, query, fraction, priority, pinned):
+        """
+        @param pinned  The ids of the caches whose counters have been increased are appended
         """
         assert_type(query, dict)
         query = copy.deepcopy(query)
@@ -95,15 +200,37 @@ class CacheManager(object):
         
         engine = self._cache_engine
 
+        cube_pattern = find_cube_pattern(query)
+        if cube_pattern is not None:
+            self.learn_cube(cube_pattern)
+
         ratios = {}     # sampling ratios
         cache_sizes  = {}
+        row_orders = {}
         tables_to_cache = find_base_tables(query, include_samples=True)
         for cache_table in tables_to_cache:
             cache_name = cache_table.name()     # sample_id
             self.increase_cache_counter(cache_name)
+            pinned.append(cache_name)
             cache_meta = self.get_cache_meta(cache_name)
             ratios[cache_name] = float(cache_meta['sampling_ratio'])
-            cache_sizes[cache_name] = self._cache_info[cache_name]['cache_size']
+            with self._cache_info_lock:
+                cache_sizes[cache_name] = self._cache_info[cache_name]['cache_size']
+            row_orders[cache_name] = cache_meta.get('row_order')
+
+        # The prefix of a randomly ordered cache is a uniform sample of it. We only sub-sample a
+        # single cache since the prefixes of different caches do not preserve their joins.
+        if fraction < 1.0 and len(ratios) == 1 and list(row_orders.values())[0] == 'random':
+            cache_name = list(ratios.keys())[0]
+            prefix_size = prefix_length(cache_sizes[cache_name], fraction)
+            if prefix_size > 0:
+                fraction = prefix_size / float(cache_sizes[cache_name])
+                ratios[cache_name] *= fraction
+                cache_sizes[cache_name] = prefix_size
+            else:
+                fraction = 1.0
+        else:
+            fraction = 1.0
 
         GROUP_SIZE_ALIAS = '_group_size'
 
@@ -127,21 +254,66 @@ class CacheManager(object):
 
         query = inject_group_size(query)
         query_to_db = to_verdict_query(query)
-        result = engine.execute(query_to_db)
+        options = {}
+        if fraction < 1.0:
+            options['fraction'] = fraction
+        if priority is not None and isinstance(engine, PandasSQLClient):
+            options['priority'] = priority
+        result = engine.execute(query_to_db, **options)
         result, group_sizes = remove_injected(result)
         meta = {
             'ratio': min(ratios.values()),
             'min_group_size': min(group_sizes),
             'max_group_size': max(group_sizes),
             'total_cache_size': min(cache_sizes.values()),
+            'fraction': fraction,
         }
-
-        # clear things up
-        # for cache_table in tables_to_cache:
-        #     cache_name = cache_table.name()
-        #     self.reduce_cache_counter(cache_name)
         return result, meta
 
+    def declare_cube(self, sample_id, dims):
+        """Materializes a cube (i.e., the sums and counts per dimension combination) over the cache
+        of the sample. The group-by queries over those dimensions (and with filters on them) are
+        then answered from the cube. The cube is rebuilt whenever the cache is reloaded.
+
+        @param dims  A list of column names
+        @return  The number of rows in the cube
+        """
+        assert_type(dims, (List, tuple))
+        dims = sorted(dims)
+        declared = self._cube_dims.setdefault(sample_id, [])
+        if dims not in declared:
+            declared.append(dims)
+        log(f"A cube is declared for {sample_id} over {dims}.", "debug")
+        return self._cache_engine.create_cube(sample_id, dims)
+
+    def drop_cube(self, sample_id, dims):
+        dims = sorted(dims)
+        if dims in self._cube_dims.get(sample_id, []):
+            self._cube_dims[sample_id].remove(dims)
+        self._cache_engine.drop_cube(sample_id, dims)
+
+    def learn_cube(self, cube_pattern):
+        """Counts the dimension sets used by the queries; declares a cube for a frequent one.
+
+        @param cube_pattern  A CubePattern of a query
+        """
+        sample_id = cube_pattern.table_name
+        dims = cube_pattern.dims
+        if len(dims) == 0:
+            return
+        usage = self._dims_usage.setdefault(sample_id, {})
+        usage[dims] = usage.get(dims, 0) + 1
+        if usage[dims] != CacheManager.CUBE_LEARNING_THRESHOLD:
+            return
+
+        declared = self._cube_dims.get(sample_id, [])
+        if any([dims <= set(d) for d in declared]):
+            return
+        if len(declared) >= CacheManager.MAX_CUBES_PER_SAMPLE:
+            return
+        log(f"Frequently used dimensions are found for {sample_id}: {sorted(dims)}.", "debug")
+        self.declare_cube(sample_id, sorted(dims))
+
     def retrieve_min_group_size(self):
         return self.min_group_size
 
@@ -149,75 +321,175 @@ class CacheManager(object):
         return self.max_group_size
 
     def reduce_cache_counter(self, sample_id):
-        if sample_id not in self._cache_info:
-            return
-        else:
-            self._cache_info[sample_id]['counter'] -= 1 
-            if self._cache_info[sample_id]['counter'] < 1:
-                cache_dest = f"{self._cache_catalog}.{self._cache_schema}.{sample_id}"
-                self._cache_engine.drop_table(cache_dest)
-                self._cache_info[sample_id]
-                log(f"Dropped {sample_id} from the in-memory db", 'debug')
-        
+        """Marks the cache as no longer used by a query; see evict_caches() for dropping it."""
+        with self._cache_info_lock:
+            info = self._cache_info.get(sample_id)
+            if info is not None and info['counter'] > 0:
+                info['counter'] -= 1
+
     def increase_cache_counter(self, sample_id):
-        if sample_id not in self._cache_info:
-            # sample_meta = self.get_cache_meta(sample_id)
+        """Loads the cache if it is not loaded, and marks it as used by a query. The concurrent
+        callers on the same unloaded cache wait for a single load."""
+        def load():
             cache_size = self.cache_to_db(sample_id)
-            self._cache_info[sample_id] = {
-                'counter': 1,
-                'cache_size': cache_size,
-            }
+            # registered before the flight ends so that a later caller finds it loaded
+            with self._cache_info_lock:
+                if sample_id not in self._cache_info:
+                    self._cache_info[sample_id] = {
+                        'counter': 0,
+                        'cache_size': cache_size,
+                        'uses': 0,
+                        'last_used': time.time(),
+                    }
+                    # the memory of the new table is fetched by the next eviction
+                    self._table_memory_refreshed = 0.0
+
+        while True:
+            with self._cache_info_lock:
+                info = self._cache_info.get(sample_id)
+                evicted = None if info is None else info.get('evicted')
+                if info is not None and evicted is None:
+                    self._use_cache(info)
+                    return sample_id
+            if evicted is not None:
+                # being dropped (see evict_caches()); loaded again afterwards
+                evicted.wait()
+                continue
+            # loaded without the lock so that other samples are loaded meanwhile; loaded again
+            # if evicted before being marked as used
+            self._load_flights.do(sample_id, load)
+
+    def _use_cache(self, info):
+        info['counter'] += 1
+        info['uses'] += 1
+        info['last_used'] = time.time()
+
+    def evict_caches(self):
+        """Drops the caches not used by any running query from the engine, in the order of the
+        eviction policy, until the loaded caches fit in the memory budget.
+
+        @return  The ids of the dropped caches
+        """
+        if self._memory_budget is None:
+            return []
+        memory = self._table_memory()
+        if self._eviction_policy == 'lfu':
+            def rank(item):
+                return (item[1]['uses'], item[1]['last_used'])
         else:
-            if self._cache_info[sample_id]['counter'] <= 0:
-                cache_size = self.cache_to_db(sample_id)
-                self._cache_info[sample_id] = {
-                    'counter': 1,
-                    'cache_size': cache_size,
-                }
-            else:
-                self._cache_info[sample_id]['counter'] += 1
-        return sample_id
+            def rank(item):
+                return item[1]['last_used']
+
+        victims = []
+        with self._cache_info_lock:
+            total = sum(memory.get(sid, 0) for sid, info in self._cache_info.items()
+                            if 'evicted' not in info)
+            for sample_id, info in sorted(self._cache_info.items(), key=rank):
+                if total <= self._memory_budget:
+                    break
+                if info['counter'] > 0 or 'evicted' in info:
+                    continue
+                # no query starts using it until it is dropped (see increase_cache_counter())
+                info['evicted'] = threading.Event()
+                total -= memory.get(sample_id, 0)
+                victims.append(sample_id)
+
+        # dropped without the lock so that the other caches are used meanwhile
+        evicted = []
+        for sample_id in victims:
+            try:
+                self._cache_engine.drop_table(sample_id, if_exists=True)
+                dropped = True
+            except Exception as e:
+                log(f"Failed to drop {sample_id} from the in-memory db: {e}", "error")
+                dropped = False
+            with self._cache_info_lock:
+                event = self._cache_info[sample_id].pop('evicted')
+                if dropped:
+                    del self._cache_info[sample_id]
+                    self._table_memory_estimates.pop(sample_id, None)
+                    evicted.append(sample_id)
+            event.set()
+        if len(evicted) > 0:
+            log(f"Dropped {evicted} from the in-memory db to fit in {self._memory_budget} "
+                f"bytes.", 'debug')
+        return evicted
+
+    def _table_memory(self):
+        """@return  { table name: bytes } of the tables in the engine; fetched from the engine at
+                    most once per MEMORY_REFRESH_SECONDS (or after a load), estimated in between"""
+        now = time.time()
+        with self._cache_info_lock:
+            refreshed = self._table_memory_refreshed
+            if now - refreshed < CacheManager.MEMORY_REFRESH_SECONDS:
+                return dict(self._table_memory_estimates)
+        if isinstance(self._cache_engine, PandasSQLClient):
+            tables = self._cache_engine.stats()["tables"]
+        else:
+            tables = self._cache_engine.table_stats()
+        memory = {name: t["memory"] for name, t in tables.items()}
+        with self._cache_info_lock:
+            self._table_memory_estimates = dict(memory)
+            # unless a cache has been loaded meanwhile
+            if self._table_memory_refreshed == refreshed:
+                self._table_memory_refreshed = now
+        return memory
 
 
     def cache_to_db(self, sample_id):
         log(f"Starts to load the cache for (sample_id = {sample_id}).", "debug")
         rows_count = self.cache_to_pandasdb(sample_id)
+        # The engine may have been restarted; we declare the cubes again (no-op otherwise).
+        for dims in self._cube_dims.get(sample_id, []):
+            self._cache_engine.create_cube(sample_id, dims)
         log(f"The cache of (sample_id = {sample_id}) has been loaded.", "debug")
         return rows_count
 
 
-    def cache_to_prestodb(self, sample_id):
-        data_col = self.get_cache_data(sample_id)
-        if data_col is None:
-            raise ValueError(f'Not found in cache: {sample_id}')
-        data, col_def = data_col
-        cache_dest = f"{self._cache_catalog}.{self._cache_schema}.{sample_id}"
-        self._cache_engine.drop_table(cache_dest, if_exists=True)
-        rows_count = self._cache_engine.create_table(cache_dest, data, col_def)
-        return rows_count
-
-
     def cache_to_pandasdb(self, sample_id):
         cache_filename = self.get_cache_filename(sample_id)
-        rows_count = self._cache_engine.load_table(sample_id, cache_filename)
-        # data_col = self.get_cache_data(sample_id)
-        # if data_col is None:
-        #     raise ValueError(f'Not found in cache: {sample_id}')
-        # data, col_def = data_col
-        # rows_count = self._cache_engine.create_table(sample_id, data, col_def)
+        if migrate_table_file(cache_filename, self._compression):
+            log(f"The cache of (sample_id = {sample_id}) has been converted to the columnar "
+                f"format.", "debug")
+        # the columns are read when the queries first reference them
+        rows_count = self._cache_engine.load_table(sample_id, cache_filename, if_not_exists=True,
+                                                   lazy=True)
         return rows_count
 
 
     # CACHE META MANAGEMENT
     def get_cache_meta(self, sample_id):
+        """The meta is cached in this process. It is invalidated by the Redis keyspace notifications
+        if available (then, no round trip is made for a cached meta); otherwise, by its version.
+        """
         assert_type(sample_id, str)
         cache_id = self.cache_meta_id(sample_id)
         if cache_id is None:
             return None
 
-        cache_meta = self.get(cache_id)
+        now = time.time()
+        with self._meta_lock:
+            cached = self._meta_cache.get(sample_id)
+            generation = self._meta_generations.get(sample_id, 0)
+        if cached is not None:
+            version, meta, checked = cached
+            if self._watching_cache_meta() or \
+                    now - checked < CacheManager.CACHE_META_REVALIDATE_SECONDS:
+                return dict(meta)
+            if self.r.get(self.cache_meta_version_id(sample_id)) == version:
+                with self._meta_lock:
+                    if self._meta_generations.get(sample_id, 0) == generation:
+                        self._meta_cache[sample_id] = (version, meta, now)
+                return dict(meta)
+
+        # both in a single round trip
+        version, cache_meta = self.r.mget([self.cache_meta_version_id(sample_id), cache_id])
         assert cache_meta is not None
-        return json.loads(cache_meta)
+        meta = json.loads(cache_meta.decode('utf-8'))
+        with self._meta_lock:
+            if self._meta_generations.get(sample_id, 0) == generation:
+                self._meta_cache[sample_id] = (version, meta, now)
+        return dict(meta)
 
     def store_cache_meta(self, sample_id, sample_meta):
         """
@@ -227,31 +499,94 @@ class CacheManager(object):
         assert_type(sample_id, str)
         assert_type(sample_meta, dict)
         self.set(self.cache_meta_id(sample_id), json.dumps(sample_meta))
+        self.r.incr(self.cache_meta_version_id(sample_id))
+        self._invalidate_cache_meta(sample_id)
 
     def drop_cache_meta(self, sample_id):
         assert_type(sample_id, str)
         self.delete(self.cache_meta_id(sample_id))
+        self.r.incr(self.cache_meta_version_id(sample_id))
+        self._invalidate_cache_meta(sample_id)
+
+    def _invalidate_cache_meta(self, sample_id):
+        with self._meta_lock:
+            self._meta_cache.pop(sample_id, None)
+            self._meta_generations[sample_id] = self._meta_generations.get(sample_id, 0) + 1
+
+    def _watch_cache_meta(self):
+        """Subscribes to the keyspace notifications of the cache meta, so that the meta changed by
+        any process is invalidated here. The notifications must be enabled on the Redis server
+        (see config.cache_meta_notifications); this never changes its configuration.
+
+        @return  The thread receiving the notifications; None if they are not available
+        """
+        if not cache_meta_notifications:
+            return None
+        try:
+            events = self.r.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+            if 'K' not in events or ('A' not in events and not ('g' in events and '$' in events)):
+                log(f"The cache meta is revalidated by its version since the keyspace "
+                    f"notifications are not enabled (notify-keyspace-events: '{events}').", "debug")
+                return None
+            pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+            pattern = f"__keyspace@*__:{self.cache_meta_id('*')}"
+            pubsub.psubscribe(**{pattern: self._on_cache_meta_changed})
+            return pubsub.run_in_thread(sleep_time=1.0, daemon=True,
+                                        exception_handler=self._on_cache_meta_watch_failed)
+        except redis.exceptions.RedisError as e:
+            log(f"The cache meta is revalidated by its version since the keyspace notifications "
+                f"are not available: {e}", "debug")
+            return None
+
+    def _watching_cache_meta(self):
+        """@return  True if the cached meta is invalidated by the notifications"""
+        watcher = self._meta_watcher
+        return watcher is not None and watcher.is_alive()
+
+    def _on_cache_meta_watch_failed(self, e, pubsub, thread):
+        """Stops watching once receiving the notifications fails. Any of them may have been
+        missed, so every cached meta is invalidated; from then on, they are revalidated by their
+        versions.
+        """
+        log(f"The cache meta is revalidated by its version since the keyspace notifications "
+            f"failed: {e}", "error")
+        thread.stop()
+        with self._meta_lock:
+            self._meta_watcher = None
+            for sample_id in self._meta_cache:
+                self._meta_generations[sample_id] = self._meta_generations.get(sample_id, 0) + 1
+            self._meta_cache.clear()
+
+    def close(self):
+        """Stops watching the cache meta."""
+        with self._meta_lock:
+            watcher, self._meta_watcher = self._meta_watcher, None
+        if watcher is not None:
+            watcher.stop()
+            if watcher is not threading.current_thread():
+                watcher.join()
+
+    def _on_cache_meta_changed(self, message):
+        channel = message['channel'].decode('utf-8')
+        key = channel.split(':', 1)[1]
+        self._invalidate_cache_meta(key[len(CacheManager.cache_meta_id_prefix):])
 
 
     # CACHE DATA MANAGEMENT
     def get_cache_filename(self, sample_id):
         return os.path.join(self._persist_dir, self.cache_data_id(sample_id))
         
-    def get_cache_data(self, sample_id):
-        """
-        @param sample_id  sample_id
-        @return (data, col_def) where
-            data := [tuple, ...]
-            col_def := [(name, type), ...]
-        """
-        assert_type(sample_id, str)
-        cache_filename = self.get_cache_filename(sample_id)
-        with open(cache_filename, 'rb') as f:
-            data_col = pickle.load(f)
-            return data_col
-
     def store_cache_data(self, sample_id, data, col_def):
-        """Stores the cache data to a file
+        """Stores the cache data to a file in the columnar format, which the engine maps instead of
+        reading. The rows are stored in random order so that any prefix of them is a uniform
+        sample of the cache (see execute()); this is recorded in the cache meta as 'row_order'.
+        The numbers of distinct values of the columns with a few are recorded as 'group_counts',
+        and the number of rows as 'row_count' (see Querying.cache_group_counts()). The meta is
+        stored after the engine has loaded the new data, so that no query reads the old data as
+        ordered randomly.
+
+        If the cache already exists (i.e., it is refreshed), the engine swaps in the new data
+        atomically; the queries never find the cache missing.
 
         @param sample_id  sample_id
         @param data  [tuple, ...]
@@ -262,15 +597,30 @@ class CacheManager(object):
         assert_type(col_def, List)
         cache_filename = self.get_cache_filename(sample_id)
         df = PandasSQL.frame_from_data(data, col_def)
-        with open(cache_filename, 'wb') as f:
-            pickle.dump(df, f)
-            log(f"The cache of (sample_id = {sample_id}) is saved to {cache_filename}.", "debug")
-        self._cache_engine.load_table(sample_id, cache_filename)
+        df = df.sample(frac=1.0).reset_index(drop=True)
+        # written aside and renamed so that a concurrent load never reads a partial file
+        write_table_file(df, cache_filename, self._compression)
+        log(f"The cache of (sample_id = {sample_id}) is saved to {cache_filename}.", "debug")
+        group_counts = {}
+        for name in df.columns:
+            count = df[name].nunique()
+            if count <= CacheManager.GROUP_COUNT_LIMIT:
+                group_counts[name] = int(count)
+        rows_count = self._cache_engine.load_table(sample_id, cache_filename, replace=True,
+                                                   lazy=True)
+        with self._cache_info_lock:
+            if sample_id in self._cache_info:
+                self._cache_info[sample_id]['cache_size'] = rows_count
+        cache_meta = self.get(self.cache_meta_id(sample_id))
+        if cache_meta is not None:
+            cache_meta = json.loads(cache_meta)
+            cache_meta['row_order'] = 'random'
+            cache_meta['group_counts'] = group_counts
+            cache_meta['row_count'] = len(df.index)
+            self.store_cache_meta(sample_id, cache_meta)
 
     def drop_cache_data(self, sample_id):
-        cache_filename = self.get_cache_filename(sample_id)
-        if os.path.exists(cache_filename):
-            os.remove(cache_filename)
+        remove_table_file(self.get_cache_filename(sample_id))
 
 
     cache_meta_id_prefix = "verdict.cache_meta."
@@ -281,6 +631,11 @@ class CacheManager(object):
         """
         return CacheManager.cache_meta_id_prefix + sample_id
 
+    cache_meta_version_id_prefix = "verdict.cache_meta_version."
+
+    def cache_meta_version_id(self, sample_id):
+        return CacheManager.cache_meta_version_id_prefix + sample_id
+
     def cache_data_id(self, sample_id):
         """
         @param sample_id  Mostly, sample_id
@@ -300,6 +655,6 @@ class CacheManager(object):
                 value = {value}'''))
         self.r.set(key, value.encode('utf-8'))
 
-    # def delete(self, key):
-    #     self.r.delete(key)
+    def delete(self, key):
+        self.r.delete(key)
 
@@ -14,6 +14,7 @@ from typing import Callable, List
 from ..interface import *
 from ..common.logging import *
 from ..common.tools import *
+from ..pandas_sql.pandas_sql import prefix_length
 
 
 
@@ -196,13 +197,8 @@ class AggMerger(object):
 
                 # merge agg columns (e.g., total_price_x, total_price_y) into one (total_price)
                 for i, agg_col in enumerate(agg_cols):
-                    to_merge_cols = []
-                    # find matching columns
-                    for jc in joined.columns:
-                        if jc.startswith(agg_col):
-                            assert jc != agg_col
-                            to_merge_cols.append(jc)
-                    assert_equal(len(to_merge_cols), 2)
+                    # pd.merge() suffixes the columns of the same name
+                    to_merge_cols = [agg_col + '_x', agg_col + '_y']
 
                     joined[agg_col] = self._merge_func[self._agg_types[i]](
                                             (joined[to_merge_cols[0]], prev_ratio), 
@@ -214,6 +210,10 @@ class AggMerger(object):
 
         return self.unbiased_result()
 
+    def merged_result(self):
+        """The merged answers as they are (i.e., not scaled by the sampling ratio)."""
+        return self._merged_result
+
     def unbiased_result(self):
         """Obtains a statistically unbiased answer from a series of answers that have been merged.
 
@@ -297,6 +297,12 @@ class Querying(object):
     #    Then, we need 73778 samples for each group.
     AVG_MIN_SAMPLE_SIZE = 73778
 
+    # The fraction of the cache first tried. If the part has found every group (see
+    # cache_group_counts()) and the error estimated from it is small enough, its answer is
+    # returned without processing the rest of the cache. It is not tried if it cannot be
+    # large enough (see prefix_may_suffice()).
+    CACHE_PREFIX_FRACTION = 0.1
+
     def __init__(self, engine, cache_engine):
         self._engine = engine
         self._cache_engine = cache_engine
@@ -393,7 +399,31 @@ class Querying(object):
         
         # this method sets some metadata to "self" object
         # thus, the instance of this class must be created for every query by the front-end
-        cache_result, cache_ratio = self.run_on_cache(query_to_run, base2chosen)
+        group_counts = None
+        if not cache_only and not options['bypass_cache']:
+            group_counts = self.cache_group_counts(source_rel, query_request.get('groupby', []),
+                                                   base2chosen)
+        if group_counts is not None and \
+                self.prefix_may_suffice(query_to_run, group_counts, rel_err_bound):
+            # Tries a part of the cache first; enough for the loose error bounds. Its answer is
+            # only used if it has every group; otherwise, the smallest groups may be missing.
+            cache_result, cache_ratio = self.run_on_cache(query_to_run, base2chosen, 
+                                                          Querying.CACHE_PREFIX_FRACTION)
+            groups_count = 1
+            for count in group_counts:
+                groups_count *= count
+            has_all_groups = len(cache_result.index) >= groups_count and \
+                                self._min_group_size_on_cache > 0
+            if self._cache_fraction < 1.0:
+                if has_all_groups and cache_ratio >= \
+                        self.estimate_required_sampling_ratio(query_to_run, rel_err_bound):
+                    log(f"A part of the cache ({self._cache_fraction*100:.2f}%) is large enough; "
+                        f"we return its answer.", "debug")
+                    agg_merger = AggMerger(query_to_run, orderby, limit)
+                    return agg_merger.merge(cache_result, cache_ratio)
+                cache_result, cache_ratio = self.run_on_cache(query_to_run, base2chosen)
+        else:
+            cache_result, cache_ratio = self.run_on_cache(query_to_run, base2chosen)
         agg_merger = AggMerger(query_to_run, orderby, limit)
         unbiased_result = agg_merger.merge(cache_result, cache_ratio)
         log("The result using cache:", 'debug')
@@ -441,7 +471,71 @@ class Querying(object):
         log(unbiased_result, 'debug')
         return unbiased_result
 
-    def run_on_cache(self, query, base2chosen):
+    def cache_group_counts(self, source_rel, groupby, base2chosen):
+        """Finds the number of distinct values in the cache of each group-by column, as recorded
+        in the cache meta. If a part of the cache has as many groups as their product, it has
+        found every group of the query.
+
+        :param groupby:  A list of group-by attributes (BaseAttr or str)
+
+        :return:  A list of counts (empty if there is no group-by), or None if unknown; i.e., the
+                  query reads more than one cache, or a group-by column is not a column of the
+                  cache. The number of rows in the cache is set to self._cache_row_count.
+        """
+        if len(base2chosen) != 1:
+            return None
+        rel = source_rel
+        while isinstance(rel, DerivedTable):
+            # a project may define a group-by column under the name of another column
+            if not rel.is_select():
+                return None
+            rel = rel.source()
+        sample_id = list(base2chosen.values())[0]['sample_id']
+        cache_meta = self._cache_engine.get_cache_meta(sample_id)
+        if 'row_count' not in cache_meta:
+            return None
+        self._cache_row_count = cache_meta['row_count']
+        distinct_counts = cache_meta.get('group_counts', {})
+        counts = []
+        for attr in groupby:
+            name = attr.name() if isinstance(attr, BaseAttr) else attr
+            if name not in distinct_counts:
+                return None
+            counts.append(distinct_counts[name])
+        return counts
+
+    def prefix_may_suffice(self, query, group_counts, rel_err_bound):
+        """Checks if the prefix of the cache (see CACHE_PREFIX_FRACTION) can be large enough
+        before it is processed, so that the cache is not scanned twice when it cannot be. The
+        smallest group of the prefix has at most its average number of rows, which bounds the
+        ratio estimate_required_sampling_ratio() can find from the prefix.
+
+        :param group_counts:  See cache_group_counts(), which must have been called
+
+        :return:  False if the prefix cannot be large enough; True otherwise
+        """
+        prefix_size = prefix_length(self._cache_row_count, Querying.CACHE_PREFIX_FRACTION)
+        if prefix_size >= self._cache_row_count:
+            # the prefix is the entire cache
+            return False
+        groups_count = 1
+        for count in group_counts:
+            groups_count *= count
+        max_min_group_size = prefix_size / float(max(groups_count, 1))
+
+        agg_table = query
+        while not agg_table.is_agg():
+            agg_table = agg_table.source()
+        for agg_func, alias in agg_table.relop_args():
+            if agg_func.op() == 'count':
+                # see estimate_required_sampling_ratio(); the selectivity is at most 1/groups_count
+                if (groups_count - 1) / rel_err_bound**2 > prefix_size:
+                    return False
+            elif max_min_group_size < Querying.AVG_MIN_SAMPLE_SIZE:
+                return False
+        return True
+
+    def run_on_cache(self, query, base2chosen, fraction=1.0, priority='interactive'):
         """Process the query using an in-memory engine.
 
         For every base table (e.g., named "base.table"), we replace it with "base.table.key_col",
@@ -458,6 +552,12 @@ class Querying(object):
                     "sample_id": str,
                     "sampling_ratio": float
                 }
+
+        :param fraction:  If less than 1.0, the cache engine may process only this fraction of the
+                          cache. The returned ratio is the sampling ratio of the processed rows.
+
+        :param priority:  The priority class of the query in the cache server; the stream
+                          partitions yield to the interactive queries.
         """
         query = copy.deepcopy(query)
         old2new_name = {}
@@ -466,10 +566,11 @@ class Querying(object):
             old2new_name[base] = sample_id
         new_query = replace_table_name(query, old2new_name)
         query_to_db = to_verdict_query(new_query)
-        result, meta = self._cache_engine.execute(query_to_db)
+        result, meta = self._cache_engine.execute(query_to_db, fraction, priority)
         ratio = meta['ratio']
         assert_type(ratio, float)
         self._cache_ratio = ratio
+        self._cache_fraction = meta.get('fraction', 1.0)
         self._min_group_size_on_cache = meta['min_group_size']
         self._max_group_size_on_cache = meta['max_group_size']
         self._total_cache_size = meta['total_cache_size']
@@ -728,7 +829,8 @@ class Querying(object):
                 ratio = part['sampling_ratio']
                 if col_value == cache_col_value:
                     query_futures.append(
-                        executor.submit(self.run_on_cache, query_to_run, base2chosen))
+                        executor.submit(self.run_on_cache, query_to_run, base2chosen, 
+                                        priority='stream'))
                 else:
                     query_futures.append(
                         executor.submit(self.run_on_sample_part, query_to_run, primary_base, 
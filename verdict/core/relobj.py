@@ -520,7 +520,7 @@ class Table(object):
     def project(self, args) -> 'DerivedTable':
         if isinstance(args, dict):
             col_dict = args
-            return self.agg([(attr, alias) for alias, attr in col_dict.items()])
+            return self.project([(attr, alias) for alias, attr in col_dict.items()])
         assert_type(args, (List, tuple))
         for attr_alias in args:
             assert_type(attr_alias[0], (BaseAttr, AttrOp))
@@ -1,3 +1,5 @@
 from .pandas_sql import PandasSQL
 from .pandas_sql_client import PandasSQLClient
+from .pandas_sql_async_client import AsyncPandasSQLClient
 from .pandas_sql_server import pandas_server_start, pandas_server_stop
+from .pandas_sql_shard import ShardedPandasSQL
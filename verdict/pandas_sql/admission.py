@@ -0,0 +1,177 @@
+"""Admission control for the Pandas SQL server.
+
+A bounded number of worker threads process the requests. The requests waiting for a worker are
+kept in a bounded queue and dispatched by priority class (see PRIORITY_CLASSES), first-come
+first-served within a class, while no client runs more than a fixed number of requests at once.
+A request is shed (ServerOverloadedError) when the queue is full of requests of the same or
+higher priority, or when it has waited too long; the clients may retry it later.
+"""
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+
+# From the highest to the lowest priority
+PRIORITY_CLASSES = ['interactive', 'stream', 'load']
+
+# The priority class of each request type unless the request specifies one
+DEFAULT_PRIORITIES = {
+    "json-query": 'interactive',
+    "json-query-many": 'interactive',
+    "json-query-stream": 'stream',
+    "load-table": 'load',
+    "drop-table": 'load',
+    "create-cube": 'load',
+    "drop-cube": 'load',
+    "snapshot": 'load',
+}
+
+# The seconds a shed request is suggested to wait before retrying
+DEFAULT_RETRY_AFTER = 0.1
+
+
+class ServerOverloadedError(ValueError):
+    """The server shed the request without processing it; it is safe to retry."""
+
+    def __init__(self, msg, retry_after=DEFAULT_RETRY_AFTER):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+def request_priority(request):
+    """
+    @return  The priority class of the request; None if it is not subject to admission control
+    """
+    if 'priority' in request:
+        priority = request['priority']
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority: {priority}")
+        return priority
+    if request["type"] == "batch":
+        # the highest priority of its items
+        priorities = [request_priority(item) for item in request.get('items', [])]
+        priorities = [p for p in priorities if p is not None]
+        return min(priorities, key=PRIORITY_CLASSES.index, default='interactive')
+    return DEFAULT_PRIORITIES.get(request["type"])
+
+
+class AdmissionController(object):
+    """
+    :param max_workers:  The number of the requests processed at once
+    :param max_queue:  The number of the requests that may wait for a worker
+    :param client_limit:  The number of the requests of a single client processed at once
+    :param max_wait:  The seconds after which a waiting request is shed
+    """
+
+    def __init__(self, max_workers=32, max_queue=256, client_limit=8, max_wait=10.0):
+        assert max_workers > 0 and client_limit > 0 and max_queue >= 0
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.client_limit = client_limit
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._queues = {p: collections.deque() for p in PRIORITY_CLASSES}
+        self._running = collections.Counter()       # client -> the number of its running requests
+        self._threads = []
+        self._shed_count = 0
+
+    def submit(self, fn, priority='interactive', client=None):
+        """Queues fn to run on a worker thread.
+
+        @return  A concurrent.futures.Future of fn's result
+        @raise ServerOverloadedError  If the request is shed right away
+        """
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority: {priority}")
+        future = concurrent.futures.Future()
+        with self._cond:
+            self._start_workers()
+            self._shed_expired()
+            idle_workers = self.max_workers - sum(self._running.values())
+            if self._queued_count() >= self.max_queue + max(idle_workers, 0):
+                victim = self._lowest_queued(priority)
+                if victim is None:
+                    self._shed_count += 1
+                    raise ServerOverloadedError(
+                        f"The server is overloaded ({self.max_queue} requests are waiting).")
+                self._shed(victim, "Displaced by a request of a higher priority.")
+            self._queues[priority].append((time.time(), client, fn, future))
+            self._cond.notify()
+        return future
+
+    def stats(self):
+        with self._cond:
+            return {
+                "workers": self.max_workers,
+                "running": sum(self._running.values()),
+                "queued": {p: len(q) for p, q in self._queues.items()},
+                "shed": self._shed_count,
+            }
+
+    def _start_workers(self):
+        # started lazily so that a pre-forked worker process starts its own threads
+        if len(self._threads) > 0:
+            return
+        for i in range(self.max_workers):
+            thread = threading.Thread(target=self._work, daemon=True,
+                                      name=f'pandas-sql-worker-{i}')
+            thread.start()
+            self._threads.append(thread)
+
+    def _queued_count(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def _lowest_queued(self, priority):
+        """@return  The latest queued item of a lower priority class than the given one"""
+        for lower in reversed(PRIORITY_CLASSES[PRIORITY_CLASSES.index(priority) + 1:]):
+            if len(self._queues[lower]) > 0:
+                return self._queues[lower].pop()
+        return None
+
+    def _shed(self, item, msg):
+        self._shed_count += 1
+        item[3].set_exception(ServerOverloadedError(msg))
+
+    def _shed_expired(self):
+        deadline = time.time() - self.max_wait
+        for queue in self._queues.values():
+            while len(queue) > 0 and queue[0][0] < deadline:
+                self._shed(queue.popleft(), f"Waited for more than {self.max_wait} seconds.")
+
+    def _next(self):
+        """@return  The first queued item of the highest priority whose client is below its limit"""
+        for priority in PRIORITY_CLASSES:
+            queue = self._queues[priority]
+            for i, item in enumerate(queue):
+                if self._running[item[1]] < self.client_limit:
+                    del queue[i]
+                    return item
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._shed_expired()
+                item = self._next()
+                while item is None:
+                    self._cond.wait(self.max_wait)
+                    self._shed_expired()
+                    item = self._next()
+                client = item[1]
+                self._running[client] += 1
+            _, _, fn, future = item
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn())
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._running[client] -= 1
+                    if self._running[client] == 0:
+                        del self._running[client]
+                    # a request of this client may have been skipped
+                    self._cond.notify_all()
@@ -0,0 +1,308 @@
+"""Workload-driven secondary structures for Pandas SQL.
+
+PandasSQL reports the filter columns, join keys, and group-by dimensions it sees (per table) along
+with their observed costs. The advisor periodically picks the most beneficial structures that fit
+in a memory budget, builds them, and drops the ones that are no longer worth their memory.
+
+Structures:
+    ('index', table, column)    A sorted index; used by filters and (inner-side) join keys
+    ('cube', table, dims)       A data cube (see cube.py); used by the group-by aggregations
+"""
+
+import numpy as np
+import pandas as pd
+import threading
+import time
+from verdict.core.relobj import *
+
+
+def comparison_columns(predicate):
+    """Returns (column name, op, value) for every conjunct of the form `attr op constant`."""
+    flipped = {'eq': 'eq', 'gt': 'lt', 'geq': 'leq', 'lt': 'gt', 'leq': 'geq'}
+    if not isinstance(predicate, AttrOp):
+        return []
+    if predicate.op() == 'and':
+        return flatten([comparison_columns(a) for a in predicate.args()])
+    if predicate.op() not in flipped or len(predicate.args()) != 2:
+        return []
+    left, right = predicate.args()
+    if isinstance(left, BaseAttr) and isinstance(right, Constant):
+        return [(left.name(), predicate.op(), right.value())]
+    elif isinstance(left, Constant) and isinstance(right, BaseAttr):
+        return [(right.name(), flipped[predicate.op()], left.value())]
+    else:
+        return []
+
+
+class SortedIndex(object):
+    """The row positions of a table sorted by the values of a column.
+
+    :param series:  The column (pandas Series) without nulls
+    """
+
+    def __init__(self, series):
+        values = series.to_numpy()
+        self._order = np.argsort(values, kind='stable')
+        self._values = values[self._order]
+        self._row_count = len(values)
+
+    @staticmethod
+    def from_arrays(order, values):
+        """Restores an index from its to_arrays() (e.g., memory-mapped from a snapshot)."""
+        index = SortedIndex.__new__(SortedIndex)
+        index._order = order
+        index._values = values
+        index._row_count = len(order)
+        return index
+
+    def to_arrays(self):
+        """@return  (the row positions in the order of the values, the sorted values)"""
+        return self._order, self._values
+
+    def row_count(self):
+        return self._row_count
+
+    def memory_usage(self):
+        return self._order.nbytes + pd.Series(self._values).memory_usage(deep=True)
+
+    def positions(self, op, value):
+        """@return  The (ascending) row positions satisfying `column op value`"""
+        values = self._values
+        if op == 'eq':
+            start = np.searchsorted(values, value, 'left')
+            end = np.searchsorted(values, value, 'right')
+        elif op == 'gt':
+            start, end = np.searchsorted(values, value, 'right'), len(values)
+        elif op == 'geq':
+            start, end = np.searchsorted(values, value, 'left'), len(values)
+        elif op == 'lt':
+            start, end = 0, np.searchsorted(values, value, 'left')
+        elif op == 'leq':
+            start, end = 0, np.searchsorted(values, value, 'right')
+        else:
+            raise ValueError(op)
+        return np.sort(self._order[start:end])
+
+    def positions_in(self, keys):
+        """@return  The (ascending) row positions whose values are in keys"""
+        keys = pd.unique(np.asarray(keys))
+        starts = np.searchsorted(self._values, keys, 'left')
+        ends = np.searchsorted(self._values, keys, 'right')
+        ranges = [self._order[s:e] for s, e in zip(starts, ends) if e > s]
+        if len(ranges) == 0:
+            return np.array([], dtype=self._order.dtype)
+        return np.sort(np.concatenate(ranges))
+
+
+class WorkloadUsage(object):
+    """How often (and at what cost) a set of columns of a table was used in a certain way.
+
+    :param kind:     One of 'predicate', 'join', and 'group'
+    :param table:    A table name
+    :param columns:  A tuple of column names
+    """
+
+    # The score is halved at every advisor round so that the old workload is forgotten.
+    DECAY = 0.5
+
+    def __init__(self, kind, table, columns):
+        self.kind = kind
+        self.table = table
+        self.columns = columns
+        self.count = 0
+        self.score = 0.0
+        self.avg_cost = 0.0
+        self.idle_rounds = 0
+        self._measured = 0
+
+    def structure(self):
+        if self.kind == 'group':
+            return ('cube', self.table, self.columns)
+        else:
+            return ('index', self.table, self.columns[0])
+
+    def record(self, cost):
+        """
+        :param cost:  The elapsed seconds, or None if a structure was used. In the latter case, the
+                      cost without the structure (i.e., the saving) is credited instead.
+        """
+        self.count += 1
+        self.idle_rounds = 0
+        if cost is not None:
+            self._measured += 1
+            self.avg_cost += (cost - self.avg_cost) / self._measured
+        self.score += self.avg_cost
+
+    def decay(self):
+        self.score *= WorkloadUsage.DECAY
+        self.idle_rounds += 1
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'table': self.table,
+            'columns': list(self.columns),
+            'count': self.count,
+            'avg_cost': self.avg_cost,
+            'score': self.score,
+            'idle_rounds': self.idle_rounds,
+        }
+
+
+class IndexAdvisor(object):
+    """Builds and drops the secondary structures of a PandasSQL instance based on its workload.
+
+    :param engine:         PandasSQL
+    :param memory_budget:  The total bytes the advisor's structures may use
+    :param min_count:      A use must be seen this many times before a structure is built for it
+    :param max_idle_rounds:  A use not seen during this many rounds no longer justifies a structure
+    """
+
+    # The number of decisions kept for inspection
+    MAX_DECISIONS = 100
+
+    def __init__(self, engine, memory_budget, min_count=3, max_idle_rounds=3):
+        self._engine = engine
+        self._memory_budget = memory_budget
+        self._min_count = min_count
+        self._max_idle_rounds = max_idle_rounds
+        self._lock = threading.Lock()
+        self._usages = {}           # (kind, table, columns) -> WorkloadUsage
+        self._built = {}            # structure -> bytes
+        self._decisions = []
+        self._stop_event = None
+        self._thread = None
+
+    def record(self, kind, table, columns, cost=None):
+        key = (kind, table, tuple(columns))
+        with self._lock:
+            if key not in self._usages:
+                self._usages[key] = WorkloadUsage(kind, table, tuple(columns))
+            self._usages[key].record(cost)
+
+    def adopt(self, structure, size):
+        """Takes over a structure built elsewhere (e.g., restored from a snapshot), so that it is
+        dropped when no longer beneficial."""
+        with self._lock:
+            self._built[structure] = size
+
+    def built_structures(self):
+        """@return  { structure: bytes } of the structures this advisor has built"""
+        with self._lock:
+            return dict(self._built)
+
+    def table_dropped(self, table):
+        """The structures of the table are gone with it; they are rebuilt at the next round if
+        still beneficial."""
+        with self._lock:
+            for structure in [s for s in self._built if s[1] == table]:
+                del self._built[structure]
+
+    def start(self, interval=10):
+        """Runs advise() every interval seconds in a background thread."""
+        if self._thread is not None:
+            return
+        self._stop_event = threading.Event()
+
+        def run():
+            while not self._stop_event.wait(interval):
+                try:
+                    self.advise()
+                except Exception as e:
+                    self._engine._log(f"The index advisor failed: {e}")
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def advise(self):
+        """Runs one round: picks the structures greedily by score per byte within the budget,
+        drops the built structures that were not picked (e.g., not used recently), and builds the
+        new ones.
+
+        @return  The list of the decisions made in this round
+        """
+        with self._lock:
+            scores = {}
+            for usage in self._usages.values():
+                if usage.count < self._min_count or usage.idle_rounds >= self._max_idle_rounds:
+                    continue
+                structure = usage.structure()
+                scores[structure] = scores.get(structure, 0.0) + usage.score
+            for usage in self._usages.values():
+                usage.decay()
+            built = dict(self._built)
+
+        candidates = []
+        for structure, score in scores.items():
+            if score <= 0:
+                continue
+            size = built.get(structure) or self._engine._estimate_structure_size(structure)
+            if size is None:
+                continue
+            candidates.append((score / max(size, 1), score, size, structure))
+        candidates.sort(key=lambda c: c[0], reverse=True)
+
+        chosen = {}
+        remaining = self._memory_budget
+        for _, score, size, structure in candidates:
+            if size <= remaining:
+                chosen[structure] = score
+                remaining -= size
+
+        decisions = []
+        for structure in built:
+            if structure not in chosen:
+                self._engine._drop_structure(structure)
+                decisions.append(self._decision('drop', structure, scores.get(structure, 0.0),
+                                                built[structure]))
+        for structure, score in chosen.items():
+            if structure in built:
+                continue
+            size = self._engine._build_structure(structure)
+            if size is None:
+                continue
+            built[structure] = size
+            decisions.append(self._decision('build', structure, score, size))
+
+        with self._lock:
+            self._built = {s: b for s, b in built.items() if s in chosen}
+            self._decisions.extend(decisions)
+            self._decisions = self._decisions[-IndexAdvisor.MAX_DECISIONS:]
+        return decisions
+
+    def _decision(self, action, structure, score, size):
+        kind, table, columns = structure
+        self._engine._log(f"The index advisor decided to {action} the {kind} of {table} over "
+                          f"{columns} (score: {score:.6f}, {size} bytes).")
+        return {
+            'time': time.time(),
+            'action': action,
+            'structure': kind,
+            'table': table,
+            'columns': list(columns) if isinstance(columns, tuple) else [columns],
+            'score': score,
+            'bytes': size,
+        }
+
+    def report(self):
+        """@return  A dict describing the recorded workload, the built structures, and the recent
+                    decisions"""
+        with self._lock:
+            return {
+                'memory_budget': self._memory_budget,
+                'workload': [u.to_dict() for u in self._usages.values()],
+                'structures': [{
+                    'structure': kind,
+                    'table': table,
+                    'columns': list(columns) if isinstance(columns, tuple) else [columns],
+                    'bytes': size,
+                    } for (kind, table, columns), size in self._built.items()],
+                'decisions': list(self._decisions),
+            }
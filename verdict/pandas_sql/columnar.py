@@ -0,0 +1,418 @@
+"""A columnar on-disk format for the Pandas SQL tables.
+
+A table is a directory with a manifest and one file per column:
+
+    manifest.json       { "format": "verdict-columnar", "version": 3, "row_count": int,
+                          "columns_dtype": str,
+                          "columns": [ { "name": str, "encoding": str, "files": [str, ...],
+                                         "compression": str or null, "dtype": str }, ...] }
+    <i>.npy             The values of the i-th column (encoding "plain")
+    <i>.codes.npy       The dictionary codes of the i-th column (encoding "dictionary"; -1 is null)
+    <i>.offsets.npy     The end offsets of the dictionary entries in <i>.dict (encoding
+                        "dictionary")
+    <i>.dict            The dictionary entries of the i-th column, concatenated in UTF-8 (encoding
+                        "dictionary"; a single <i>.dict.npy of fixed-width strings in version 2)
+    <i>.pkl             The pickled values of the i-th column (encoding "pickle")
+
+The dtypes of the columns (e.g., the nullable "Int64" or "string") and of the column names are
+restored from "dtype" and "columns_dtype" when read; see columns_frame().
+
+A table written by write_table_file() is a symbolic link to such a directory, so that a new
+version replaces it atomically (see install_columnar()). A replaced version is removed once no
+reader holds it (see hold_table_dir()).
+
+The "plain" columns (numbers, booleans, and timestamps) are memory-mapped read-only when read, so
+the processes reading the same table share its memory through the OS page cache. The string
+columns are dictionary-encoded; they are decoded into the memory of each reader.
+
+If a compression codec is given when writing, every column is compressed on its own (its files
+get the codec as another suffix, e.g., "0.npy.lz4") if that pays off. A compressed column is
+decompressed into the memory of each reader instead of being mapped, so a plain column is only
+compressed if it shrinks to half or less; the other columns are decoded anyway.
+"""
+
+import fcntl
+import io
+import json
+import numpy as np
+import os
+import pandas as pd
+import pickle
+import re
+import shutil
+import uuid
+from .protocol import compress, decompress
+
+
+MANIFEST_FILE = 'manifest.json'
+
+FORMAT_NAME = 'verdict-columnar'
+
+FORMAT_VERSION = 3
+
+# A compressed plain column must be at most this fraction of its raw size (see above)
+PLAIN_COMPRESSION_RATIO = 0.5
+
+
+def is_columnar(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_FILE))
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE), 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('format') != FORMAT_NAME:
+        raise ValueError(f"Not a columnar table: {path}")
+    if manifest.get('version', 1) > FORMAT_VERSION:
+        raise ValueError(f"Unsupported version of the columnar format: {manifest['version']}")
+    return manifest
+
+
+def _npy_bytes(array):
+    buf = io.BytesIO()
+    np.save(buf, array)
+    return buf.getvalue()
+
+
+def _encode_column(series, i):
+    """@return  (encoding, { file name: array or bytes })"""
+    # the extension dtypes (e.g., "Int64") have no numpy array of the same values
+    if isinstance(series.dtype, np.dtype) and (pd.api.types.is_bool_dtype(series) or
+            pd.api.types.is_numeric_dtype(series) or pd.api.types.is_datetime64_dtype(series)):
+        return 'plain', { f'{i}.npy': series.to_numpy() }
+    elif series.map(lambda v: isinstance(v, str) or v is None or v is pd.NA or v != v).all():
+        # strings with nulls (None, NaN, or NA)
+        codes, uniques = pd.factorize(series)
+        encoded = [s.encode('utf-8', 'surrogatepass') for s in uniques]
+        return 'dictionary', { f'{i}.codes.npy': codes.astype(np.int32),
+                               f'{i}.offsets.npy': np.cumsum([len(e) for e in encoded],
+                                                             dtype=np.int64),
+                               f'{i}.dict': b''.join(encoded) }
+    else:
+        return 'pickle', { f'{i}.pkl': pickle.dumps(series.to_numpy()) }
+
+
+def _decode_dictionary(offsets, content):
+    """@return  An object array of the dictionary entries (see _encode_column())"""
+    starts = np.concatenate([[0], offsets[:-1]]) if len(offsets) > 0 else offsets
+    dictionary = np.empty(len(offsets), dtype=object)
+    for j, (start, end) in enumerate(zip(starts, offsets)):
+        dictionary[j] = content[start:end].decode('utf-8', 'surrogatepass')
+    return dictionary
+
+
+def _restore_dtype(values, dtype):
+    """Converts the values read into the recorded dtype (a str) if they differ.
+
+    @return  A numpy array or a pandas ExtensionArray
+    """
+    if dtype is None or str(values.dtype) == dtype:
+        return values
+    try:
+        target = pd.api.types.pandas_dtype(dtype)
+    except TypeError:
+        # a dtype this version of pandas does not know (e.g., "str" before pandas 3)
+        return values
+    if isinstance(target, np.dtype) and target.kind in 'US':
+        return values
+    return pd.array(values, dtype=target) if not isinstance(target, np.dtype) else \
+                values.astype(target)
+
+
+def write_columnar(df, path, compression=None):
+    """Writes the DataFrame (its index is not kept) into the directory, which must not exist.
+
+    @param compression  "lz4", "zstd", or None; see above
+    @return  The manifest
+    """
+    os.makedirs(path)
+    columns = []
+    for i, name in enumerate(df.columns):
+        encoding, contents = _encode_column(df[name], i)
+        codec = None
+        if compression is not None:
+            raw = {f: c if isinstance(c, bytes) else _npy_bytes(c) for f, c in contents.items()}
+            compressed = {f: compress(c, compression) for f, c in raw.items()}
+            raw_size = sum(len(c) for c in raw.values())
+            compressed_size = sum(len(c) for c in compressed.values())
+            max_size = raw_size * PLAIN_COMPRESSION_RATIO if encoding == 'plain' else raw_size
+            if compressed_size <= max_size:
+                codec = compression
+                contents = {f'{f}.{codec}': c for f, c in compressed.items()}
+        for file_name, content in contents.items():
+            if isinstance(content, bytes):
+                with open(os.path.join(path, file_name), 'wb') as f:
+                    f.write(content)
+            else:
+                np.save(os.path.join(path, file_name), content)
+        columns.append({ 'name': name, 'encoding': encoding, 'files': list(contents),
+                         'compression': codec, 'dtype': str(df[name].dtype) })
+
+    manifest = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'row_count': len(df.index),
+        'columns_dtype': str(df.columns.dtype),
+        'columns': columns,
+    }
+    # The manifest is written last; a directory without it is incomplete.
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def read_column(path, column, mmap=True, rows=None):
+    """
+    @param column  An entry of the manifest's columns
+    @param rows  The rows to read (a slice or an array of the row positions); None for all. Of a
+                 mapped column, only the pages of these rows are read.
+    @return  A numpy array, or a pandas ExtensionArray for an extension dtype
+    """
+    if rows is None:
+        rows = slice(None)
+    files = [os.path.join(path, f) for f in column['files']]
+    encoding = column['encoding']
+    codec = column.get('compression')
+    if codec is not None:
+        def content(i):
+            with open(files[i], 'rb') as f:
+                return decompress(f.read(), codec)
+
+        def load(i):
+            return np.load(io.BytesIO(content(i)))
+    else:
+        def content(i):
+            with open(files[i], 'rb') as f:
+                return f.read()
+
+        def load(i):
+            return np.load(files[i], mmap_mode='r' if mmap else None)
+
+    if encoding == 'plain':
+        # an ndarray viewing the mapping; the selected rows of a np.memmap are a np.memmap too
+        values = np.asarray(load(0)[rows])
+        if codec is not None and isinstance(rows, slice):
+            # not a view keeping the whole decompressed column
+            values = values.copy()
+    elif encoding == 'dictionary':
+        codes = load(0)[rows]
+        if len(files) == 2:
+            # version 2
+            dictionary = load(1).astype(object)
+        else:
+            dictionary = _decode_dictionary(load(1), content(2))
+        values = dictionary[np.maximum(codes, 0)] if len(dictionary) > 0 else \
+                    np.empty(len(codes), dtype=object)
+        values[codes < 0] = None
+    elif encoding == 'pickle':
+        values = pickle.loads(content(0))[rows]
+    else:
+        raise ValueError(f"Unknown encoding: {encoding}")
+    return _restore_dtype(values, column.get('dtype'))
+
+
+def read_columnar(path, columns=None, mmap=True, rows=None):
+    """Reads the table without copying its plain columns (if mmap is True).
+
+    @param columns  The names of the columns to read; None for all
+    @param rows  The rows to read (see read_column()); None for all
+    @return  A pandas DataFrame
+    """
+    manifest = read_manifest(path)
+    selected = manifest['columns'] if columns is None else \
+                    [c for c in manifest['columns'] if c['name'] in columns]
+    data = {c['name']: read_column(path, c, mmap, rows) for c in selected}
+    return columns_frame(data, [c['name'] for c in selected],
+                         columns_dtype=manifest.get('columns_dtype'))
+
+
+def columns_frame(data, names, index=None, columns_dtype=None):
+    """Builds a DataFrame of the columns read (see read_column()) without copying them.
+
+    A DataFrame built from a dict infers the dtypes again; e.g., pandas 3 turns an object column
+    of strings, and a list of string names, into the "str" dtype. Every column keeps its dtype
+    here, and the column names get the recorded one.
+
+    @param data  Column name -> a numpy array, a pandas ExtensionArray, or a Series on the index
+    @param names  The column names, in order
+    @param columns_dtype  The recorded dtype of the column names (the manifest's "columns_dtype")
+    """
+    series = {}
+    for name in names:
+        values = data[name]
+        if not isinstance(values, pd.Series):
+            values = pd.Series(values, index=index, dtype=values.dtype, copy=False)
+        series[name] = values
+    df = pd.DataFrame(series, index=index, copy=False)
+    df.columns = pd.Index(_restore_dtype(pd.Index(list(names)), columns_dtype))
+    return df
+
+
+def read_table_file(path, mmap=True):
+    """Reads a table from either a columnar directory or a pickled DataFrame file."""
+    if is_columnar(path):
+        return read_columnar(path, mmap=mmap)
+    with open(path, 'rb') as f:
+        df = pickle.load(f)
+    assert isinstance(df, pd.core.frame.DataFrame)
+    return df
+
+
+def _hidden_path(path, kind):
+    """A new path next to the given one. Its name starts with a dot, so that the listings of the
+    table files skip it.
+    """
+    parent, name = os.path.split(os.path.abspath(path))
+    return os.path.join(parent, f".{name}.{kind}-{uuid.uuid4().hex[:8]}")
+
+
+def _version_name(path):
+    """@return  The name of the versioned directory the path links to (see install_columnar());
+    None if the path is not a link."""
+    if not os.path.islink(path):
+        return None
+    return os.readlink(path)
+
+
+def _lock_dir(path, operation):
+    """@return  The fd of the directory, locked; the lock is released when the fd is closed"""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        fcntl.flock(fd, operation)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def hold_table_dir(path):
+    """Takes a shared lock on the directory of a table (the version it links to, if path is a
+    link), so that the directory is not removed while a reader may still read its files. The
+    lock is released by closing the returned fd; see remove_retired_versions().
+
+    @return  (the directory, its fd)
+    """
+    for _ in range(10):
+        dir_path = os.path.realpath(path)
+        try:
+            fd = _lock_dir(dir_path, fcntl.LOCK_SH)
+        except FileNotFoundError:
+            continue
+        if os.path.exists(os.path.join(dir_path, MANIFEST_FILE)):
+            return dir_path, fd
+        # removed before the lock; path links to a newer version now
+        os.close(fd)
+    raise FileNotFoundError(f"No columnar table in {path}")
+
+
+def release_table_dir(path, fd):
+    """Releases a directory held by hold_table_dir(), and removes it if it has been replaced and
+    no other reader holds it.
+
+    @param path  The path given to hold_table_dir()
+    """
+    os.close(fd)
+    remove_retired_versions(path)
+
+
+def remove_unheld_dir(dir_path, in_use=None):
+    """Removes a table directory unless a reader holds it (see hold_table_dir()); then, its last
+    reader is expected to call this again.
+
+    @param in_use  If not None, a function telling (while no reader can take the directory) that
+                   the directory is in use again; then, it is kept.
+    @return  True if removed
+    """
+    try:
+        fd = _lock_dir(dir_path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (FileNotFoundError, BlockingIOError):
+        return False
+    try:
+        if in_use is not None and in_use():
+            return False
+        shutil.rmtree(dir_path, ignore_errors=True)
+        return True
+    finally:
+        os.close(fd)
+
+
+def remove_retired_versions(path):
+    """Removes the versioned directories of the table at path (see install_columnar()) that are
+    neither current nor held by a reader."""
+    parent, name = os.path.split(os.path.abspath(path))
+    pattern = re.compile(rf"\.{re.escape(name)}\.(v|old)-[0-9a-f]{{8}}")
+    current = _version_name(path)
+    for entry in os.listdir(parent):
+        if entry != current and pattern.fullmatch(entry):
+            # a new version is held by its writer until the link is swapped (see
+            # install_columnar()); checked again in case the link was swapped back meanwhile
+            remove_unheld_dir(os.path.join(parent, entry),
+                              lambda: _version_name(path) == entry)
+
+
+def install_columnar(temp_path, path):
+    """Moves a table written into temp_path into place, replacing the table file (either a
+    columnar directory or a pickled DataFrame) at path.
+
+    The table is moved into a versioned directory next to path, and path becomes a symbolic link
+    to it. The link is swapped by a single rename, so a reader finds either the old table or the
+    new one, never nothing. The old version is removed unless a reader holds it (see
+    hold_table_dir()); then, its last reader removes it.
+    """
+    version_path = _hidden_path(path, 'v')
+    # held so that no one removes it before it becomes current
+    fd = _lock_dir(temp_path, fcntl.LOCK_SH)
+    try:
+        os.rename(temp_path, version_path)
+        link_path = _hidden_path(path, 'link')
+        os.symlink(os.path.basename(version_path), link_path)
+        if _version_name(path) is None and os.path.isdir(path):
+            # a directory (written before the links) cannot be replaced by a rename; moved aside
+            # once
+            os.rename(path, _hidden_path(path, 'old'))
+        os.replace(link_path, path)
+    finally:
+        os.close(fd)
+    remove_retired_versions(path)
+
+
+def remove_table_file(path):
+    """Removes a table file (either a columnar directory, possibly linked, or a pickled
+    DataFrame); an absent one is ignored. A version held by a reader is removed by its last
+    reader."""
+    if os.path.islink(path):
+        os.remove(path)
+        remove_retired_versions(path)
+    elif os.path.isdir(path):
+        os.rename(path, _hidden_path(path, 'old'))
+        remove_retired_versions(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def write_table_file(df, path, compression=None):
+    """Writes the table in the columnar format aside and moves it into place, so that a reader
+    never sees a partial table.
+
+    @return  The manifest
+    """
+    temp_path = _hidden_path(path, 'tmp')
+    try:
+        manifest = write_columnar(df, temp_path, compression)
+        install_columnar(temp_path, path)
+    except BaseException:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+    return manifest
+
+
+def migrate_table_file(path, compression=None):
+    """Converts a pickled DataFrame file into a columnar directory in place; a columnar table is
+    left as it is.
+
+    @return  True if the file has been converted
+    """
+    if is_columnar(path):
+        return False
+    write_table_file(read_table_file(path), path, compression)
+    return True
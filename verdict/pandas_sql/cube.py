@@ -0,0 +1,167 @@
+"""Pre-aggregated data cubes over Pandas SQL tables.
+
+A cube stores, for every combination of its dimension values, the row count and the sums (and the
+non-null counts) of the numeric columns. A group-by query whose groups and filters only reference
+the dimensions can be answered from the cube instead of scanning the table.
+"""
+
+import pandas as pd
+from verdict.core.relobj import *
+
+
+COUNT_COL = '_count'
+
+
+def sum_col(name):
+    return f'_sum_{name}'
+
+
+def count_col(name):
+    return f'_count_{name}'
+
+
+class CubePattern(object):
+    """The shape of a query that may be answered using a cube.
+
+    :param table_name:  The name of the table the query reads
+    :param groups:      A list of group column names
+    :param predicate:   The filter (AttrOp), or None
+    :param aggs:        A list of (agg_type, column name or None, alias)
+    """
+
+    def __init__(self, table_name, groups, predicate, aggs):
+        self.table_name = table_name
+        self.groups = groups
+        self.predicate = predicate
+        self.aggs = aggs
+
+        def attr_names(attr):
+            if isinstance(attr, BaseAttr):
+                return [attr.name()]
+            elif isinstance(attr, AttrOp):
+                return flatten([attr_names(a) for a in attr.args()])
+            else:
+                return []
+
+        filter_cols = [] if predicate is None else attr_names(predicate)
+        self.dims = frozenset(groups + filter_cols)
+        self.measures = frozenset([a[1] for a in aggs if a[1] is not None])
+
+
+def find_cube_pattern(query_obj):
+    """Returns the CubePattern of the query if the query is in the following form; otherwise, None.
+
+    agg(groupby(select(table)))     where groupby() and select() are optional and the arguments of
+                                    the aggregate functions are base attributes.
+    """
+    if not isinstance(query_obj, DerivedTable) or not query_obj.is_agg():
+        return None
+
+    source = query_obj.source()
+    groups = []
+    if isinstance(source, DerivedTable) and source.is_groupby():
+        groups = [a.name() for a in source.relop_args()]
+        source = source.source()
+    predicate = None
+    if isinstance(source, DerivedTable) and source.is_select():
+        predicate = source.relop_args()[0]
+        source = source.source()
+    if not isinstance(source, (BaseTable, SampleTable)):
+        return None
+
+    aggs = []
+    for agg_func, alias in query_obj.relop_args():
+        args = agg_func.args()
+        if len(args) == 0:
+            aggs.append((agg_func.op(), None, alias))
+        elif isinstance(args[0], BaseAttr):
+            aggs.append((agg_func.op(), args[0].name(), alias))
+        else:
+            return None
+
+    pattern = CubePattern(source.name(), groups, predicate, aggs)
+    if len(pattern.dims & pattern.measures) > 0:
+        return None
+    return pattern
+
+
+class DataCube(object):
+    """Sums and counts of a table per dimension combination.
+
+    :param df:    The table (pandas DataFrame)
+    :param dims:  The dimension column names
+    """
+
+    def __init__(self, df, dims):
+        dims = list(dims)
+        self.dims = frozenset(dims)
+        measures = [c for c in df.columns if c not in self.dims and
+                        pd.api.types.is_numeric_dtype(df[c])]
+        self.measures = frozenset(measures)
+
+        grouped = df.groupby(dims)
+        cube = grouped.size().to_frame(COUNT_COL)
+        for c in measures:
+            cube[sum_col(c)] = grouped[c].sum()
+            cube[count_col(c)] = grouped[c].count()
+        self._frame = cube.reset_index()
+
+    @staticmethod
+    def from_frame(frame, dims, measures):
+        """Restores a cube from its to_frame() (e.g., memory-mapped from a snapshot)."""
+        cube = DataCube.__new__(DataCube)
+        cube.dims = frozenset(dims)
+        cube.measures = frozenset(measures)
+        cube._frame = frame
+        return cube
+
+    def to_frame(self):
+        """@return  The dimension columns, COUNT_COL, and the sums and counts of the measures"""
+        return self._frame
+
+    def row_count(self):
+        return len(self._frame.index)
+
+    def memory_usage(self):
+        return int(self._frame.memory_usage(deep=True).sum())
+
+    def covers(self, pattern):
+        return pattern.dims <= self.dims and pattern.measures <= self.measures
+
+    def answer(self, pattern, evaluate):
+        """Computes the query result in the same form as PandasSQL does.
+
+        :param pattern:   The CubePattern of the query
+        :param evaluate:  A function that evaluates a predicate over a DataFrame
+        """
+        cube = self._frame
+        if pattern.predicate is not None:
+            cube = cube[evaluate(pattern.predicate, cube)]
+        if len(pattern.groups) > 0:
+            source = cube.groupby(pattern.groups)
+        else:
+            source = cube
+
+        def total(col):
+            if len(pattern.groups) > 0:
+                return source[col].sum()
+            else:
+                return pd.Series(source[col].sum())
+
+        agg_results = []
+        for agg_type, col, alias in pattern.aggs:
+            if agg_type == 'count':
+                agg_results.append(total(COUNT_COL if col is None else count_col(col)))
+            elif agg_type == 'sum':
+                agg_results.append(total(sum_col(col)))
+            elif agg_type == 'avg':
+                agg_results.append(total(sum_col(col)) / total(count_col(col)))
+            else:
+                raise NotImplementedError(agg_type)
+
+        df = pd.concat([r.to_frame() for r in agg_results], axis=1)
+        df.columns = [a[2] for a in pattern.aggs]
+        if len(pattern.groups) > 0:
+            return df.reset_index()
+        else:
+            return df
@@ -0,0 +1,104 @@
+"""The tables whose columns are read from their columnar directories (see columnar.py) only when
+a query first references them.
+
+A lazily loaded table is registered with its schema and row count only. Before a query runs, the
+columns it references are read into the table (the plain columns are mapped, not copied), and
+the columns no query has used for a while can be dropped again (see
+PandasSQL.evict_cold_columns()). The table holds the version of its directory until it is
+dropped, so that replacing the table file does not remove the columns it has yet to read.
+"""
+
+import os
+import threading
+import time
+import weakref
+from .columnar import (MANIFEST_FILE, columns_frame, hold_table_dir, read_column,
+                       read_manifest, release_table_dir)
+
+
+def referenced_columns(query):
+    """Finds the columns a query (in the verdict query format) may read.
+
+    @return  (the referenced column names, True if the query returns the rows of a table as they
+             are, i.e., needs all of its columns)
+    """
+    names = set()
+
+    def collect(element):
+        if isinstance(element, str):
+            if element.startswith('attr '):
+                names.add(element[5:])
+        elif isinstance(element, dict):
+            for value in element.values():
+                collect(value)
+        elif isinstance(element, (list, tuple)):
+            for value in element:
+                collect(value)
+
+    def returns_rows(element):
+        # the columns of the output are only the computed ones under a project or an agg
+        if isinstance(element, str):
+            return True
+        if not isinstance(element, dict) or element.get('op') in ('project', 'agg'):
+            return False
+        if element.get('op') == 'join' and returns_rows(element['arg'].get('join_to')):
+            return True
+        return returns_rows(element.get('source'))
+
+    collect(query)
+    return names, returns_rows(query)
+
+
+class LazyColumns(object):
+    """The columns of a lazily loaded table.
+
+    :param path:  The columnar directory of the table
+    """
+
+    def __init__(self, path):
+        # the versioned directory if path is a link (see columnar.install_columnar()); held until
+        # this is collected
+        self.path, fd = hold_table_dir(path)
+        self._release = weakref.finalize(self, _release_dir, path, fd)
+        # a directory written before the links is replaced in place; its new manifest tells
+        self._manifest_inode = os.stat(os.path.join(self.path, MANIFEST_FILE)).st_ino
+        manifest = read_manifest(self.path)
+        self._entries = {c['name']: c for c in manifest['columns']}
+        self.schema = [c['name'] for c in manifest['columns']]
+        self.row_count = manifest['row_count']
+        self.columns_dtype = manifest.get('columns_dtype')
+        # Serializes reading and evicting the columns of the table
+        self.lock = threading.Lock()
+        # column name -> the last time a query referenced it
+        self._last_used = {}
+
+    def read(self, name):
+        try:
+            if os.stat(os.path.join(self.path, MANIFEST_FILE)).st_ino != self._manifest_inode:
+                raise FileNotFoundError(self.path)
+            return read_column(self.path, self._entries[name])
+        except FileNotFoundError:
+            raise ValueError(f"The table in {self.path} has been replaced.")
+
+    def frame(self, data, index):
+        """@return  A DataFrame of the columns in data, in the order of the schema"""
+        names = [c for c in self.schema if c in data]
+        return columns_frame(data, names, index, self.columns_dtype)
+
+    def touch(self, names):
+        now = time.time()
+        for name in names:
+            self._last_used[name] = now
+
+    def cold_columns(self, idle_seconds):
+        """@return  The columns not referenced for idle_seconds"""
+        deadline = time.time() - idle_seconds
+        return [c for c in self.schema if self._last_used.get(c, 0) < deadline]
+
+
+def _release_dir(path, fd):
+    try:
+        release_table_dir(path, fd)
+    except OSError:
+        # e.g., the parent directory is gone; the lock is released with the fd regardless
+        pass
@@ -0,0 +1,414 @@
+"""A load generator for the Pandas SQL server.
+
+    pandas-sql-loadtest --concurrency 16 --rate 200 --duration 60
+
+Starts a server (or attaches to a running one with --server) on generated TPC-H-like tables,
+replays a mix of queries, and reports the latency percentiles, the throughput, and the server's
+memory over time.
+
+The default mix (loadtest_queries.json, shipped with the package) has the TPC-H queries in the
+format of the Pandas SQL server, written against the premerged (i.e., denormalized) tables,
+lineitem_premerged and orders_premerged. Another mix is a JSON file of the same form, given by
+--queries.
+"""
+
+import argparse
+import collections
+import json
+import numpy as np
+import os
+import pandas as pd
+import psutil
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from .admission import ServerOverloadedError
+from .pandas_sql_client import PandasSQLClient
+from .pandas_sql_server import PANDAS_SQL_DEFAULT_PORT
+
+
+DEFAULT_QUERY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'loadtest_queries.json')
+
+PERCENTILES = [50, 95, 99]
+
+NATIONS = [
+    ('ALGERIA', 'AFRICA'), ('ARGENTINA', 'AMERICA'), ('BRAZIL', 'AMERICA'),
+    ('CANADA', 'AMERICA'), ('EGYPT', 'MIDDLE EAST'), ('ETHIOPIA', 'AFRICA'),
+    ('FRANCE', 'EUROPE'), ('GERMANY', 'EUROPE'), ('INDIA', 'ASIA'), ('INDONESIA', 'ASIA'),
+    ('IRAN', 'MIDDLE EAST'), ('IRAQ', 'MIDDLE EAST'), ('JAPAN', 'ASIA'), ('JORDAN', 'MIDDLE EAST'),
+    ('KENYA', 'AFRICA'), ('MOROCCO', 'AFRICA'), ('MOZAMBIQUE', 'AFRICA'), ('PERU', 'AMERICA'),
+    ('CHINA', 'ASIA'), ('ROMANIA', 'EUROPE'), ('SAUDI ARABIA', 'MIDDLE EAST'),
+    ('VIETNAM', 'ASIA'), ('RUSSIA', 'EUROPE'), ('UNITED KINGDOM', 'EUROPE'),
+    ('UNITED STATES', 'AMERICA'),
+]
+
+SEGMENTS = ['AUTOMOBILE', 'BUILDING', 'FURNITURE', 'MACHINERY', 'HOUSEHOLD']
+
+PRIORITIES = ['1-URGENT', '2-HIGH', '3-MEDIUM', '4-NOT SPECIFIED', '5-LOW']
+
+TYPE_WORDS = [
+    ['STANDARD', 'SMALL', 'MEDIUM', 'LARGE', 'ECONOMY', 'PROMO'],
+    ['ANODIZED', 'BURNISHED', 'PLATED', 'POLISHED', 'BRUSHED'],
+    ['TIN', 'NICKEL', 'BRASS', 'STEEL', 'COPPER'],
+]
+
+NAME_WORDS = ['almond', 'azure', 'blush', 'chiffon', 'coral', 'cornsilk', 'forest', 'ivory',
+              'lavender', 'lime', 'navy', 'orchid', 'peach', 'plum', 'rose', 'salmon', 'tan']
+
+
+def generate_tables(data_dir, rows=100000, seed=0):
+    """Writes the premerged TPC-H-like tables (pickled DataFrames) into data_dir.
+
+    @param rows  The number of the rows of lineitem_premerged; orders_premerged has a quarter
+    @return  { table name: file path }
+    """
+    rng = np.random.RandomState(seed)
+    order_count = max(rows // 4, 1)
+    nation_ids = rng.randint(len(NATIONS), size=order_count)
+    order_dates = pd.Timestamp('1992-01-01') + pd.to_timedelta(rng.randint(2405, size=order_count),
+                                                               unit='D')
+    custkeys = rng.randint(1, max(order_count // 10, 1) + 1, size=order_count)
+    orders = pd.DataFrame({
+        'o_orderkey': np.arange(1, order_count + 1),
+        'o_custkey': custkeys,
+        'o_orderdate': order_dates,
+        'o_orderpriority': np.array(PRIORITIES)[rng.randint(len(PRIORITIES), size=order_count)],
+        'o_shippriority': np.zeros(order_count, dtype=np.int64),
+        'c_name': [f'Customer#{k:09d}' for k in custkeys],
+        'c_mktsegment': np.array(SEGMENTS)[rng.randint(len(SEGMENTS), size=order_count)],
+        'n_name': np.array([n for n, _ in NATIONS])[nation_ids],
+        'r_name': np.array([r for _, r in NATIONS])[nation_ids],
+    })
+
+    order_index = np.sort(rng.randint(order_count, size=rows))
+    ship_dates = order_dates[order_index] + pd.to_timedelta(rng.randint(1, 122, size=rows),
+                                                            unit='D')
+    commit_dates = order_dates[order_index] + pd.to_timedelta(rng.randint(30, 91, size=rows),
+                                                              unit='D')
+    receipt_dates = ship_dates + pd.to_timedelta(rng.randint(1, 31, size=rows), unit='D')
+    quantity = rng.randint(1, 51, size=rows).astype(np.float64)
+    cutoff = pd.Timestamp('1995-06-17')
+    returned = np.where(rng.rand(rows) < 0.5, 'R', 'A')
+    lineitem = pd.DataFrame({
+        'l_orderkey': orders['o_orderkey'].values[order_index],
+        'l_quantity': quantity,
+        'l_extendedprice': quantity * rng.uniform(900.0, 2000.0, size=rows).round(2),
+        'l_discount': rng.randint(0, 11, size=rows) / 100.0,
+        'l_tax': rng.randint(0, 9, size=rows) / 100.0,
+        'l_returnflag': np.where(receipt_dates <= cutoff, returned, 'N'),
+        'l_linestatus': np.where(ship_dates > cutoff, 'O', 'F'),
+        'l_shipdate': ship_dates,
+        'l_commitdate': commit_dates,
+        'l_receiptdate': receipt_dates,
+        'p_name': [' '.join(words) for words in
+                   np.array(NAME_WORDS)[rng.randint(len(NAME_WORDS), size=(rows, 3))]],
+        'p_type': [' '.join(words) for words in
+                   zip(*[np.array(w)[rng.randint(len(w), size=rows)] for w in TYPE_WORDS])],
+        'ps_supplycost': rng.uniform(1.0, 1000.0, size=rows).round(2),
+        'n_name': np.array([n for n, _ in NATIONS])[rng.randint(len(NATIONS), size=rows)],
+    })
+
+    os.makedirs(data_dir, exist_ok=True)
+    paths = {}
+    for name, df in [('lineitem_premerged', lineitem), ('orders_premerged', orders)]:
+        paths[name] = os.path.join(data_dir, name)
+        df.to_pickle(paths[name])
+    return paths
+
+
+def load_queries(path=DEFAULT_QUERY_FILE):
+    """Reads a query mix: a JSON object of { name: a query for the Pandas SQL server }."""
+    with open(path) as f:
+        queries = json.load(f)
+    if not isinstance(queries, dict) or \
+            not all(isinstance(q, dict) for q in queries.values()):
+        raise ValueError(f"Not a query mix (a JSON object of queries): {path}")
+    return queries
+
+
+def parse_mix(mix, names):
+    """
+    @param mix  e.g., "q1=3,q6=1"; None for the same weight for all the queries
+    @return  { query name: weight }
+    """
+    if mix is None:
+        return {name: 1.0 for name in names}
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in names:
+            raise ValueError(f"Unknown query in the mix: {name}")
+        weights[name] = float(weight) if weight != '' else 1.0
+    return weights
+
+
+def percentiles(latencies):
+    if len(latencies) == 0:
+        return {f"p{p}": None for p in PERCENTILES}
+    values = np.percentile(latencies, PERCENTILES)
+    return {f"p{p}": float(v) for p, v in zip(PERCENTILES, values)}
+
+
+class LoadGenerator(object):
+    """
+    :param client:  A PandasSQLClient (shared by the threads)
+    :param queries:  { name: query }
+    :param weights:  { name: weight }; the queries are drawn at random in these proportions
+    :param concurrency:  The number of the requests in flight at most
+    :param rate:  The requests per second. If None, each thread sends the next request as soon as
+                  it gets a response (a closed loop). Otherwise, the requests are scheduled at
+                  this rate, and a latency includes the time a request waited for a free thread.
+    :param memory_interval:  The seconds between the samples of the server's memory
+    """
+
+    def __init__(self, client, queries, weights=None, concurrency=8, rate=None, duration=30.0,
+                 memory_interval=1.0, seed=0):
+        assert concurrency > 0 and duration > 0
+        self._client = client
+        self._queries = queries
+        self._weights = weights if weights is not None else {n: 1.0 for n in queries}
+        self._concurrency = concurrency
+        self._rate = rate
+        self._duration = duration
+        self._memory_interval = memory_interval
+        self._seed = seed
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._samples = []      # (query name, latency, error type or None)
+        self._memory = []       # (elapsed seconds, resident memory, requests in flight)
+
+    def run(self):
+        """@return  The report (see report())"""
+        self._start_time = time.time()
+        self._end_time = self._start_time + self._duration
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample_memory, args=(stop,), daemon=True)
+        sampler.start()
+        threads = [threading.Thread(target=self._work, args=(i,), daemon=True)
+                   for i in range(self._concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._elapsed = time.time() - self._start_time
+        stop.set()
+        sampler.join()
+        return self.report()
+
+    def _next_schedule(self):
+        """@return  The time to send the next request; None when the run is over"""
+        with self._lock:
+            if self._rate is None:
+                now = time.time()
+                return now if now < self._end_time else None
+            scheduled = self._start_time + self._sent / self._rate
+            if scheduled >= self._end_time:
+                return None
+            self._sent += 1
+            return scheduled
+
+    def _work(self, index):
+        rng = random.Random(self._seed + index)
+        names = list(self._weights)
+        weights = [self._weights[n] for n in names]
+        while True:
+            scheduled = self._next_schedule()
+            if scheduled is None:
+                return
+            wait = scheduled - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            name = rng.choices(names, weights)[0]
+            error = None
+            try:
+                self._client.execute(self._queries[name])
+            except ServerOverloadedError:
+                error = 'overloaded'
+            except Exception as e:
+                error = type(e).__name__
+            with self._lock:
+                self._samples.append((name, time.time() - scheduled, error))
+
+    def _sample_memory(self, stop):
+        while True:
+            try:
+                stats = self._client.stats()
+                self._memory.append((time.time() - self._start_time,
+                                     stats["resident-memory"], stats["in-flight"]))
+            except Exception:
+                pass
+            if stop.wait(self._memory_interval):
+                return
+
+    def report(self):
+        with self._lock:
+            samples = list(self._samples)
+        ok = [latency for _, latency, error in samples if error is None]
+        errors = collections.Counter(error for _, _, error in samples if error is not None)
+        per_query = {}
+        for name in sorted(self._weights):
+            latencies = [l for n, l, e in samples if n == name and e is None]
+            per_query[name] = dict(count=len(latencies), **percentiles(latencies))
+        return {
+            "duration": self._elapsed,
+            "concurrency": self._concurrency,
+            "rate": self._rate,
+            "requests": len(samples),
+            "errors": dict(errors),
+            "throughput": len(ok) / self._elapsed,
+            "latency": dict(percentiles(ok), mean=float(np.mean(ok)) if len(ok) > 0 else None,
+                            max=max(ok, default=None)),
+            "queries": per_query,
+            "memory": list(self._memory),
+        }
+
+
+def format_report(report):
+    def ms(seconds):
+        return '-' if seconds is None else f"{seconds * 1000:.1f}ms"
+
+    latency = report["latency"]
+    lines = [
+        f"requests: {report['requests']} in {report['duration']:.1f}s "
+        f"(concurrency {report['concurrency']}, rate {report['rate'] or 'unlimited'})",
+        f"throughput: {report['throughput']:.1f} queries/s",
+        f"latency: p50 {ms(latency['p50'])}, p95 {ms(latency['p95'])}, "
+        f"p99 {ms(latency['p99'])}, max {ms(latency['max'])}",
+        f"errors: {report['errors'] or 'none'}",
+        "",
+        f"{'query':<8}{'count':>8}{'p50':>12}{'p95':>12}{'p99':>12}",
+    ]
+    for name, q in report["queries"].items():
+        lines.append(f"{name:<8}{q['count']:>8}{ms(q['p50']):>12}{ms(q['p95']):>12}"
+                     f"{ms(q['p99']):>12}")
+    lines += ["", f"{'time':>8}{'memory':>12}{'in-flight':>12}"]
+    for elapsed, memory, in_flight in report["memory"]:
+        lines.append(f"{elapsed:>7.1f}s{memory / 1024 / 1024:>10.1f}MB{in_flight:>12}")
+    return '\n'.join(lines)
+
+
+def start_server(port, cache_dir, extra_args=()):
+    """Starts pandas-sql-server in a new process (so that it does not share the GIL with the
+    load generator) and waits until it has loaded the cache files.
+
+    @return  The server process
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-c', 'from verdict.pandas_sql.pandas_sql_server import main; main()',
+         'start', '-p', str(port), '--cache-dir', cache_dir] + list(extra_args))
+    while True:
+        if process.poll() is not None:
+            raise ValueError(f"The server exited with {process.returncode}.")
+        try:
+            client = PandasSQLClient(f"localhost:{port}")
+            break
+        except ValueError:
+            time.sleep(0.2)
+    while not client.readiness()["ready"]:
+        time.sleep(0.2)
+    client.close()
+    return process
+
+
+def stop_server(process):
+    """Stops the server process and its pre-forked workers."""
+    try:
+        children = psutil.Process(process.pid).children(recursive=True)
+    except psutil.NoSuchProcess:
+        children = []
+    process.kill()
+    process.wait()
+    for child in children:
+        try:
+            child.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A load generator for the Pandas SQL server')
+    parser.add_argument('--server', type=str,
+                        help='The address (host:port) of a running server. If not given, a server '
+                             'is started on --port.')
+    parser.add_argument('-p', '--port', type=int, default=PANDAS_SQL_DEFAULT_PORT + 1,
+                        help='The port of the started server.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='The number of the processes of the started server.')
+    parser.add_argument('--data-dir', type=str,
+                        help='The directory of the generated tables (a temporary one by default). '
+                             'An attached server must be able to read it.')
+    parser.add_argument('--rows', type=int, default=200000,
+                        help='The number of the rows of lineitem_premerged.')
+    parser.add_argument('--no-load-tables', dest='load_tables', action='store_false',
+                        help='Do not generate and load the tables (an attached server has them).')
+    parser.add_argument('--queries', type=str, default=DEFAULT_QUERY_FILE,
+                        help='A JSON file of { name: query }; the TPC-H queries by default.')
+    parser.add_argument('--mix', type=str,
+                        help='The weights of the queries, e.g., "q1=3,q6=1". Equal by default.')
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+                        help='The number of the requests in flight at most.')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='The requests per second; 0 sends them as fast as possible.')
+    parser.add_argument('-d', '--duration', type=float, default=30.0,
+                        help='The seconds to run.')
+    parser.add_argument('--memory-interval', type=float, default=1.0,
+                        help='The seconds between the samples of the server memory.')
+    parser.add_argument('--protocol', type=str, choices=['arrow', 'json'],
+                        help='The protocol of the client.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, help='Also writes the report into this JSON file.')
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries)
+
+    temp_dir = None
+    data_dir = args.data_dir
+    if data_dir is None:
+        temp_dir = data_dir = tempfile.mkdtemp(prefix='verdict-loadtest-')
+    process = None
+    try:
+        paths = {}
+        if args.load_tables:
+            print(f"Generates the tables ({args.rows} rows) in {data_dir}...")
+            paths = generate_tables(data_dir, args.rows, args.seed)
+        if args.server is None:
+            process = start_server(args.port, data_dir, ['--workers', str(args.workers)])
+            address = f"localhost:{args.port}"
+        else:
+            address = args.server
+        client = PandasSQLClient(address, protocol=args.protocol,
+                                 pool_size=max(args.concurrency, 1) + 1)
+        if args.server is not None:
+            for name, path in paths.items():
+                client.load_table(name, path, if_not_exists=True)
+
+        # a query the tables cannot answer is reported instead of failing the run
+        for name in sorted(queries):
+            try:
+                client.execute(queries[name])
+            except Exception as e:
+                print(f"Skips {name}: {type(e).__name__}: {e}")
+                del queries[name]
+        if len(queries) == 0:
+            raise ValueError("No query to run.")
+        weights = parse_mix(args.mix, queries)
+        print(f"Runs {sorted(weights)} for {args.duration} seconds...")
+        generator = LoadGenerator(client, queries, weights, args.concurrency,
+                                  args.rate if args.rate > 0 else None, args.duration,
+                                  args.memory_interval, args.seed)
+        report = generator.run()
+        print(format_report(report))
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+    finally:
+        if process is not None:
+            stop_server(process)
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
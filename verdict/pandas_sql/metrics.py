@@ -0,0 +1,185 @@
+"""The metrics of the Pandas SQL server.
+
+The server answers GET /metrics with format_metrics(stats), a plain text in the Prometheus
+exposition format, and the "stats" request with the stats themselves (a dict).
+"""
+
+import bisect
+import psutil
+import threading
+import time
+
+
+# The upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, float('inf')]
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def to_dict(self):
+        """@return  The cumulative counts of the buckets (as in Prometheus)"""
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return { "count": self.count, "sum": self.sum, "buckets": cumulative }
+
+
+class ServerMetrics(object):
+    """Collects the request latencies and the table load times."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = {}        # request type -> LatencyHistogram
+        self._statuses = {}         # (request type, status) -> count
+        self._in_flight = 0
+        self._loads = {}            # table name -> { "seconds": float, "rows": int, "time": float }
+        self._compression = {}      # codec ("none" if not compressed) -> the response sizes
+        self._started = time.time()
+
+    def request_started(self):
+        with self._lock:
+            self._in_flight += 1
+
+    def request_finished(self, request_type, status, seconds):
+        with self._lock:
+            self._in_flight -= 1
+            histogram = self._latencies.setdefault(request_type, LatencyHistogram())
+            histogram.observe(seconds)
+            key = (request_type, status)
+            self._statuses[key] = self._statuses.get(key, 0) + 1
+
+    def response_sent(self, codec, raw_bytes, sent_bytes, seconds):
+        """
+        @param codec  The compression codec; None if the response is sent uncompressed
+        @param seconds  The time spent on compression
+        """
+        with self._lock:
+            totals = self._compression.setdefault(codec or 'none',
+                { "responses": 0, "raw-bytes": 0, "sent-bytes": 0, "seconds": 0.0 })
+            totals["responses"] += 1
+            totals["raw-bytes"] += raw_bytes
+            totals["sent-bytes"] += sent_bytes
+            totals["seconds"] += seconds
+
+    def table_loaded(self, table_name, seconds, rows):
+        with self._lock:
+            self._loads[table_name] = { "seconds": seconds, "rows": rows, "time": time.time() }
+
+    def stats(self, admission=None, tables=None, preload=None, flights=None):
+        """
+        @param admission  The stats of the AdmissionController
+        @param tables  { table name: { "rows": int, "memory": bytes } }
+        @param preload  The progress of the CachePreloader
+        @param flights  The stats of the SingleFlight coalescing the identical queries
+        """
+        with self._lock:
+            return {
+                "uptime": time.time() - self._started,
+                "in-flight": self._in_flight,
+                "latencies": {t: h.to_dict() for t, h in self._latencies.items()},
+                "requests": [
+                    { "type": t, "status": s, "count": c } for (t, s), c in self._statuses.items()],
+                "admission": admission,
+                "tables": tables if tables is not None else {},
+                "loads": dict(self._loads),
+                "preload": preload,
+                "flights": flights,
+                "compression": {c: dict(t, ratio=t["raw-bytes"] / max(t["sent-bytes"], 1))
+                                for c, t in self._compression.items()},
+                "resident-memory": psutil.Process().memory_info().rss,
+            }
+
+
+def format_metrics(stats):
+    """@return  The stats in the Prometheus text exposition format"""
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            if len(labels) > 0:
+                label_str = ','.join(f'{k}="{escape(v)}"' for k, v in labels)
+                lines.append(f"{name}{{{label_str}}} {value}")
+            else:
+                lines.append(f"{name} {value}")
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    lines.append(f"# HELP verdict_request_seconds The latencies of the requests.")
+    lines.append(f"# TYPE verdict_request_seconds histogram")
+    for request_type, histogram in sorted(stats["latencies"].items()):
+        for bound, count in histogram["buckets"]:
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'verdict_request_seconds_bucket{{type="{escape(request_type)}",'
+                         f'le="{le}"}} {count}')
+        lines.append(f'verdict_request_seconds_sum{{type="{escape(request_type)}"}} '
+                     f'{histogram["sum"]}')
+        lines.append(f'verdict_request_seconds_count{{type="{escape(request_type)}"}} '
+                     f'{histogram["count"]}')
+
+    metric("verdict_requests_total", "counter", "The finished requests.",
+           [((("type", r["type"]), ("status", r["status"])), r["count"])
+            for r in stats["requests"]])
+    metric("verdict_requests_in_flight", "gauge", "The requests being received or processed.",
+           [((), stats["in-flight"])])
+    admission = stats["admission"]
+    if admission is not None:
+        metric("verdict_requests_running", "gauge", "The requests running on the workers.",
+               [((), admission["running"])])
+        metric("verdict_requests_queued", "gauge", "The requests waiting for a worker.",
+               [((("priority", p),), c) for p, c in admission["queued"].items()])
+        metric("verdict_requests_shed_total", "counter", "The requests shed when overloaded.",
+               [((), admission["shed"])])
+    metric("verdict_table_rows", "gauge", "The number of rows of each table.",
+           [((("table", t),), s["rows"]) for t, s in sorted(stats["tables"].items())])
+    metric("verdict_table_memory_bytes", "gauge", "The memory (deep) of each table.",
+           [((("table", t),), s["memory"]) for t, s in sorted(stats["tables"].items())])
+    metric("verdict_table_load_seconds", "gauge", "The time taken to load each table.",
+           [((("table", t),), l["seconds"]) for t, l in sorted(stats["loads"].items())])
+    compression = sorted(stats.get("compression", {}).items())
+    metric("verdict_responses_total", "counter", "The responses by compression codec.",
+           [((("codec", c),), t["responses"]) for c, t in compression])
+    metric("verdict_response_bytes_total", "counter",
+           "The response bytes before (raw) and after (sent) compression.",
+           [((("codec", c), ("kind", k)), t[f"{k}-bytes"])
+            for c, t in compression for k in ("raw", "sent")])
+    metric("verdict_compression_ratio", "gauge", "The raw bytes divided by the sent bytes.",
+           [((("codec", c),), t["ratio"]) for c, t in compression])
+    metric("verdict_compression_seconds_total", "counter", "The time spent on compression.",
+           [((("codec", c),), t["seconds"]) for c, t in compression])
+    preload = stats.get("preload")
+    if preload is not None:
+        metric("verdict_ready", "gauge", "1 if all the cache files have been loaded.",
+               [((), 1 if preload["ready"] else 0)])
+        metric("verdict_preload_tables", "gauge", "The cache files by their loading state.",
+               [((("state", "loaded"),), preload["loaded"]),
+                ((("state", "loading"),), len(preload["loading"])),
+                ((("state", "pending"),), preload["pending"]),
+                ((("state", "failed"),), len(preload["failed"]))])
+    flights = stats.get("flights")
+    if flights is not None:
+        metric("verdict_queries_coalesced_total", "counter",
+               "The queries that shared the execution of an identical query in flight.",
+               [((), flights["shared"])])
+    metric("verdict_resident_memory_bytes", "gauge", "The resident memory of the server.",
+           [((), stats["resident-memory"])])
+    metric("verdict_uptime_seconds", "gauge", "The time since the server started.",
+           [((), stats["uptime"])])
+    return '\n'.join(lines) + '\n'
@@ -2,11 +2,18 @@
 """
 
 import json
+import math
 import numpy as np
 import pandas as pd
 import pickle
+import threading
+import time
 from verdict.core.relobj import *
 from verdict.interface import from_verdict_query
+from .advisor import IndexAdvisor, SortedIndex, comparison_columns
+from .columnar import is_columnar, read_table_file
+from .cube import DataCube, find_cube_pattern
+from .lazy import LazyColumns, referenced_columns
 
 
 
@@ -28,19 +35,75 @@ def init_logger(log_dir=None):
     return pandas_sql_logger
 
 
+def plan_key(element):
+    """Returns a hashable key that identifies the given relational object. Two objects have the same
+    key if they compute the same result; the uids (or aliases) of tables are ignored.
+    """
+    if isinstance(element, Constant):
+        return ('constant', element.type_hint, element.value())
+    elif isinstance(element, BaseAttr):
+        return ('attr', element.name())
+    elif isinstance(element, AttrOp):
+        return ('attr_op', element.op(), tuple([plan_key(a) for a in element.args()]))
+    elif isinstance(element, AggFunc):
+        return ('agg_func', element.op(), tuple([plan_key(a) for a in element.args()]))
+    elif isinstance(element, BaseTable):
+        return ('table', element.name())
+    elif isinstance(element, SampleTable):
+        return ('sample', element.name(), tuple(element.part_col_values()))
+    elif isinstance(element, DerivedTable):
+        return (element.relop_name(), plan_key(element.source()), plan_key(element.relop_args()))
+    elif isinstance(element, (List, tuple)):
+        return tuple([plan_key(a) for a in element])
+    elif isinstance(element, (str, int, float)):
+        return element
+    else:
+        raise ValueError(element)
+
+
+def prefix_length(row_count, fraction):
+    """The number of the first rows processed when only a fraction of a table is read."""
+    return min(row_count, int(math.ceil(row_count * fraction)))
+
+
 class PandasSQL(object):
 
     def __init__(self, log_dir=None):
         self.id = 'pandas'
+        # table name -> the current version of the table (DataFrame). A new version replaces the
+        # old one atomically; the queries that have pinned the old one keep using it.
         self._tables = {}
+        # table name -> the number of the versions loaded so far
+        self._table_versions = {}
+        # Serializes the swaps of a table and its secondary structures
+        self._swap_lock = threading.RLock()
+        # The tables pinned by the query running in each thread (see _pin_tables())
+        self._pinned = threading.local()
         self._logger = init_logger(log_dir)
 
+        # table name -> a list of declared dimension sets (frozenset). Kept when a table is dropped
+        # so that its cubes are rebuilt when the table is loaded again.
+        self._cube_dims = {}
+        # table name -> { dimension set: DataCube }
+        self._cubes = {}
+        # table name -> { column name: SortedIndex }. Built by the index advisor.
+        self._indexes = {}
+        self._advisor = None
+        # table name -> (id of the DataFrame, its deep memory usage); computed on demand
+        self._table_memory = {}
+        # table name -> LazyColumns, for the tables whose columns are read on first use
+        self._lazy = {}
+
     def _log(self, msg):
         self._logger.debug(msg)
 
     def drop_all_tables(self):
-        del self._tables
-        self._tables = {}
+        with self._swap_lock:
+            for name in list(self._tables):
+                self._drop_secondary_structures(name)
+            self._tables = {}
+            self._cubes = {}
+            self._lazy = {}
 
     def row_count(self, name):
         raise NotImplementedError
@@ -50,7 +113,10 @@ class PandasSQL(object):
         @param name  A fully quantified name for a data source
         @return  A list of (attr name, attr type)
         """
-        df = self._tables[name]
+        lazy = self._lazy.get(name)
+        if lazy is not None:
+            return [(c, None) for c in lazy.schema]
+        df = self._current_tables()[name]
         return [(c, None) for c in df.columns]
 
     def create_table(self, name, data, col_def):
@@ -64,7 +130,7 @@ class PandasSQL(object):
                 new_df[colname] = pd.to_datetime(intermediate[colname])
             else:
                 new_df[colname] = intermediate[colname]
-        self._tables[name] = new_df
+        self.register_table(name, new_df, replace=True)
         return len(new_df.index)
 
     @staticmethod
@@ -81,8 +147,16 @@ class PandasSQL(object):
                 new_df[colname] = intermediate[colname]
         return new_df
 
-    def load_table(self, table_name, file_path, if_not_exists=False):
-        if table_name in self._tables:
+    def load_table(self, table_name, file_path, if_not_exists=False, replace=False, lazy=False):
+        """
+        @param file_path  A pickled DataFrame or a columnar directory (see columnar.py)
+        @param replace  If True, an existing table is replaced by the loaded one (see
+                        register_table()); the table remains queryable while it is being loaded.
+        @param lazy  If True and the file is a columnar directory, only the schema is loaded; each
+                     column is read when a query first references it (see lazy.py). A table with
+                     declared cubes is loaded entirely since its cubes need all of its columns.
+        """
+        if table_name in self._tables and not replace:
             if if_not_exists:
                 pass
             else:
@@ -90,46 +164,730 @@ class PandasSQL(object):
                 # exists. 
                 raise ValueError(f"The specified table, {table_name}, already exists.")
 
+        elif lazy and is_columnar(file_path) and len(self._cube_dims.get(table_name, [])) == 0:
+            lazy_columns = LazyColumns(file_path)
+            df = pd.DataFrame(index=pd.RangeIndex(lazy_columns.row_count))
+            self.register_table(table_name, df, replace, lazy_columns)
+            self._log(f"The schema of the table, {table_name}, has been loaded.")
+            return len(df.index)
+
         else:
-            with open(file_path, 'rb') as f:
-                df = pickle.load(f)
-                assert isinstance(df, pd.core.frame.DataFrame)
-                self.register_table(table_name, df)
-                self._log(f"The table, {table_name}, has been loaded.")
+            df = read_table_file(file_path)
+            self.register_table(table_name, df, replace)
+            self._log(f"The table, {table_name}, has been loaded.")
+            return len(df.index)
                 
         return len(self._tables[table_name].index)
 
-    def register_table(self, table_name, frame):
-        if table_name in self._tables:
+    def register_table(self, table_name, frame, replace=False, lazy_columns=None):
+        """
+        @param replace  If True, an existing table is replaced by a new version atomically. The
+                        queries in flight finish on the old version, which is released after them.
+        @param lazy_columns  If not None, the LazyColumns of the table; the frame holds none of
+                             its columns yet
+        """
+        if table_name in self._tables and not replace:
             raise ValueError(f"The table name ({table_name}) already exists.")
-        self._tables[table_name] = frame
+        # The cubes of the new version are built before the swap.
+        cubes = self._make_cubes(table_name, frame)
+        with self._swap_lock:
+            if table_name in self._tables and not replace:
+                raise ValueError(f"The table name ({table_name}) already exists.")
+            # the indexes are of the old version
+            self._drop_secondary_structures(table_name)
+            self._tables[table_name] = frame
+            self._cubes[table_name] = cubes
+            if lazy_columns is None:
+                self._lazy.pop(table_name, None)
+            else:
+                self._lazy[table_name] = lazy_columns
+            self._table_versions[table_name] = self._table_versions.get(table_name, 0) + 1
+        if replace:
+            self._log(f"The table, {table_name}, is now at version "
+                      f"{self._table_versions[table_name]}.")
+
+    def table_version(self, table_name):
+        """@return  The version of the table (increases whenever the table is loaded); None if
+                    the table does not exist"""
+        if table_name not in self._tables:
+            return None
+        return self._table_versions[table_name]
 
     def drop_table(self, name, if_exists=False):
-        if name not in self._tables:
-            if if_exists == False:
-                raise ValueError(f"The specified table, {name}, does not exist.")
+        with self._swap_lock:
+            if name not in self._tables:
+                if if_exists == False:
+                    raise ValueError(f"The specified table, {name}, does not exist.")
+                else:
+                    pass
             else:
-                pass
+                del self._tables[name]
+                self._cubes.pop(name, None)
+                self._lazy.pop(name, None)
+                self._drop_secondary_structures(name)
+
+    def _current_tables(self):
+        """@return  The tables pinned by the query running in this thread; otherwise, the latest"""
+        tables = getattr(self._pinned, 'tables', None)
+        return self._tables if tables is None else tables
+
+    def _pin_tables(self):
+        """Pins the current versions of the tables for the query running in this thread, so that
+        the query reads the same version of a table throughout even if it is replaced.
+
+        @return  False if the tables have already been pinned (e.g., by the calling method)
+        """
+        if getattr(self._pinned, 'tables', None) is not None:
+            return False
+        # the LazyColumns of the same versions (see _materialize_columns())
+        with self._swap_lock:
+            self._pinned.tables = dict(self._tables)
+            self._pinned.lazy = dict(self._lazy)
+        return True
+
+    def _unpin_tables(self):
+        self._pinned.tables = None
+        self._pinned.lazy = None
+
+    def _materialize_query(self, query):
+        """Reads the columns of the lazily loaded tables that the query may reference. Called after
+        the tables are pinned, so that the pinned versions hold the columns."""
+        lazy = getattr(self._pinned, 'lazy', None)
+        if len(self._lazy if lazy is None else lazy) == 0 or not isinstance(query, dict):
+            return
+        names, returns_rows = referenced_columns(query)
+        for table in find_base_tables(from_verdict_query(query), include_samples=True):
+            self._materialize_columns(table.name(), None if returns_rows else names)
+
+    def _materialize_columns(self, table_name, columns=None):
+        """Reads the given columns of a lazily loaded table if they have not been read yet. The
+        table's frame is replaced by one with the new columns (the other columns are shared); if
+        the tables are pinned, the pinned frame is (and the latest one too, if the same).
+
+        @param columns  The column names (the ones not in the table are ignored); None for all
+        """
+        pinned_lazy = getattr(self._pinned, 'lazy', None)
+        with self._swap_lock:
+            lazy = (self._lazy if pinned_lazy is None else pinned_lazy).get(table_name)
+        if lazy is None:
+            return
+        with lazy.lock:
+            with self._swap_lock:
+                df = self._current_tables().get(table_name)
+                if pinned_lazy is None and self._lazy.get(table_name) is not lazy:
+                    # replaced or dropped meanwhile
+                    return
+            if df is None:
+                return
+            wanted = [c for c in lazy.schema if columns is None or c in columns]
+            lazy.touch(wanted)
+            missing = [c for c in wanted if c not in df.columns]
+            if len(missing) == 0:
+                return
+            # the Series keep their dtypes and share the values (see columnar.columns_frame())
+            data = {c: df[c] if c in df.columns else lazy.read(c)
+                        for c in lazy.schema if c in df.columns or c in missing}
+            self._swap_frame(table_name, df, lazy.frame(data, df.index))
+            self._log(f"Read the columns {missing} of the table, {table_name}.")
+
+    def _complete_frame(self, df, lazy):
+        """Reads the columns of a lazily loaded table that its frame does not hold. Unlike
+        _materialize_columns(), the table keeps them unread; e.g., a cube or a snapshot needs all
+        the columns only once.
+
+        @param df  The frame of the table taken along with its LazyColumns (lazy)
+        @return  A frame with all the columns
+        """
+        if lazy is None or all(c in df.columns for c in lazy.schema):
+            return df
+        data = {c: df[c] if c in df.columns else lazy.read(c) for c in lazy.schema}
+        return lazy.frame(data, df.index)
+
+    def evict_cold_columns(self, idle_seconds):
+        """Drops the columns of the lazily loaded tables that no query has referenced for
+        idle_seconds. They are read again when referenced.
+
+        @return  The number of the dropped columns
+        """
+        evicted = 0
+        with self._swap_lock:
+            lazy_tables = list(self._lazy.items())
+        for table_name, lazy in lazy_tables:
+            with lazy.lock:
+                with self._swap_lock:
+                    # a replaced table keeps its columns; a query may have pinned it
+                    if self._lazy.get(table_name) is not lazy:
+                        continue
+                    df = self._tables.get(table_name)
+                if df is None:
+                    continue
+                cold = [c for c in lazy.cold_columns(idle_seconds) if c in df.columns]
+                if len(cold) == 0:
+                    continue
+                data = {c: df[c] for c in df.columns if c not in cold}
+                self._swap_frame(table_name, df, lazy.frame(data, df.index))
+                evicted += len(cold)
+                self._log(f"Dropped the cold columns {cold} of the table, {table_name}.")
+        return evicted
+
+    def _swap_frame(self, table_name, df, new_df):
+        """Replaces the frame of a table with one holding a different set of its columns (i.e., the
+        same version of the table). Its cubes and indexes remain valid."""
+        with self._swap_lock:
+            if self._tables.get(table_name) is df:
+                self._tables[table_name] = new_df
+        pinned = getattr(self._pinned, 'tables', None)
+        if pinned is not None and pinned.get(table_name) is df:
+            pinned[table_name] = new_df
+
+    def create_cube(self, table_name, dims):
+        """Declares a cube (i.e., pre-aggregated sums and counts) over the dimension columns. The
+        cube is built now if the table exists; otherwise, when the table is loaded.
+
+        @param dims  A list of column names
+        @return  The number of rows in the cube (0 if not built yet)
+        """
+        assert_type(dims, (List, tuple))
+        dims = frozenset(dims)
+        declared = self._cube_dims.setdefault(table_name, [])
+        if dims not in declared:
+            declared.append(dims)
+            self._build_cube(table_name, dims)
+        cube = self._cubes.get(table_name, {}).get(dims)
+        return 0 if cube is None else cube.row_count()
+
+    def drop_cube(self, table_name, dims=None):
+        """Drops the cube over the dimensions; if dims is None, all cubes of the table."""
+        if dims is None:
+            self._cube_dims.pop(table_name, None)
+            self._cubes.pop(table_name, None)
+        else:
+            dims = frozenset(dims)
+            if dims in self._cube_dims.get(table_name, []):
+                self._cube_dims[table_name].remove(dims)
+            self._cubes.get(table_name, {}).pop(dims, None)
+
+    def cubes(self, table_name):
+        """@return  A list of (dims, cube row count) of the materialized cubes"""
+        return [(sorted(dims), cube.row_count())
+                    for dims, cube in self._cubes.get(table_name, {}).items()]
+
+    def _make_cubes(self, table_name, df):
+        """@return  The declared cubes of the table built over the given version of it"""
+        cubes = {}
+        for dims in list(self._cube_dims.get(table_name, [])):
+            cube = self._make_cube(table_name, df, dims)
+            if cube is not None:
+                cubes[dims] = cube
+        return cubes
+
+    def _make_cube(self, table_name, df, dims):
+        if not dims <= set(df.columns):
+            self._log(f"Skips the cube of {table_name} over {sorted(dims)}: no such columns.")
+            return None
+        if df[list(dims)].isnull().values.any():
+            self._log(f"Skips the cube of {table_name} over {sorted(dims)}: nulls found.")
+            return None
+        cube = DataCube(df, dims)
+        self._log(f"A cube of {table_name} over {sorted(dims)} has been built "
+                  f"({cube.row_count()} rows).")
+        return cube
+
+    def _build_cube(self, table_name, dims):
+        with self._swap_lock:
+            df = self._tables.get(table_name)
+            lazy = self._lazy.get(table_name)
+            version = self._table_versions.get(table_name)
+        if df is None:
+            return
+        cube = self._make_cube(table_name, self._complete_frame(df, lazy), dims)
+        with self._swap_lock:
+            # the frame may have been swapped for the same version (see _swap_frame())
+            if cube is not None and self._table_versions.get(table_name) == version and \
+                    table_name in self._tables:
+                self._cubes.setdefault(table_name, {})[dims] = cube
+
+    def _execute_on_cube(self, query_obj):
+        """Answers the query using the smallest matching cube. Returns None if no cube matches."""
+        pattern = find_cube_pattern(query_obj)
+        if pattern is None:
+            return None
+        with self._swap_lock:
+            cubes = list(self._cubes.get(pattern.table_name, {}).values())
+            current = self._tables.get(pattern.table_name)
+        if current is not self._current_tables().get(pattern.table_name):
+            # replaced after this query has pinned the table
+            return None
+        candidates = [c for c in cubes if c.covers(pattern)]
+        if len(candidates) == 0:
+            return None
+        cube = min(candidates, key=lambda c: c.row_count())
+        self._log(f"The query is answered using the cube over {sorted(cube.dims)}.")
+        return cube.answer(pattern, self._execute)
+
+    def start_advisor(self, memory_budget, interval=10):
+        """Starts the index advisor in a background thread. The advisor builds the secondary
+        structures (sorted indexes and cubes) that benefit the observed workload most, and drops
+        the ones no longer used.
+
+        @param memory_budget  The bytes the advisor's structures may use in total
+        @param interval  The seconds between the advisor rounds
+        """
+        if self._advisor is None:
+            self._advisor = IndexAdvisor(self, memory_budget)
+        self._advisor.start(interval)
+
+    def stop_advisor(self):
+        if self._advisor is not None:
+            self._advisor.stop()
+
+    def snapshot_state(self):
+        """@return  A consistent view of the tables and their secondary structures (see
+                    snapshot.py)"""
+        with self._swap_lock:
+            state = {
+                "tables": dict(self._tables),
+                "cube_dims": {n: list(dims) for n, dims in self._cube_dims.items()},
+                "cubes": {n: dict(cubes) for n, cubes in self._cubes.items()},
+                "indexes": {n: dict(indexes) for n, indexes in self._indexes.items()},
+                "advisor": {} if self._advisor is None else self._advisor.built_structures(),
+            }
+            lazy_tables = dict(self._lazy)
+        # the unread columns are read for the snapshot only
+        for table_name, lazy in lazy_tables.items():
+            if table_name in state["tables"]:
+                state["tables"][table_name] = self._complete_frame(state["tables"][table_name],
+                                                                   lazy)
+        return state
+
+    def restore_table(self, table_name, frame, cube_dims=(), cubes=None, indexes=None,
+                      advisor_structures=None):
+        """Installs a table along with its prebuilt secondary structures (e.g., read from a
+        snapshot) instead of building them. An existing table is replaced.
+
+        @param cube_dims  The declared dimension sets (frozenset) of the table's cubes
+        @param cubes  { dims: DataCube }
+        @param indexes  { column name: SortedIndex }
+        @param advisor_structures  { structure: bytes } of the advisor's structures among them
+        """
+        with self._swap_lock:
+            self._drop_secondary_structures(table_name)
+            declared = self._cube_dims.setdefault(table_name, [])
+            for dims in cube_dims:
+                if dims not in declared:
+                    declared.append(dims)
+            self._tables[table_name] = frame
+            self._lazy.pop(table_name, None)
+            self._cubes[table_name] = dict(cubes or {})
+            self._indexes[table_name] = dict(indexes or {})
+            self._table_versions[table_name] = self._table_versions.get(table_name, 0) + 1
+        if self._advisor is not None:
+            for structure, size in (advisor_structures or {}).items():
+                self._advisor.adopt(structure, size)
+
+    def advisor_report(self):
+        """@return  The recorded workload, the built structures, and the advisor's decisions (None
+                    if the advisor has never been started)"""
+        if self._advisor is None:
+            return None
+        return self._advisor.report()
+
+    def _record_use(self, kind, table_name, columns, cost):
+        if self._advisor is not None:
+            self._advisor.record(kind, table_name, columns, cost)
+
+    def _drop_secondary_structures(self, table_name):
+        self._indexes.pop(table_name, None)
+        self._table_memory.pop(table_name, None)
+        if self._advisor is not None:
+            self._advisor.table_dropped(table_name)
+
+    def _estimate_structure_size(self, structure):
+        """@return  The estimated bytes of the structure; None if it cannot be built"""
+        kind, table_name, columns = structure
+        self._materialize_columns(table_name, [columns] if kind == 'index' else columns)
+        df = self._tables.get(table_name)
+        if df is None:
+            return None
+        if kind == 'index':
+            if columns not in df.columns:
+                return None
+            return len(df.index) * 8 + int(df[columns].memory_usage(index=False, deep=True))
+        else:
+            dims = list(columns)
+            if not set(dims) <= set(df.columns):
+                return None
+            groups = min(np.prod([float(df[c].nunique()) for c in dims]), len(df.index))
+            measures = [c for c in df.columns if c not in dims and
+                            pd.api.types.is_numeric_dtype(df[c])]
+            return int(groups * (len(dims) + 2 * len(measures) + 1) * 8)
+
+    def _build_structure(self, structure):
+        """@return  The bytes of the built structure; None if not built"""
+        kind, table_name, columns = structure
+        if kind == 'index':
+            self._materialize_columns(table_name, [columns])
+        df = self._tables.get(table_name)
+        if df is None:
+            return None
+        if kind == 'index':
+            if columns not in df.columns or df[columns].isnull().any():
+                return None
+            try:
+                index = SortedIndex(df[columns])
+            except TypeError:
+                # not orderable (e.g., mixed types)
+                return None
+            with self._swap_lock:
+                if self._tables.get(table_name) is not df:
+                    # replaced while building
+                    return None
+                indexes = dict(self._indexes.get(table_name, {}))
+                indexes[columns] = index
+                self._indexes[table_name] = indexes
+            return index.memory_usage()
         else:
-            del self._tables[name]
+            dims = frozenset(columns)
+            if dims in self._cubes.get(table_name, {}):
+                # already declared by a user
+                return None
+            self._build_cube(table_name, dims)
+            cube = self._cubes.get(table_name, {}).get(dims)
+            return None if cube is None else cube.memory_usage()
+
+    def _drop_structure(self, structure):
+        kind, table_name, columns = structure
+        if kind == 'index':
+            with self._swap_lock:
+                indexes = dict(self._indexes.get(table_name, {}))
+                indexes.pop(columns, None)
+                self._indexes[table_name] = indexes
+        else:
+            dims = frozenset(columns)
+            if dims not in self._cube_dims.get(table_name, []):
+                self._cubes.get(table_name, {}).pop(dims, None)
+
+    def _base_source(self, element, memo=None):
+        """If the element reads a table as is (possibly projecting its columns), returns the table
+        name and the mapping from the output columns to the table columns; otherwise, None.
+
+        @param memo  If the memo holds other rows for the table (e.g., a prefix), returns None.
+        """
+        table = element
+        if isinstance(element, DerivedTable) and element.is_project():
+            table = element.source()
+        if not isinstance(table, (BaseTable, SampleTable)):
+            return None
+        df = self._current_tables().get(table.name())
+        if df is None:
+            return None
+        if memo is not None and memo.get(plan_key(table), df) is not df:
+            return None
+
+        if isinstance(element, (BaseTable, SampleTable)):
+            return element.name(), {c: c for c in df.columns}
+        else:
+            mapping = {}
+            for attr, alias in element.relop_args():
+                if not isinstance(attr, BaseAttr):
+                    return None
+                mapping[alias] = attr.name()
+            return element.source().name(), mapping
+
+    def _indexes_of(self, table_name):
+        """@return  The indexes of the table if they are of the version read by the current query"""
+        # The indexes are dropped before a new version is swapped in; hence, checked after.
+        indexes = self._indexes.get(table_name, {})
+        if self._tables.get(table_name) is not self._current_tables().get(table_name):
+            return {}
+        return indexes
+
+    def _source_rows(self, element, table_name, positions):
+        """Computes the element (see _base_source()) only over the rows at the positions."""
+        df = self._current_tables()[table_name].iloc[positions]
+        if isinstance(element, DerivedTable):
+            return self._project(element, df)
+        return df
+
+    def _indexed_source(self, source, predicate, memo=None):
+        """Returns the rows of the source that may satisfy the predicate, found using an index on
+        one of its comparisons. Returns None if no index applies.
+        """
+        base = self._base_source(source, memo)
+        if base is None:
+            return None
+        table_name, mapping = base
+        indexes = self._indexes_of(table_name)
+        for column, op, value in comparison_columns(predicate):
+            column = mapping.get(column)
+            if column not in indexes:
+                continue
+            try:
+                positions = indexes[column].positions(op, value)
+            except TypeError:
+                continue
+            self._record_predicates(source, predicate, None)
+            return self._source_rows(source, table_name, positions)
+        return None
+
+    def _record_predicates(self, source, predicate, cost):
+        base = self._base_source(source)
+        if base is None:
+            return
+        table_name, mapping = base
+        for column, _, _ in comparison_columns(predicate):
+            if column in mapping:
+                self._record_use('predicate', table_name, [mapping[column]], cost)
+
+    def _join_inputs(self, element, execute, memo=None):
+        """Computes the two inputs of the join. If a side has an index on its join key and may
+        drop its non-matching rows, only the matching rows of that side are read.
+
+        @return  (left df, right df, True if an index has been used)
+        """
+        join_type = element.join_type()
+        sides = [
+            (element.source(), element.left_join_col().name(), join_type in ('inner', 'right')),
+            (element.right_join_table(), element.right_join_col().name(),
+                join_type in ('inner', 'left')),
+        ]
+        for i, (side, key, prunable) in enumerate(sides):
+            base = self._base_source(side, memo)
+            if not prunable or base is None:
+                continue
+            table_name, mapping = base
+            index = self._indexes_of(table_name).get(mapping.get(key))
+            if index is None:
+                continue
+            other, other_key, _ = sides[1-i]
+            other_df = execute(other)
+            keys = other_df[other_key].dropna().unique()
+            if len(keys) >= index.row_count():
+                continue
+            try:
+                positions = index.positions_in(keys)
+            except TypeError:
+                continue
+            this_df = self._source_rows(side, table_name, positions)
+            if i == 0:
+                return this_df, other_df, True
+            else:
+                return other_df, this_df, True
+        return execute(element.source()), execute(element.right_join_table()), False
+
+    def _record_join_keys(self, element, cost):
+        for side, key in [(element.source(), element.left_join_col().name()),
+                          (element.right_join_table(), element.right_join_col().name())]:
+            base = self._base_source(side)
+            if base is not None and key in base[1]:
+                self._record_use('join', base[0], [base[1][key]], cost)
+
+    def _record_group(self, pattern, cost):
+        if pattern is not None and len(pattern.dims) > 0:
+            self._record_use('group', pattern.table_name, sorted(pattern.dims), cost)
 
     def get_df(self, name):
         return self._tables[name]
 
-    def execute(self, query):
+    def table_stats(self):
+        """@return  { table name: { "rows": int, "memory": the deep memory usage in bytes } }"""
+        stats = {}
+        for name, df in list(self._tables.items()):
+            memory = self._table_memory.get(name)
+            if memory is None or memory[0] != id(df):
+                # deep memory usage scans the strings; a table does not change once loaded
+                memory = (id(df), int(df.memory_usage(index=True, deep=True).sum()))
+                self._table_memory[name] = memory
+            stats[name] = { "rows": len(df.index), "memory": memory[1] }
+        return stats
+
+    def execute(self, query, fraction=None):
         """
         @param query  A query in the verdict query format
+        @param fraction  If not None, only this fraction of the rows (i.e., the first rows) of each
+                         table is processed. This is a uniform subsample if the rows of the tables
+                         are stored in random order.
         @return  A result in json string format
         """
+        pinned = self._pin_tables()
+        try:
+            self._materialize_query(query)
+            return self._execute_query(query, fraction)
+        finally:
+            if pinned:
+                self._unpin_tables()
+
+    def _execute_query(self, query, fraction):
         assert_type(query, dict)
         self._log(f'PandasDB received a query: {query}')
         query_obj = from_verdict_query(query)
         assert_type(query_obj, DerivedTable)
 
+        if fraction is not None and fraction < 1.0:
+            # The cubes and the workload statistics are for the entire tables.
+            memo = self._prefix_memo(query_obj, fraction)
+            pattern = None
+        else:
+            memo = None
+            start = time.time()
+            pattern = find_cube_pattern(query_obj) if self._advisor is not None else None
+            cube_result = self._execute_on_cube(query_obj)
+            if cube_result is not None:
+                self._record_group(pattern, None)
+                return cube_result
+
         self._attach_column_names(query_obj)
         query_obj = self._pushdown_project(query_obj)
         self._log(f"PandasDB's internal optimized query: {query_obj}")
-        return self._execute(query_obj)
+        result = self._execute(query_obj, memo=memo)
+        if pattern is not None:
+            self._record_group(pattern, time.time() - start)
+        return result
+
+    def _prefix_memo(self, query_obj, fraction):
+        """Returns a memo (see _execute()) that maps the tables of the query to their first rows."""
+        memo = {}
+        tables = self._current_tables()
+        for table in find_base_tables(query_obj, include_samples=True):
+            if table.name() not in tables:
+                raise ValueError(f"Tried to access non-existing table {table.name()}")
+            df = tables[table.name()]
+            memo[plan_key(table)] = df.iloc[:prefix_length(len(df.index), fraction)]
+        self._log(f"Only {fraction*100:.2f}% of the rows are processed.")
+        return memo
+
+    def execute_many(self, queries, return_exceptions=False):
+        """Executes a batch of queries, sharing the scans over the same source tables.
+
+        The queries are grouped by the tables they read. Within a group, identical sub-plans (e.g.,
+        the same filter over the same table) are evaluated only once, and the aggregates computed
+        over the same (filtered and grouped) source are evaluated together in a single agg().
+
+        @param queries  A list of queries in the verdict query format
+        @param return_exceptions  If True, a failed query's exception is placed in the returned
+                                  list instead of being raised.
+        @return  A list of results (one for each query, in the same order)
+        """
+        pinned = self._pin_tables()
+        try:
+            return self._execute_many(queries, return_exceptions)
+        finally:
+            if pinned:
+                self._unpin_tables()
+
+    def _execute_many(self, queries, return_exceptions):
+        assert_type(queries, (List, tuple))
+        self._log(f'PandasDB received a batch of {len(queries)} queries.')
+
+        results = [None] * len(queries)
+        query_objs = {}
+        for i, query in enumerate(queries):
+            try:
+                cube_result, query_obj = self._plan_in_batch(query)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results[i] = e
+                continue
+            if cube_result is not None:
+                results[i] = cube_result
+            else:
+                query_objs[i] = query_obj
+
+        # source tables -> the indexes of the queries
+        groups = {}
+        for i, query_obj in query_objs.items():
+            base_tables = find_base_tables(query_obj, include_samples=True)
+            names = tuple(sorted(set([t.name() for t in base_tables])))
+            groups.setdefault(names, []).append(i)
+
+        for names, indexes in groups.items():
+            self._log(f'{len(indexes)} queries share the scan over {list(names)}.')
+            memo = {}
+            try:
+                group_results = self._execute_shared([query_objs[i] for i in indexes], memo)
+            except Exception:
+                # Falls back to executing the queries one by one so that a failure is only
+                # reported for the query that caused it.
+                group_results = []
+                for i in indexes:
+                    try:
+                        group_results.append(self._execute(query_objs[i], memo=memo).copy())
+                    except Exception as e:
+                        if not return_exceptions:
+                            raise
+                        group_results.append(e)
+            for i, result in zip(indexes, group_results):
+                results[i] = result
+        return results
+
+    def _plan_in_batch(self, query):
+        """Reads the columns the query needs and answers it from a cube if possible.
+
+        @return  (the result from a cube or None, the query object to execute otherwise)
+        """
+        assert_type(query, dict)
+        self._materialize_query(query)
+        query_obj = from_verdict_query(query)
+        assert_type(query_obj, DerivedTable)
+        if self._advisor is not None:
+            # the cost of each query is unknown in a batch
+            self._record_group(find_cube_pattern(query_obj), None)
+        cube_result = self._execute_on_cube(query_obj)
+        if cube_result is not None:
+            return cube_result, None
+        self._attach_column_names(query_obj)
+        if self._has_join(query_obj):
+            # Sharing is less likely for joins; we prefer the faster join instead.
+            query_obj = self._pushdown_project(query_obj)
+        return None, query_obj
+
+    def _execute_shared(self, query_objs, memo):
+        """Executes the queries reading the same tables. The aggregates over the same source are
+        combined into one agg() operation, and its result is split back for each query.
+        """
+        # plan_key(source) -> { plan_key(agg_func): internal alias }
+        source2aggs = {}
+        source2table = {}
+        for query_obj in query_objs:
+            if not query_obj.is_agg():
+                continue
+            source_key = plan_key(query_obj.source())
+            source2table[source_key] = query_obj.source()
+            aggs = source2aggs.setdefault(source_key, {})
+            for agg_func, alias in query_obj.relop_args():
+                func_key = plan_key(agg_func)
+                if func_key not in aggs:
+                    aggs[func_key] = (agg_func, f'_agg{len(aggs)}')
+
+        source2result = {}
+        for source_key, aggs in source2aggs.items():
+            combined = DerivedTable(source2table[source_key], 'agg', list(aggs.values()))
+            source2result[source_key] = self._execute(combined, memo=memo)
+
+        results = []
+        for query_obj in query_objs:
+            if not query_obj.is_agg():
+                # the memo may hold the same frame for other queries
+                results.append(self._execute(query_obj, memo=memo).copy())
+                continue
+            source_key = plan_key(query_obj.source())
+            aggs = source2aggs[source_key]
+            combined_result = source2result[source_key]
+            groups_count = len(combined_result.columns) - len(aggs)
+            group_cols = list(combined_result.columns[0:groups_count])
+            agg_cols = [aggs[plan_key(a[0])][1] for a in query_obj.relop_args()]
+            result = combined_result[group_cols + agg_cols].copy()
+            result.columns = group_cols + [a[1] for a in query_obj.relop_args()]
+            results.append(result)
+        return results
+
+    def _has_join(self, query_obj):
+        if isinstance(query_obj, DerivedTable):
+            if query_obj.is_join():
+                return True
+            return self._has_join(query_obj.source())
+        return False
 
     def _attach_column_names(self, query_obj):
         base_tables = find_base_tables(query_obj, include_samples=True)
@@ -236,10 +994,20 @@ class PandasSQL(object):
         else:
             raise ValueError(query_obj)
 
-    def _execute(self, element, context_df=None):
+    def _execute(self, element, context_df=None, memo=None):
         """
         @param context_df  Used for processing the elements that require their parent dataframe.
+        @param memo  If not None, the results of the table operations are shared through this dict
+                     (keyed by plan_key()). Used for the batch execution.
         """
+        if memo is not None and isinstance(element, Table):
+            key = plan_key(element)
+            if key not in memo:
+                memo[key] = self._execute_table(element, memo)
+            return memo[key]
+        elif isinstance(element, Table):
+            return self._execute_table(element, memo)
+
         if isinstance(element, Constant):
             return element.value()
             # return pd.DataFrame(element.value(), index=context_df.index, columns=[0])[0]
@@ -260,6 +1028,14 @@ class PandasSQL(object):
             return context_df[col_name]
 
         elif isinstance(element, AggFunc):
+            if element.op() == 'count' and len(element.args()) > 0:
+                # count(attr) counts the non-null values
+                arg = self._execute(element.args()[0], context_df)
+                if isinstance(arg, pd.core.series.Series):
+                    return pd.Series(arg.count())
+                else:
+                    return arg.count()
+
             if element.op() == 'count':
                 if isinstance(context_df, pd.core.frame.DataFrame):
                     # When no groupby() procedes
@@ -410,53 +1186,74 @@ class PandasSQL(object):
             else:
                 raise ValueError(f'Unknown attriute operation: {op_name}')
 
-        elif isinstance(element, BaseTable):
+        else:
+            raise ValueError(element)
+
+    def _project(self, element, source):
+        df = pd.concat([self._execute(attr_alias[0], source).to_frame() for attr_alias
+                            in element.relop_args()], axis=1)
+        # df.columns = [f'{self.uid}.{alias}' for alias in element.relop_args()[0].keys()]
+        df.columns = [attr_alias[1] for attr_alias in element.relop_args()]
+        return df
+
+    def _execute_table(self, element, memo=None):
+        """Executes a table operation (i.e., BaseTable, SampleTable, or DerivedTable).
+        """
+        def execute(e):
+            return self._execute(e, memo=memo)
+
+        if isinstance(element, BaseTable):
             table_name = element.name()
-            if table_name not in self._tables:
+            tables = self._current_tables()
+            if table_name not in tables:
                 raise ValueError(f"Tried to access non-existing table {table_name}")
-            return self._tables[table_name]
+            return tables[table_name]
 
         elif isinstance(element, SampleTable):
             table_name = element.name()
-            if table_name not in self._tables:
+            tables = self._current_tables()
+            if table_name not in tables:
                 raise ValueError(f"Tried to access non-existing table {table_name}")
-            return self._tables[table_name]
+            return tables[table_name]
 
         elif isinstance(element, DerivedTable):
             if element.is_project():
-                source = self._execute(element.source())
-                df = pd.concat([self._execute(attr_alias[0], source).to_frame() for attr_alias
-                                    in element.relop_args()], axis=1)
-                # df.columns = [f'{self.uid}.{alias}' for alias in element.relop_args()[0].keys()]
-                df.columns = [attr_alias[1] for attr_alias in element.relop_args()]
-                return df
+                return self._project(element, execute(element.source()))
             elif element.is_select():
-                source = self._execute(element.source())
                 assert_equal(len(element.relop_args()), 1)
-                predicate = self._execute(element.relop_args()[0], source)
-                return source[predicate]
+                predicate = element.relop_args()[0]
+                source = self._indexed_source(element.source(), predicate, memo)
+                if source is not None:
+                    return source[self._execute(predicate, source)]
+                start = time.time()
+                source = execute(element.source())
+                result = source[self._execute(predicate, source)]
+                self._record_predicates(element.source(), predicate, time.time() - start)
+                return result
                 
             elif element.is_join():
                 join_type = element.join_type()
                 if join_type == 'cross':
                     COMMON_JOIN_KEY = '_dummy_join_key'
-                    source = self._execute(element)
-                    source[COMMON_JOIN_KEY] = 0
-                    right_join_table = self._execute(self.right_join_table())
-                    right_join_table[COMMON_JOIN_KEY] = 0
+                    # assign() copies; the inputs may be shared through the memo
+                    source = self._execute(element).assign(**{COMMON_JOIN_KEY: 0})
+                    right_join_table = self._execute(self.right_join_table()).assign(
+                        **{COMMON_JOIN_KEY: 0})
                     return pd.merge(left=source, right=right_join_table, how='outer',
                                     left_on=COMMON_JOIN_KEY, right_on=COMMON_JOIN_KEY)
                 else:
                     # left_join_key = self.left_join_col().full_name()
                     left_join_key = element.left_join_col().name()
-                    source = self._execute(element.source())
-                    right_join_table = self._execute(element.right_join_table())
                     right_join_key = element.right_join_col().name()
-                    return pd.merge(left=source, right=right_join_table, how=join_type, 
-                                    left_on=left_join_key, right_on=right_join_key)
+                    start = time.time()
+                    source, right_join_table, indexed = self._join_inputs(element, execute, memo)
+                    result = pd.merge(left=source, right=right_join_table, how=join_type, 
+                                      left_on=left_join_key, right_on=right_join_key)
+                    self._record_join_keys(element, None if indexed else time.time() - start)
+                    return result
 
             elif element.is_groupby():
-                source = self._execute(element.source())
+                source = execute(element.source())
                 attr_names = []
                 for attr in element.relop_args():
                     assert isinstance(attr, BaseAttr)
@@ -464,7 +1261,7 @@ class PandasSQL(object):
                 return source.groupby(attr_names)
 
             elif element.is_agg():
-                source = self._execute(element.source())
+                source = execute(element.source())
                 # attr.pandas_attr() is expected to return a Series object.
                 # We convert them to DataFrame, then concatenate.
                 df = pd.concat([self._execute(attr_alias[0], source).to_frame() for attr_alias 
@@ -477,11 +1274,10 @@ class PandasSQL(object):
                     return df
 
             elif self.is_orderby():
-                source = self._execute(element.source())
+                source = execute(element.source())
                 by = [f'{element.source().uid}.{a[0]}' for a in element.relop_args()]
                 ascending = [True if a[1] == 'ASC' else False for a in element.relop_args()]
-                source.sort_values(by=by, ascending=ascending, inplace=True)
-                return source
+                return source.sort_values(by=by, ascending=ascending)
 
             elif self.is_limit():
                 source = self._execute(element)
@@ -0,0 +1,213 @@
+"""An asyncio variant of PandasSQLClient.
+
+Many requests can be in flight from a single thread, e.g.,
+
+    client = await AsyncPandasSQLClient().connect()
+    results = await asyncio.gather(*[client.execute(q) for q in queries])
+"""
+
+import asyncio
+import uuid
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from .admission import ServerOverloadedError
+from .pandas_sql_client import batch_results, check_response, init_logger, \
+    negotiate_compression, negotiate_transport, retry_delay
+from .pandas_sql_server import PANDAS_SQL_DEFAULT_PORT
+from .protocol import ENCODING_HEADER, arrow_available, decode_response, encode_request, \
+    negotiate_protocol
+from .shm import create_probe, remove_segment
+
+try:
+    # keeps the connections alive (the simple client opens one per request); requires pycurl
+    from tornado.curl_httpclient import CurlAsyncHTTPClient as PooledHTTPClient
+except ImportError:
+    PooledHTTPClient = None
+
+
+class AsyncPandasSQLClient(object):
+
+    def __init__(self, server_address=f"localhost:{PANDAS_SQL_DEFAULT_PORT}", protocol=None,
+                 max_clients=64, transport=None, max_retries=3, compression=None,
+                 compress_threshold=None):
+        """
+        :param server_address:
+            The listening server address in the following form: "host:port"
+        :param protocol:
+            See PandasSQLClient.
+        :param transport:
+            See PandasSQLClient.
+        :param max_clients:
+            The maximum number of the requests in flight; the others wait in a queue.
+        :param max_retries:
+            See PandasSQLClient.
+        :param compression:
+            See PandasSQLClient.
+        :param compress_threshold:
+            See PandasSQLClient.
+        """
+        self.client_id = 'client' + uuid.uuid4().hex[:8]
+        self._logger = init_logger()
+        self._server_address = server_address
+        self._url = f'http://{server_address}'
+        self._requested_protocol = protocol
+        self._protocol = 'json'
+        self._requested_transport = transport
+        self._transport = 'http'
+        self._requested_compression = compression
+        self._codec = None
+        self._compress_threshold = compress_threshold
+        self._max_clients = max_clients
+        self._max_retries = max_retries
+        self._http = None
+
+    def _log(self, msg):
+        self._logger.debug(msg)
+
+    async def connect(self):
+        """Checks the server and negotiates the protocol. Must be called within the event loop
+        where this client is used.
+
+        :return: self
+        """
+        if PooledHTTPClient is not None:
+            self._http = PooledHTTPClient(force_instance=True, max_clients=self._max_clients)
+        else:
+            self._http = AsyncHTTPClient(force_instance=True, max_clients=self._max_clients)
+        ping = { "type": "ping" }
+        if arrow_available() and self._requested_transport != 'http':
+            ping["shm-probe"] = create_probe()
+        try:
+            response = await self.request(ping)
+        except (OSError, HTTPClientError):
+            msg = f"Failed to connect to the Pandas SQL server ({self._server_address})."
+            raise ValueError(msg) from None
+        finally:
+            if "shm-probe" in ping:
+                remove_segment(ping["shm-probe"])
+
+        # old servers only speak json
+        self._protocol = negotiate_protocol(self._requested_protocol,
+                                            response.get("protocols", ['json']))
+        self._transport = negotiate_transport(self._requested_transport, self._protocol,
+                                              response.get("shm", False))
+        self._codec = negotiate_compression(self._requested_compression,
+                                            response.get("codecs", []), self._server_address,
+                                            self._transport)
+        self._log(f"Uses the {self._protocol} protocol over {self._transport} "
+                  f"(compression: {self._codec}).")
+        return self
+
+    def close(self):
+        if self._http is not None:
+            self._http.close()
+            self._http = None
+
+    async def load_table(self, table_name, file_path, if_not_exists=True, part_col=None,
+                         replicate=False, replace=False, lazy=False):
+        request = {
+            "type": "load-table",
+            "table-name": table_name,
+            "file-path": file_path,
+            "if-not-exists": if_not_exists,
+            }
+        if part_col is not None:
+            request["part-col"] = part_col
+        if replicate:
+            request["replicate"] = replicate
+        if replace:
+            request["replace"] = replace
+        if lazy:
+            request["lazy"] = lazy
+        response = await self.request(request)
+        return response["result"]
+
+    async def drop_table(self, table_name, if_exists=True):
+        await self.request({
+            "type": "drop-table",
+            "table-name": table_name,
+            "if-exists": if_exists,
+            })
+
+    async def create_cube(self, table_name, dims):
+        response = await self.request({
+            "type": "create-cube",
+            "table-name": table_name,
+            "dims": list(dims),
+            })
+        return response["result"]
+
+    async def drop_cube(self, table_name, dims=None):
+        request = {
+            "type": "drop-cube",
+            "table-name": table_name,
+            }
+        if dims is not None:
+            request["dims"] = list(dims)
+        await self.request(request)
+
+    async def advisor_report(self):
+        response = await self.request({ "type": "advisor-report" })
+        return response["result"]
+
+    async def execute(self, json_query, fraction=None, priority=None):
+        request = {
+            "type": "json-query",
+            "query": json_query
+            }
+        if fraction is not None:
+            request["fraction"] = fraction
+        if priority is not None:
+            request["priority"] = priority
+        response = await self.request(request)
+        return response["result"]
+
+    async def execute_many(self, json_queries):
+        response = await self.request({
+            "type": "json-query-many",
+            "queries": json_queries
+            })
+        return response["result"]
+
+    async def readiness(self):
+        response = await self.request({ "type": "readiness" })
+        return response["result"]
+
+    async def stats(self):
+        response = await self.request({ "type": "stats" })
+        return response["result"]
+
+    async def snapshot(self, path=None):
+        """See PandasSQLClient.snapshot()."""
+        request = { "type": "snapshot" }
+        if path is not None:
+            request["path"] = path
+        response = await self.request(request)
+        return response["result"]
+
+    async def batch(self, items, return_exceptions=False):
+        """See PandasSQLClient.batch()."""
+        response = await self.request({
+            "type": "batch",
+            "items": items
+            })
+        return batch_results(response["result"], return_exceptions, self._logger)
+
+    async def request(self, request):
+        assert isinstance(request, dict)
+        assert self._http is not None, "connect() must be called first."
+        request = dict(request, **{"client-id": self.client_id})
+        headers, body = encode_request(request, self._protocol, self._transport, self._codec,
+                                       self._compress_threshold)
+        for attempt in range(self._max_retries + 1):
+            # the shed requests come back with 503
+            r = await self._http.fetch(self._url, method='POST', headers=headers, body=body,
+                                       request_timeout=0, raise_error=False)
+            response = decode_response(r.body, r.headers.get('Content-Type'),
+                                       r.headers.get(ENCODING_HEADER))
+            try:
+                return check_response(response, self._logger)
+            except ServerOverloadedError as e:
+                if attempt == self._max_retries:
+                    raise
+                self._log(f"The server is overloaded; retries the request: {e}")
+                await asyncio.sleep(retry_delay(e, attempt))
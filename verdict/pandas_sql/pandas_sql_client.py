@@ -2,9 +2,15 @@ import json
 import logging
 import pickle
 import requests
+import time
 import types
 import uuid
+from requests.adapters import HTTPAdapter
+from .admission import ServerOverloadedError
 from .pandas_sql_server import PANDAS_SQL_DEFAULT_PORT
+from .protocol import ENCODING_HEADER, STREAM_CONTENT_TYPE, arrow_available, decode_response, \
+    decode_stream, encode_request, negotiate_codec, negotiate_protocol
+from .shm import create_probe, remove_segment
 
 
 
@@ -16,62 +22,348 @@ def init_logger():
     return pandas_sql_logger
 
 
+def check_response(response, logger):
+    """Raises the server-side error if the response reports one."""
+    if response["status"] == "overloaded":
+        raise ServerOverloadedError(response["result"], response["retry-after"])
+    if response["status"] == "error":
+        trace = response["result"]
+        e = response["error"]
+        logger.error(trace)
+        raise e
+    return response
+
+
+def batch_results(responses, return_exceptions, logger):
+    """@return  The results of the responses to the items of a batch"""
+    results = []
+    for response in responses:
+        try:
+            results.append(check_response(response, logger)["result"])
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+
+def retry_delay(error, attempt):
+    """The seconds to wait before the attempt-th retry (from 0) of a shed request."""
+    return error.retry_after * (2 ** attempt)
+
+
+def negotiate_compression(requested, server_codecs, server_address, transport):
+    """By default, the responses are compressed only for a server on another host.
+
+    @param requested  "lz4", "zstd", "none", or None (automatic)
+    @return  The codec; None for no compression
+    """
+    if requested is None:
+        host = server_address.rsplit(':', 1)[0].strip('[]')
+        if transport == 'shm' or host in ('localhost', '127.0.0.1', '::1'):
+            return None
+    return negotiate_codec(requested, server_codecs)
+
+
+def negotiate_transport(requested, protocol, shm_shared):
+    """
+    @param shm_shared  True if the server has seen the client's shared-memory probe
+    """
+    shm_possible = protocol == 'arrow' and shm_shared
+    if requested is None:
+        return 'shm' if shm_possible else 'http'
+    elif requested == 'shm' and not shm_possible:
+        raise ValueError("The shared memory is not available (requires the arrow protocol and "
+                         "a server on the same host).")
+    return requested
+
+
 class PandasSQLClient(object):
 
-    def __init__(self, server_address=f"localhost:{PANDAS_SQL_DEFAULT_PORT}"):
+    def __init__(self, server_address=f"localhost:{PANDAS_SQL_DEFAULT_PORT}", protocol=None,
+                 pool_size=32, transport=None, max_retries=3, compression=None,
+                 compress_threshold=None):
         """
         :param server_address:
             The listening server address in the following form: "host:port"
+        :param protocol:
+            "arrow" (binary; requires pyarrow on both sides) or "json" (JSON requests and pickled
+            responses). If None, the first one supported by both this client and the server.
+        :param pool_size:
+            The maximum number of the keep-alive connections kept to the server (i.e., the number
+            of the threads that can send requests concurrently without opening new connections).
+        :param transport:
+            "http" or "shm". With "shm" (only for the arrow protocol and a server on the same
+            host), the results are handed over through shared memory. If None, "shm" if possible.
+        :param max_retries:
+            The number of times a request shed by an overloaded server is retried (with an
+            exponential backoff) before ServerOverloadedError is raised.
+        :param compression:
+            "lz4" or "zstd" to let the server compress large responses with the codec, or "none".
+            If None, the first codec supported by both sides if the server is on another host.
+        :param compress_threshold:
+            The responses smaller than this (in bytes) are not compressed. If None, the server's
+            default.
         """
         client_id = 'client' + uuid.uuid4().hex[:8]
         self.client_id = client_id
         self._logger = init_logger()
+        self._max_retries = max_retries
+
+        self._session = requests.Session()
+        self._session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
 
-        # connect to remote server
+        # connect to remote server; the ping is always in json so that any server understands it
         self._url = f'http://{server_address}'
+        self._protocol = 'json'
+        self._transport = 'http'
+        self._codec = None
+        self._compress_threshold = compress_threshold
+        ping = { "type": "ping" }
+        if arrow_available() and transport != 'http':
+            ping["shm-probe"] = create_probe()
         try:
-            response = self.request({
-                "type": "ping"
-            })
+            response = self.request(ping)
         except requests.exceptions.RequestException:
             msg = f"Failed to connect to the Pandas SQL server ({server_address})."
             raise ValueError(msg) from None
+        finally:
+            if "shm-probe" in ping:
+                remove_segment(ping["shm-probe"])
+
+        # old servers only speak json
+        self._protocol = negotiate_protocol(protocol, response.get("protocols", ['json']))
+        self._transport = negotiate_transport(transport, self._protocol, response.get("shm", False))
+        self._codec = negotiate_compression(compression, response.get("codecs", []),
+                                            server_address, self._transport)
+        self._log(f"Uses the {self._protocol} protocol over {self._transport} "
+                  f"(compression: {self._codec}).")
 
     def _log(self, msg):
         self._logger.debug(msg)
 
-    def load_table(self, table_name, file_path, if_not_exists=True):
+    def close(self):
+        """Closes the pooled connections."""
+        self._session.close()
+
+    def load_table(self, table_name, file_path, if_not_exists=True, part_col=None,
+                   replicate=False, replace=False, lazy=False):
         """
+        :param part_col:
+            Only for the sharded server. If set, the table is hash-partitioned on this column.
+        :param replicate:
+            Only for the sharded server. If True, every shard holds a full copy of the table.
+        :param replace:
+            If True, an existing table is replaced by the loaded one. The server keeps answering
+            the queries on the table with its old version until the new one is swapped in.
+        :param lazy:
+            If True and the file is a columnar directory, the server reads each column when a query
+            first references it (ignored by the sharded and the pre-fork servers).
+
         return:
             The number of rows in the loaded table.
         """
-        response = self.request({
+        request = {
             "type": "load-table",
             "table-name": table_name,
             "file-path": file_path,
             "if-not-exists": if_not_exists,
-            })
+            }
+        if part_col is not None:
+            request["part-col"] = part_col
+        if replicate:
+            request["replicate"] = replicate
+        if replace:
+            request["replace"] = replace
+        if lazy:
+            request["lazy"] = lazy
+        response = self.request(request)
         return response["result"]
 
-    def execute(self, json_query):
+    def drop_table(self, table_name, if_exists=True):
+        """The queries in flight on the table finish on it."""
+        self.request({
+            "type": "drop-table",
+            "table-name": table_name,
+            "if-exists": if_exists,
+            })
+
+    def create_cube(self, table_name, dims):
+        """
+        return:
+            The number of rows in the cube (0 if the table has not been loaded yet).
+        """
         response = self.request({
+            "type": "create-cube",
+            "table-name": table_name,
+            "dims": list(dims),
+            })
+        return response["result"]
+
+    def drop_cube(self, table_name, dims=None):
+        request = {
+            "type": "drop-cube",
+            "table-name": table_name,
+            }
+        if dims is not None:
+            request["dims"] = list(dims)
+        self.request(request)
+
+    def advisor_report(self):
+        """
+        return:
+            The workload, the structures, and the decisions of the server's index advisor.
+        """
+        response = self.request({ "type": "advisor-report" })
+        return response["result"]
+
+    def execute(self, json_query, fraction=None, priority=None):
+        """
+        args:
+            fraction: If not None, the server only processes this fraction of the rows of each
+                table (i.e., the first rows).
+            priority: "interactive" (default), "stream", or "load". The server processes the
+                waiting requests of a higher priority first.
+        """
+        request = {
             "type": "json-query",
             "query": json_query
+            }
+        if fraction is not None:
+            request["fraction"] = fraction
+        if priority is not None:
+            request["priority"] = priority
+        response = self.request(request)
+        return response["result"]
+
+    def execute_stream(self, json_query, chunk_rows=None, fraction=None, priority=None):
+        """Executes a query whose result is sent in chunks as they are encoded, so that neither
+        the server nor this client holds the whole encoded result.
+
+        args:
+            chunk_rows: The number of rows in each chunk. If None, the server's default.
+            fraction: See execute().
+            priority: See execute(). The default is "stream".
+
+        return:
+            An iterator of DataFrames, the consecutive chunks of the result. The server's error
+            is raised when reached. Closing the iterator early closes the connection.
+        """
+        request = {
+            "type": "json-query-stream",
+            "query": json_query
+            }
+        if chunk_rows is not None:
+            request["chunk-rows"] = chunk_rows
+        if fraction is not None:
+            request["fraction"] = fraction
+        if priority is not None:
+            request["priority"] = priority
+        r = self._send(request, stream=True)
+        return self._read_stream(r)
+
+    def _read_stream(self, r):
+        try:
+            for response in decode_stream(r.raw.read):
+                response = check_response(response, self._logger)
+                if response["type"] == "end":
+                    return
+                yield response["result"]
+            raise ValueError("The streamed response ended before the end of the result.")
+        finally:
+            r.close()
+
+    def execute_many(self, json_queries):
+        """Executes a batch of queries in a single request. The server shares the scans over the
+        same source tables.
+
+        return:
+            A list of results in the same order as the queries.
+        """
+        response = self.request({
+            "type": "json-query-many",
+            "queries": json_queries
             })
         return response["result"]
 
+    def readiness(self):
+        """
+        return:
+            The progress of loading the cache files at the server's startup, e.g.,
+            { "ready": bool, "total": int, "loaded": int, "pending": int, "loading": [names],
+              "failed": { name: error }, "elapsed": seconds }
+        """
+        response = self.request({ "type": "readiness" })
+        return response["result"]
+
+    def stats(self):
+        """
+        return:
+            The server's request latencies, in-flight and queued requests, tables (row counts
+            and memory usage), resident memory, and table load times.
+        """
+        response = self.request({ "type": "stats" })
+        return response["result"]
+
+    def snapshot(self, path=None):
+        """Writes the server's tables, cubes, and indexes into a snapshot that a restarted server
+        maps instead of loading the cache files (see the server's --snapshot-dir).
+
+        :param path:
+            The snapshot directory on the server's host. If None, the server's --snapshot-dir.
+
+        return:
+            { "path": str, "tables": int, "seconds": float }
+        """
+        request = { "type": "snapshot" }
+        if path is not None:
+            request["path"] = path
+        response = self.request(request)
+        return response["result"]
+
+    def batch(self, items, return_exceptions=False):
+        """Sends many requests at once. The consecutive "json-query" items are executed together,
+        sharing the scans over the same tables; the other items (e.g., "load-table") are executed
+        in order between them.
+
+        :param items:
+            A list of requests, e.g., { "type": "json-query", "query": json_query }
+        :param return_exceptions:
+            If True, a failed item's exception is placed in the returned list instead of being
+            raised.
+
+        return:
+            A list of results in the same order as the items.
+        """
+        response = self.request({
+            "type": "batch",
+            "items": items
+            })
+        return batch_results(response["result"], return_exceptions, self._logger)
+
     def request(self, request):
+        return self._send(request)
+
+    def _send(self, request, stream=False):
+        """
+        :param stream:
+            If True, a streamed response is returned as the requests.Response, unread.
+        """
         assert isinstance(request, dict)
-        r = requests.post(url=self._url, data=json.dumps(request))
-        response_pickled = r.content
-        response = pickle.loads(response_pickled)
-
-        # error check
-        if response["status"] == "error":
-            trace = response["result"]
-            e = response["error"]
-            self._logger.error(trace)
-            raise e
-
-        return response
+        request = dict(request, **{"client-id": self.client_id})
+        headers, body = encode_request(request, self._protocol, self._transport, self._codec,
+                                       self._compress_threshold)
+        for attempt in range(self._max_retries + 1):
+            r = self._session.post(url=self._url, data=body, headers=headers, stream=stream)
+            if r.headers.get('Content-Type') == STREAM_CONTENT_TYPE:
+                return r
+            response = decode_response(r.content, r.headers.get('Content-Type'),
+                                       r.headers.get(ENCODING_HEADER))
+            try:
+                return check_response(response, self._logger)
+            except ServerOverloadedError as e:
+                if attempt == self._max_retries:
+                    raise
+                self._log(f"The server is overloaded; retries the request: {e}")
+                time.sleep(retry_delay(e, attempt))
 
@@ -0,0 +1,268 @@
+"""PandasSQL for the worker processes of the pre-fork Pandas SQL server.
+
+Every worker maps the same columnar table files (see columnar.py) read-only, so the plain columns
+(numbers, booleans, and timestamps) are held in memory once (in the OS page cache) regardless of
+the number of workers. The string columns are not shared: each worker decodes their dictionaries
+into its own object arrays, since the engine expects them as object columns. A request that changes
+the tables (e.g., load-table) reaches only one worker; that worker writes the table in the
+columnar format and records the change in a catalog file shared by the workers. Every worker
+brings its tables up to date with the catalog before serving a request. A worker holds the
+directories of its tables (see columnar.hold_table_dir()), so a replaced or dropped directory is
+removed by the last worker that releases it.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import threading
+import uuid
+from .columnar import (hold_table_dir, is_columnar, read_columnar, read_table_file,
+                       remove_unheld_dir, write_columnar)
+from .pandas_sql import PandasSQL
+
+
+class SharedCatalog(object):
+    """The tables (and the cube declarations) shared by the workers.
+
+    catalog.json: {
+        "version": int,
+        "tables": { table name: columnar directory },
+        "cubes": { table name: [ [dim, ...], ... ] }
+    }
+
+    :param data_dir:  The directory holding the catalog and the columnar tables written by workers
+    """
+
+    def __init__(self, data_dir):
+        os.makedirs(data_dir, exist_ok=True)
+        self.data_dir = data_dir
+        self._path = os.path.join(data_dir, 'catalog.json')
+        self._lock_path = os.path.join(data_dir, 'catalog.lock')
+
+    def read(self):
+        if not os.path.exists(self._path):
+            return { "version": 0, "tables": {}, "cubes": {} }
+        with open(self._path, 'r') as f:
+            return json.load(f)
+
+    def version(self):
+        """A cheap check for changes; every update replaces the file."""
+        try:
+            stat = os.stat(self._path)
+            return (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+    def update(self, change):
+        """Applies the change under an exclusive lock.
+
+        @param change  A function that modifies the catalog (dict) in place and returns a value
+        @return  The value returned by change
+        """
+        with open(self._lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                catalog = self.read()
+                result = change(catalog)
+                catalog["version"] += 1
+                temp_path = self._path + '.' + uuid.uuid4().hex
+                with open(temp_path, 'w') as f:
+                    json.dump(catalog, f)
+                os.replace(temp_path, self._path)
+                return result
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def new_table_dir(self, table_name):
+        return os.path.join(self.data_dir, f'{table_name}-{uuid.uuid4().hex}')
+
+
+class PreforkPandasSQL(object):
+    """
+    :param data_dir:  The directory of the SharedCatalog
+    """
+
+    def __init__(self, data_dir, log_dir=None):
+        self._pandas_sql = PandasSQL(log_dir)
+        self._catalog = SharedCatalog(data_dir)
+        self._catalog_version = -1
+        self._sync_lock = threading.Lock()
+        self._table_dirs = {}       # table name -> columnar directory
+        self._held_fds = {}         # table name -> the fd holding its directory
+        self._cube_dims = {}        # table name -> a list of sorted dims
+
+    def _log(self, msg):
+        self._pandas_sql._log(msg)
+
+    def sync(self):
+        """Brings the local tables and cubes up to date with the shared catalog."""
+        if self._catalog.version() == self._catalog_version:
+            return
+        with self._sync_lock:
+            self._sync()
+
+    def _sync(self):
+        version = self._catalog.version()
+        if version == self._catalog_version:
+            return
+        catalog = self._catalog.read()
+        engine = self._pandas_sql
+        for name in list(self._table_dirs):
+            if name not in catalog["tables"]:
+                engine.drop_table(name)
+                self._release_dir(name)
+                del self._table_dirs[name]
+        for name, table_dir in catalog["tables"].items():
+            if self._table_dirs.get(name) != table_dir:
+                # a new table or a new version (swapped in atomically)
+                try:
+                    version_dir, fd = hold_table_dir(table_dir)
+                except FileNotFoundError:
+                    # dropped by another worker meanwhile; the next sync sees it
+                    self._log(f"The table, {name}, is gone while syncing.")
+                    continue
+                try:
+                    engine.register_table(name, read_columnar(version_dir), replace=True)
+                except BaseException:
+                    os.close(fd)
+                    raise
+                self._release_dir(name)
+                self._table_dirs[name] = table_dir
+                self._held_fds[name] = fd
+        for name in set(self._cube_dims) | set(catalog["cubes"]):
+            declared = catalog["cubes"].get(name, [])
+            for dims in self._cube_dims.get(name, []):
+                if dims not in declared:
+                    engine.drop_cube(name, dims)
+            for dims in declared:
+                engine.create_cube(name, dims)
+            self._cube_dims[name] = declared
+        self._catalog_version = version
+        self._log(f"Synced with the catalog (version {catalog['version']}).")
+
+    def drop_all_tables(self):
+        def change(catalog):
+            dirs = list(catalog["tables"].values())
+            catalog["tables"] = {}
+            return dirs
+        self._remove_dirs(self._catalog.update(change))
+        self.sync()
+
+    def columns(self, name):
+        self.sync()
+        return self._pandas_sql.columns(name)
+
+    def load_table(self, table_name, file_path, if_not_exists=False, replace=False):
+        """Loads a table from a columnar directory (used as is) or from a pickled DataFrame
+        (converted into the columnar format).
+
+        @param replace  If True, an existing table is replaced; every worker swaps in the new
+                        version when it syncs.
+        """
+        self.sync()
+        if table_name in self._table_dirs and not replace:
+            if if_not_exists:
+                return len(self._pandas_sql.get_df(table_name).index)
+            raise ValueError(f"The specified table, {table_name}, already exists.")
+        if is_columnar(file_path):
+            self._add_table(table_name, file_path, owned=False, replace=replace)
+        else:
+            self.register_table(table_name, read_table_file(file_path), replace)
+        return len(self._pandas_sql.get_df(table_name).index)
+
+    def register_table(self, table_name, frame, replace=False):
+        table_dir = self._catalog.new_table_dir(table_name)
+        write_columnar(frame, table_dir)
+        self._add_table(table_name, table_dir, owned=True, replace=replace)
+
+    def _add_table(self, table_name, table_dir, owned, replace=False):
+        def change(catalog):
+            old_dir = catalog["tables"].get(table_name)
+            if old_dir is not None and not replace:
+                return False, None
+            catalog["tables"][table_name] = table_dir
+            return True, old_dir
+        added, old_dir = self._catalog.update(change)
+        if not added:
+            if owned:
+                shutil.rmtree(table_dir, ignore_errors=True)
+            raise ValueError(f"The table name ({table_name}) already exists.")
+        self.sync()
+        if old_dir != table_dir:
+            self._remove_dirs([old_dir])
+
+    def drop_table(self, name, if_exists=False):
+        def change(catalog):
+            return catalog["tables"].pop(name, None)
+        table_dir = self._catalog.update(change)
+        if table_dir is None and if_exists == False:
+            raise ValueError(f"The specified table, {name}, does not exist.")
+        self._remove_dirs([table_dir])
+        self.sync()
+
+    def _release_dir(self, name):
+        """Releases the directory held for the table, and removes it if no other worker holds it
+        and the catalog no longer refers to it."""
+        fd = self._held_fds.pop(name, None)
+        if fd is None:
+            return
+        os.close(fd)
+        self._remove_dirs([self._table_dirs[name]])
+
+    def _remove_dirs(self, table_dirs):
+        """Removes the directories written by the workers unless a worker still holds them; the
+        last worker that releases one removes it (see _release_dir())."""
+        for table_dir in table_dirs:
+            if table_dir is not None and \
+                    os.path.dirname(table_dir) == self._catalog.data_dir:
+                remove_unheld_dir(table_dir,
+                                  lambda: table_dir in self._catalog.read()["tables"].values())
+
+    def create_cube(self, table_name, dims):
+        dims = sorted(dims)
+        def change(catalog):
+            declared = catalog["cubes"].setdefault(table_name, [])
+            if dims not in declared:
+                declared.append(dims)
+        self._catalog.update(change)
+        self.sync()
+        return self._pandas_sql.create_cube(table_name, dims)
+
+    def drop_cube(self, table_name, dims=None):
+        def change(catalog):
+            if dims is None:
+                catalog["cubes"].pop(table_name, None)
+            elif sorted(dims) in catalog["cubes"].get(table_name, []):
+                catalog["cubes"][table_name].remove(sorted(dims))
+        self._catalog.update(change)
+        self.sync()
+
+    def cubes(self, table_name):
+        self.sync()
+        return self._pandas_sql.cubes(table_name)
+
+    def start_advisor(self, memory_budget, interval=10):
+        """Each worker runs its own advisor over its own workload."""
+        self._pandas_sql.start_advisor(memory_budget, interval)
+
+    def advisor_report(self):
+        return self._pandas_sql.advisor_report()
+
+    def table_version(self, table_name):
+        """The version in this worker; it increases when the worker maps a replaced table."""
+        self.sync()
+        return self._pandas_sql.table_version(table_name)
+
+    def table_stats(self):
+        """The memory of the memory-mapped columns is counted in every worker."""
+        self.sync()
+        return self._pandas_sql.table_stats()
+
+    def execute(self, query, fraction=None):
+        self.sync()
+        return self._pandas_sql.execute(query, fraction)
+
+    def execute_many(self, queries, return_exceptions=False):
+        self.sync()
+        return self._pandas_sql.execute_many(queries, return_exceptions)
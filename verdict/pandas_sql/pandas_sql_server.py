@@ -1,33 +1,76 @@
 import asyncio
 import argparse
-import concurrent.futures
+import hashlib
 import json
+import math
 import os
 import pandas as pd
 import pickle
 import psutil
 import time
 import traceback
-from threading import Thread
-from tornado.ioloop import IOLoop
+from threading import Event, Thread
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
 from tornado.web import Application, RequestHandler
+from verdict.common.singleflight import SingleFlight
+from verdict.core.relobj import find_base_tables
+from verdict.interface import from_verdict_query
+from .admission import AdmissionController, ServerOverloadedError, request_priority
+from .metrics import METRICS_CONTENT_TYPE, ServerMetrics, format_metrics
 from .pandas_sql import PandasSQL, init_logger
+from .pandas_sql_prefork import PreforkPandasSQL
+from .pandas_sql_shard import ShardedPandasSQL
+from .preload import PRELOAD_ORDERS, CachePreloader, table_name_of
+from .protocol import ENCODING_HEADER, STREAM_CONTENT_TYPE, TRANSPORT_HEADER, accepted_codec, \
+    available_codecs, compress, decode_request, encode_response, stream_message_header, \
+    supported_protocols
+from .shm import is_segment_path, segment_registry
+from .snapshot import Snapshot, is_snapshot, write_snapshot
 
 
 PANDAS_SQL_DEFAULT_PORT = 7871
 
-executor = concurrent.futures.ThreadPoolExecutor(1000)
+# The number of rows in each chunk of a streamed result unless the request specifies it
+DEFAULT_CHUNK_ROWS = 65536
+
+# The file in the data directory holding the pid of the pre-fork parent process
+PREFORK_PID_FILE = 'server.pid'
+
+admission_controller = [AdmissionController()]
 
 pandas_sql_instance = [PandasSQL()]
 
+server_metrics = ServerMetrics()
+
+# The identical queries in flight share a single execution (see execute_query())
+query_flights = SingleFlight()
+
 pandas_sql_server_logger = init_logger()
 
 running_server_instance = []
 
+running_server_thread = []
+
 # A list of full file path. The file name (excluding the dir) will be the name of the table.
 # The file must be a pickled pandas DataFrame.
 cache_to_load = []
 
+# How the files in cache_to_load are loaded (see CachePreloader)
+preload_options = { "workers": 4, "order": 'mru' }
+
+preloader_instance = [None]
+
+# The snapshot restored at startup and written by the "snapshot" requests (see snapshot.py)
+snapshot_options = { "dir": None }
+
+# If "lazy" is True, the columns of the preloaded columnar tables are read on first use (see
+# lazy.py); the columns unused for "idle-seconds" (if positive) are dropped periodically.
+column_options = { "lazy": False, "idle-seconds": 0 }
+
 
 def pandas_server_log(msg, level="debug"):
     if level == "debug":
@@ -40,25 +83,215 @@ def get_pandas_sql():
     return pandas_sql_instance[0]
 
 
+def get_admission_controller():
+    return admission_controller[0]
+
+
+def preload_progress():
+    preloader = preloader_instance[0]
+    if preloader is None:
+        return { "ready": True, "total": 0, "loaded": 0, "failed": {}, "loading": [],
+                 "pending": 0, "elapsed": 0.0 }
+    return preloader.progress()
+
+
+def wait_for_tables(queries):
+    """Loads (or waits for) the tables of the queries that are still being preloaded."""
+    preloader = preloader_instance[0]
+    if preloader is None or preloader.progress()["ready"]:
+        return
+    names = set()
+    for query in queries:
+        try:
+            tables = find_base_tables(from_verdict_query(query), include_samples=True)
+        except Exception:
+            # an invalid query fails when it is executed
+            continue
+        names.update(t.name() for t in tables)
+    preloader.ensure_loaded(names)
+
+
+def query_key(query, fraction=None):
+    """
+    @return  The canonical hash of the query and the current versions of its tables; None if the
+             query is invalid
+    """
+    try:
+        tables = find_base_tables(from_verdict_query(query), include_samples=True)
+    except Exception:
+        return None
+    pandas_sql = get_pandas_sql()
+    versions = sorted({(t.name(), pandas_sql.table_version(t.name())) for t in tables})
+    canonical = json.dumps([query, fraction, versions], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def execute_query(query, fraction=None):
+    """Executes the query once for all the identical queries in flight; they get the same result.
+    A replaced table changes the key, so the queries arriving after a swap are not coalesced with
+    the ones running on the old version.
+    """
+    key = query_key(query, fraction)
+    if key is None:
+        return get_pandas_sql().execute(query, fraction)
+    return query_flights.do(key, lambda: get_pandas_sql().execute(query, fraction))
+
+
+def compress_body(body, codec, threshold):
+    """Compresses the response body if it is large enough and compression pays off.
+
+    @return  (body, the codec used; None if not compressed)
+    """
+    if codec is None or len(body) < threshold:
+        server_metrics.response_sent(None, len(body), len(body), 0.0)
+        return body, None
+    start_time = time.time()
+    compressed = compress(body, codec)
+    seconds = time.time() - start_time
+    if len(compressed) >= len(body):
+        server_metrics.response_sent(None, len(body), len(body), seconds)
+        return body, None
+    server_metrics.response_sent(codec, len(body), len(compressed), seconds)
+    return compressed, codec
+
+
+def server_stats():
+    return server_metrics.stats(get_admission_controller().stats(),
+                                get_pandas_sql().table_stats(), preload_progress(),
+                                query_flights.stats())
+
+
+class MetricsHandler(RequestHandler):
+    """Serves the metrics in plain text for scrapers."""
+
+    async def get(self):
+        stats = await IOLoop.current().run_in_executor(None, server_stats)
+        self.set_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.write(format_metrics(stats))
+
+
 class PandasSQLHandler(RequestHandler):
 
     async def post(self):
-        request = json.loads(self.request.body)
+        server_metrics.request_started()
+        start_time = time.time()
+        request_type, status = "unknown", "error"
+        try:
+            request_type, status = await self.process()
+        finally:
+            server_metrics.request_finished(request_type, status, time.time() - start_time)
+
+    async def process(self):
+        """@return  (request type, response status)"""
+        request = decode_request(self.request.body, self.request.headers.get('Content-Type'))
+        accept = self.request.headers.get('Accept')
+        transport = self.request.headers.get(TRANSPORT_HEADER)
+        codec, threshold = accepted_codec(self.request.headers)
         pandas_server_log(f'PandasDB server received a request: {request}')
+        status = "ok"
+        encoding = None
+        streamed = request["type"] == "json-query-stream"
+
+        def job():
+            if streamed:
+                # only the result is computed here; its chunks are encoded while being sent
+                return self.execute_stream(request)
+            content_type, body = encode_response(self.execute(request), accept, transport)
+            return (content_type,) + compress_body(body, codec, threshold)
+
         try:
-            result = await IOLoop.current().run_in_executor(executor, self.execute, request)
-            response = pickle.dumps(result)
-            self.write(response)
+            priority = request_priority(request)
+            if priority is None:
+                # cheap requests (e.g., ping) are answered even when overloaded
+                result = await IOLoop.current().run_in_executor(None, job)
+            else:
+                client = request.get('client-id', self.request.remote_ip)
+                future = get_admission_controller().submit(job, priority, client)
+                result = await asyncio.wrap_future(future)
+            if streamed:
+                chunk_rows = request.get('chunk-rows', DEFAULT_CHUNK_ROWS)
+                status = await self.write_stream(result, chunk_rows, accept, transport, codec,
+                                                 threshold)
+                return request["type"], status
+            content_type, response, encoding = result
+        except ServerOverloadedError as e:
+            status = "overloaded"
+            pandas_server_log(f"Shed a request: {e}")
+            self.set_status(503)
+            self.set_header('Retry-After', str(math.ceil(e.retry_after)))
+            content_type, response = encode_response({
+                "status": "overloaded",
+                "type": "status",
+                "result": str(e),
+                "retry-after": e.retry_after,
+                }, accept)
         except Exception as e:
+            status = "error"
             var = traceback.format_exc()
             pandas_server_log(f"{var}", "error")
-            response = pickle.dumps({
+            content_type, response = encode_response({
                 "status": "error",
                 "type": "result",
                 "result": var,
                 "error": e,
-                })
-            self.write(response)
+                }, accept)
+        self.set_header('Content-Type', content_type)
+        if encoding is not None:
+            self.set_header(ENCODING_HEADER, encoding)
+        self.write(response)
+        return request["type"], status
+
+    async def write_stream(self, result, chunk_rows, accept, transport, codec, threshold):
+        """Sends the result in chunks of chunk_rows rows, each as a response of the "chunk" type,
+        followed by a response of the "end" type (or an error). A chunk is encoded only after the
+        previous one has been sent, so the encoded result is never held as a whole.
+
+        @return  The response status
+        """
+        assert chunk_rows > 0
+        self.set_header('Content-Type', STREAM_CONTENT_TYPE)
+
+        def encode_message(response):
+            content_type, body = encode_response(response, accept, transport)
+            body, encoding = compress_body(body, codec, threshold)
+            return stream_message_header(content_type, body, encoding), body
+
+        async def send(response):
+            header, body = await IOLoop.current().run_in_executor(None, encode_message, response)
+            self.write(header)
+            self.write(body)
+            await self.flush()
+
+        status = "ok"
+        try:
+            # an empty result is sent as an empty chunk to carry its columns
+            for start in range(0, max(len(result), 1), chunk_rows):
+                chunk = result.iloc[start:start + chunk_rows]
+                await send({ "status": "ok", "type": "chunk", "result": chunk })
+            end = { "status": "ok", "type": "end", "result": len(result) }
+        except StreamClosedError:
+            pandas_server_log("The client closed the streamed response.")
+            return "closed"
+        except Exception as e:
+            status = "error"
+            var = traceback.format_exc()
+            pandas_server_log(f"{var}", "error")
+            end = { "status": "error", "type": "result", "result": var, "error": e }
+        try:
+            await send(end)
+        except StreamClosedError:
+            return "closed"
+        return status
+
+    def execute_stream(self, request):
+        """@return  The result of the query of a "json-query-stream" request"""
+        assert 'query' in request
+        query = request['query']
+        wait_for_tables([query])
+        result = execute_query(query, request.get('fraction'))
+        if not isinstance(result, pd.DataFrame):
+            raise ValueError(f"Not a streamable result: {type(result).__name__}")
+        return result
 
 
     def execute(self, request):
@@ -69,11 +302,18 @@ class PandasSQLHandler(RequestHandler):
         request_type = request["type"]
 
         if request_type == "ping":
-            return { 
+            response = { 
                 "status": "ok",
                 "type": "result",
                 "result": "pong",
+                "protocols": supported_protocols(),
+                "codecs": available_codecs(),
             }
+            if 'shm-probe' in request:
+                # the client created this file; if we see it, we share the memory
+                probe = request['shm-probe']
+                response["shm"] = is_segment_path(probe) and os.path.exists(probe)
+            return response
 
         elif request_type == "load-table":
             assert 'file-path' in request
@@ -81,8 +321,20 @@ class PandasSQLHandler(RequestHandler):
             table_name = request['table-name']
             file_path = request['file-path']
             if_not_exists = request['if-not-exists']
+            # Partitioning options only apply to the sharded mode
+            options = {}
+            if 'part-col' in request:
+                options['part_col'] = request['part-col']
+            if 'replicate' in request:
+                options['replicate'] = request['replicate']
+            if request.get('replace', False):
+                options['replace'] = True
+            if request.get('lazy', False) and supports_lazy_columns(get_pandas_sql()):
+                options['lazy'] = True
+            start_time = time.time()
             row_count = get_pandas_sql().load_table(table_name, file_path, 
-                                                    if_not_exists=if_not_exists)
+                                                    if_not_exists=if_not_exists, **options)
+            server_metrics.table_loaded(table_name, time.time() - start_time, row_count)
             pandas_server_log(f"The requested table has been loaded: {table_name}.")
             return {
                 "status": "ok",
@@ -93,75 +345,321 @@ class PandasSQLHandler(RequestHandler):
         elif request_type == "drop-table":
             assert 'table-name' in request
             table_name = request['table-name']
-            get_pandas_sql().drop_table(table_name, if_exists=True)
+            get_pandas_sql().drop_table(table_name, if_exists=request.get('if-exists', True))
             return {
                 "status": "ok",
                 "type": "status",
                 "result": "ok"
             }
 
+        elif request_type == "create-cube":
+            assert 'table-name' in request
+            assert 'dims' in request
+            row_count = get_pandas_sql().create_cube(request['table-name'], request['dims'])
+            return {
+                "status": "ok",
+                "type": "result",
+                "result": row_count
+            }
+
+        elif request_type == "drop-cube":
+            assert 'table-name' in request
+            get_pandas_sql().drop_cube(request['table-name'], request.get('dims'))
+            return {
+                "status": "ok",
+                "type": "status",
+                "result": "ok"
+            }
+
+        elif request_type == "readiness":
+            return {
+                "status": "ok",
+                "type": "result",
+                "result": preload_progress()
+            }
+
+        elif request_type == "stats":
+            return {
+                "status": "ok",
+                "type": "result",
+                "result": server_stats()
+            }
+
+        elif request_type == "snapshot":
+            path = request.get('path', snapshot_options["dir"])
+            if path is None:
+                raise ValueError("No snapshot directory is given.")
+            start_time = time.time()
+            manifest = write_snapshot(get_pandas_sql(), path)
+            pandas_server_log(f"Wrote a snapshot of {len(manifest['tables'])} tables to {path}.")
+            return {
+                "status": "ok",
+                "type": "result",
+                "result": {
+                    "path": path,
+                    "tables": len(manifest["tables"]),
+                    "seconds": time.time() - start_time,
+                }
+            }
+
+        elif request_type == "advisor-report":
+            return {
+                "status": "ok",
+                "type": "result",
+                "result": get_pandas_sql().advisor_report()
+            }
+
         elif request_type == "json-query":
             assert 'query' in request
             query = request['query']
+            wait_for_tables([query])
             return {
                 "status": "ok",
                 "type": "result",
-                "result": get_pandas_sql().execute(query)
+                "result": execute_query(query, request.get('fraction'))
+            }
+
+        elif request_type == "json-query-many":
+            assert 'queries' in request
+            queries = request['queries']
+            wait_for_tables(queries)
+            return {
+                "status": "ok",
+                "type": "result",
+                "result": get_pandas_sql().execute_many(queries)
+            }
+
+        elif request_type == "batch":
+            assert 'items' in request
+            return {
+                "status": "ok",
+                "type": "result",
+                "result": self.execute_batch(request['items'])
             }
 
         else:
             raise ValueError(request_type)
 
+    def execute_batch(self, items):
+        """Executes the items (requests of the other types) in order, except that the consecutive
+        json-query items are executed together, sharing their scans (see PandasSQL.execute_many).
+
+        @return  A list of responses (one for each item, in the same order). A failed item has the
+                 "error" status; it does not affect the other items.
+        """
+        responses = [None] * len(items)
+        queries = []        # (index, query) of the consecutive json-query items
+
+        def error_response(e, trace):
+            return { "status": "error", "type": "result", "result": trace, "error": e }
+
+        def flush_queries():
+            if len(queries) == 0:
+                return
+            pandas_sql = get_pandas_sql()
+            wait_for_tables([q for _, q in queries])
+            try:
+                results = pandas_sql.execute_many([q for _, q in queries], return_exceptions=True)
+            except Exception:
+                # an invalid query fails the whole batch; executes them one by one instead
+                results = []
+                for _, query in queries:
+                    try:
+                        results.append(pandas_sql.execute(query))
+                    except Exception as e:
+                        results.append(e)
+            for (i, _), result in zip(queries, results):
+                if isinstance(result, Exception):
+                    responses[i] = error_response(result, f"{type(result).__name__}: {result}")
+                else:
+                    responses[i] = { "status": "ok", "type": "result", "result": result }
+            queries.clear()
+
+        for i, item in enumerate(items):
+            if item.get("type") == "json-query" and 'fraction' not in item and 'query' in item:
+                queries.append((i, item['query']))
+                continue
+            flush_queries()
+            try:
+                if item.get("type") in ("batch", "ping", "json-query-stream"):
+                    raise ValueError(f"{item.get('type')} is not allowed in a batch.")
+                responses[i] = self.execute(item)
+            except Exception as e:
+                responses[i] = error_response(e, traceback.format_exc())
+        flush_queries()
+        return responses
+
+
+def supports_lazy_columns(engine):
+    """Only the in-process engine (PandasSQL) loads the columns lazily."""
+    return hasattr(engine, 'evict_cold_columns')
+
+
+def load_cache_files(wait=False):
+    """Loads the pre-specified cache files in parallel.
+
+    @param wait  If False, the files are loaded in the background while the server serves
+    """
+    files = {table_name_of(p): p for p in cache_to_load}
+    load = None
+    load_options = {}
+    if column_options["lazy"] and supports_lazy_columns(get_pandas_sql()):
+        load_options["lazy"] = True
+        def load(name, path):
+            return get_pandas_sql().load_table(name, path, if_not_exists=True, lazy=True)
+    snapshot_dir = snapshot_options["dir"]
+    if snapshot_dir is not None and is_snapshot(snapshot_dir):
+        snapshot = Snapshot(snapshot_dir)
+        snapshot_paths = {}
+        for name, path in snapshot.table_paths().items():
+            # a cache file written after the snapshot is newer
+            cache_file = files.get(name)
+            if cache_file is None or os.path.getmtime(cache_file) <= snapshot.manifest["created"]:
+                snapshot_paths[name] = path
+        files.update(snapshot_paths)
+        pandas_sql = get_pandas_sql()
+        if hasattr(pandas_sql, 'restore_table'):
+            def load(name, path):
+                if pandas_sql.table_version(name) is not None:
+                    return len(pandas_sql.get_df(name).index)
+                if snapshot_paths.get(name) == path:
+                    return snapshot.restore_table(pandas_sql, name)
+                return pandas_sql.load_table(name, path, if_not_exists=True, **load_options)
+        # otherwise, the engine loads the columnar directories of the snapshot as tables
+        pandas_server_log(f"Restores {len(snapshot_paths)} tables from the snapshot in "
+                          f"{snapshot_dir}.")
+
+    pandas_server_log(f"Starts to load {len(files)} cache files...")
+    preloader = CachePreloader(get_pandas_sql(), files, preload_options["workers"],
+                               preload_options["order"], server_metrics.table_loaded,
+                               pandas_sql_server_logger, load)
+    preloader_instance[0] = preloader
+    if wait:
+        preloader.run()
+        pandas_server_log(f"Finished loading cache.")
+    else:
+        preloader.start()
+
 
-def start_app(port, new_even_loop=False):
+def start_app(port, new_even_loop=False, started=None, sockets=None):
+    """
+    @param started  If not None, this threading.Event is set once the server starts listening.
+    @param sockets  If not None, the server accepts connections on these (already bound) sockets
+                    instead of listening on the port.
+    """
     if new_even_loop:
         asyncio.set_event_loop(asyncio.new_event_loop())
-    app = Application([ (r".*", PandasSQLHandler), ])
-    app.listen(port)
+    app = Application([ (r"/metrics", MetricsHandler), (r".*", PandasSQLHandler), ])
+    if sockets is None:
+        http_server = app.listen(port)
+    else:
+        http_server = HTTPServer(app)
+        http_server.add_sockets(sockets)
     server_instance = IOLoop.current()
 
-    # Load cache files if necessary
-    pandas_sql = get_pandas_sql()
-    pandas_server_log(f"Starts to load cache files...")
-    # Load pre-specified cache files.
-    for cache_file in cache_to_load:
-        name = os.path.basename(cache_file)
-        name = name.split('.')[-1]
-        pandas_sql.load_table(name, cache_file)
-    pandas_server_log(f"Finished loading cache.")
+    # Load cache files in the background if necessary (the pre-fork workers share the tables
+    # loaded before forking)
+    if sockets is None:
+        load_cache_files()
+    idle_seconds = column_options["idle-seconds"]
+    if idle_seconds > 0 and supports_lazy_columns(get_pandas_sql()):
+        def evict():
+            IOLoop.current().run_in_executor(None, get_pandas_sql().evict_cold_columns,
+                                             idle_seconds)
+        PeriodicCallback(evict, idle_seconds * 1000).start()
 
     # Only one server instance is allowed per process
     pandas_server_log(f"Starts Pandas SQL server, listening on {port}.")
     assert len(running_server_instance) == 0
     running_server_instance.append(server_instance)
+    if started is not None:
+        server_instance.add_callback(started.set)
     server_instance.start()
 
+    # The event loop has been stopped by pandas_server_stop()
+    http_server.stop()
+    server_instance.close()
+    segment_registry.reap(everything=True)
+    pandas_server_log(f"Pandas SQL server has stopped.")
+
 
 def pandas_server_stop():
     assert len(running_server_instance) == 1
-    event_loop = running_server_instance[0]
-    event_loop.stop()
-    event_loop.close()
-    IOLoop.clear_current()
+    event_loop = running_server_instance.pop()
+    # IOLoop.stop() is not thread-safe; we schedule it on the loop itself.
+    event_loop.add_callback(event_loop.stop)
+    if len(running_server_thread) > 0:
+        running_server_thread.pop().join()
 
 
 def pandas_server_start(port=PANDAS_SQL_DEFAULT_PORT, in_thread=False):
     if in_thread:
         new_even_loop = True
-        Thread(target=start_app, args=(port, new_even_loop)).start()
+        started = Event()
+        server_thread = Thread(target=start_app, args=(port, new_even_loop, started))
+        running_server_thread.append(server_thread)
+        server_thread.start()
+        while not started.wait(0.1):
+            if not server_thread.is_alive():
+                running_server_thread.remove(server_thread)
+                raise ValueError(f"Failed to start the Pandas SQL server (port={port}).")
     else:
         start_app(port)
 
 
-def find_pandas_sql_process():
+def pandas_server_start_prefork(port, num_workers, data_dir, log_dir=None, advisor_memory=0):
+    """Starts the server with num_workers processes accepting on the same socket (the kernel
+    distributes the connections among them). The tables are stored in data_dir in the columnar
+    format and memory-mapped by every worker (see PreforkPandasSQL). Does not return.
+
+    @param advisor_memory  If positive, every worker runs an index advisor with this many bytes
+    """
+    # A fresh server starts without tables; the cache files are converted once here.
+    pandas_sql_instance[0] = PreforkPandasSQL(data_dir, log_dir)
+    get_pandas_sql().drop_all_tables()
+    # a process must not fork while its threads are loading
+    load_cache_files(wait=True)
+    preloader_instance[0] = None
+    pandas_sql_instance[0] = None
+
+    sockets = bind_sockets(port)
+    # the stop command kills the parent first (see main())
+    with open(os.path.join(data_dir, PREFORK_PID_FILE), 'w') as f:
+        f.write(str(os.getpid()))
+    worker_id = fork_processes(num_workers)
+    pandas_server_log(f"Pandas SQL worker {worker_id} (pid={os.getpid()}) has started.")
+    pandas_sql_instance[0] = PreforkPandasSQL(data_dir, log_dir)
+    get_pandas_sql().sync()
+    if advisor_memory > 0:
+        get_pandas_sql().start_advisor(advisor_memory)
+    start_app(port, sockets=sockets)
+
+
+def find_pandas_sql_processes():
+    """@return  The server processes (including the pre-fork workers)"""
+    processes = []
     for process in psutil.process_iter():
         try:
             cmd = process.cmdline()
             if (len(cmd) >= 2) and ("pandas-sql-server" in cmd[1]):
-                return process
+                processes.append(process)
         except (psutil.AccessDenied, psutil.ZombieProcess):
             continue
-    return None
+    return processes
+
+
+def find_pandas_sql_process():
+    processes = find_pandas_sql_processes()
+    return processes[0] if len(processes) > 0 else None
+
+
+def read_prefork_pid(data_dir):
+    """@return  The pid of the pre-fork parent recorded in data_dir; None if there is none"""
+    try:
+        with open(os.path.join(data_dir, PREFORK_PID_FILE), 'r') as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
 
 
 def main():
@@ -178,30 +676,97 @@ def main():
     parser.add_argument('--cache-dir', type=str, default='/usr/local/var/verdict/cache/',
                         help='The directory where cache files are stored.')
 
+    parser.add_argument('--preload-workers', type=int, default=4,
+                        help='The number of cache files loaded at once.')
+    parser.add_argument('--preload-order', type=str, choices=PRELOAD_ORDERS, default='mru',
+                        help='The order of loading the cache files: "mru" (the most recently used '
+                             'first), "smallest" (the smallest first), or "name".')
+    parser.add_argument('--lazy-columns', action='store_true',
+                        help='The columns of the preloaded cache files are read when a query '
+                             'first references them.')
+    parser.add_argument('--column-idle', type=int, default=0,
+                        help='If positive, the lazily read columns unused for this many seconds '
+                             'are dropped from memory (and read again when referenced).')
+    parser.add_argument('--snapshot-dir', type=str,
+                        help='If it holds a snapshot, the tables are restored from it (mapped, '
+                             'not read) at the startup. The "snapshot" requests write into it.')
     parser.add_argument('--log-dir', type=str,
                         help='The directory to generate logs')
-    parser.add_argument('-p', '--port', type=int, nargs=1, default=PANDAS_SQL_DEFAULT_PORT,
+    parser.add_argument('-p', '--port', type=int, default=PANDAS_SQL_DEFAULT_PORT,
                         help="The listening port of the server")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="If greater than 1, the tables are partitioned across this number of "
+                             "worker processes.")
+    parser.add_argument('--advisor-memory', type=int, default=0,
+                        help="If positive, the index advisor builds the secondary structures "
+                             "(indexes and cubes) for the workload within this memory (in MB).")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="If greater than 1, this number of processes serve the requests. The "
+                             "processes share the tables through memory-mapped columnar files.")
+    parser.add_argument('--data-dir', type=str, default='/usr/local/var/verdict/pandas_sql/',
+                        help='The directory where the workers store the columnar tables. The '
+                             'stop command finds the pre-fork parent process through it.')
+    parser.add_argument('--max-threads', type=int, default=32,
+                        help="The number of the requests processed at once (per worker process).")
+    parser.add_argument('--max-queue', type=int, default=256,
+                        help="The number of the requests that may wait; the others are rejected "
+                             "with a retryable status.")
+    parser.add_argument('--client-limit', type=int, default=8,
+                        help="The number of the requests of a single client processed at once.")
 
     args = parser.parse_args()
 
     if args.command == 'stop':
         # do something
-        pandas_sql_process = find_pandas_sql_process()
-        if pandas_sql_process is None:
+        pandas_sql_processes = find_pandas_sql_processes()
+        if len(pandas_sql_processes) == 0:
             print(f"Failed: didn't find any verdict servers.")
         else:
-            pandas_sql_pid = pandas_sql_process.pid
-            pandas_sql_process.kill()
-            print(f"Success: killed the Pandas SQL server (pid={pandas_sql_pid}).")
+            # the pre-fork parent first so that it does not restart the workers
+            parent_pid = read_prefork_pid(args.data_dir)
+            pandas_sql_processes.sort(key=lambda p: p.pid != parent_pid)
+            for pandas_sql_process in pandas_sql_processes:
+                pandas_sql_pid = pandas_sql_process.pid
+                try:
+                    pandas_sql_process.kill()
+                    if pandas_sql_pid == parent_pid:
+                        pandas_sql_process.wait(timeout=10)
+                except psutil.NoSuchProcess:
+                    continue
+                except psutil.TimeoutExpired:
+                    pass
+                print(f"Success: killed the Pandas SQL server (pid={pandas_sql_pid}).")
 
     else:
         pandas_server_log(f"Pandas SQL server mode")
+        if args.workers > 1 and args.shards > 1:
+            raise ValueError("--workers and --shards cannot be used together.")
+        admission_controller[0] = AdmissionController(args.max_threads, args.max_queue, 
+                                                      args.client_limit)
+        if args.shards > 1:
+            pandas_server_log(f"The tables are partitioned across {args.shards} shards.")
+            pandas_sql_instance[0] = ShardedPandasSQL(args.shards, args.log_dir)
+        if args.advisor_memory > 0 and args.workers <= 1:
+            pandas_server_log(f"The index advisor uses up to {args.advisor_memory} MB.")
+            get_pandas_sql().start_advisor(args.advisor_memory * 1024 * 1024)
         if args.preload_cache:
             cache_dir = args.cache_dir
             for name in os.listdir(cache_dir):
+                if name.startswith('.'):
+                    # the versions and the temporary files of the tables (see columnar.py)
+                    continue
                 full_path = os.path.join(cache_dir, name)
                 cache_to_load.append(full_path)
+            preload_options["workers"] = args.preload_workers
+            preload_options["order"] = args.preload_order
+        snapshot_options["dir"] = args.snapshot_dir
+        column_options["lazy"] = args.lazy_columns
+        column_options["idle-seconds"] = args.column_idle
 
         listening_port = args.port
-        pandas_server_start(listening_port)
+        if args.workers > 1:
+            pandas_server_log(f"Starts {args.workers} worker processes.")
+            pandas_server_start_prefork(listening_port, args.workers, args.data_dir, 
+                                        args.log_dir, args.advisor_memory * 1024 * 1024)
+        else:
+            pandas_server_start(listening_port)
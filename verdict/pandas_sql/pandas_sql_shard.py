@@ -0,0 +1,486 @@
+"""Partitions the tables of Pandas SQL across multiple worker processes.
+
+A coordinator (ShardedPandasSQL) offers the same interface as PandasSQL. Each table is split into
+as many partitions as there are workers, and every query is scattered to all the workers. The
+partial results are merged in the coordinator by AggMerger, which also merges the answers
+computed on summaries.
+
+Each worker serves the requests in the order it receives them. The coordinator sends a request to
+all the workers at once with respect to the other requests, so every worker sees the requests in
+the same order, while many requests can be in flight.
+"""
+
+import concurrent.futures
+import itertools
+import multiprocessing
+import numpy as np
+import os
+import threading
+import traceback
+from verdict.core.querying2 import AggMerger
+from verdict.interface import to_verdict_query
+from .columnar import is_columnar, read_columnar, read_manifest, read_table_file
+from .pandas_sql import *
+
+
+def _shard_range(row_count, shard_index, num_shards):
+    begin = row_count * shard_index // num_shards
+    end = row_count * (shard_index + 1) // num_shards
+    return slice(begin, end)
+
+
+def _shard_mask(part_values, shard_index, num_shards):
+    hashes = pd.util.hash_pandas_object(part_values, index=False)
+    return (hashes % num_shards == shard_index).values
+
+
+def partition_frame(df, part_col, shard_index, num_shards):
+    """Returns the rows of a shard. If part_col is None, we use range partitioning on the row
+    positions; otherwise, we use hash partitioning on the part_col values.
+    """
+    if part_col is None:
+        return df.iloc[_shard_range(len(df.index), shard_index, num_shards)]
+    else:
+        return df[_shard_mask(df[part_col], shard_index, num_shards)]
+
+
+def read_partition(file_path, part_col, shard_index, num_shards):
+    """Reads the rows of a shard (see partition_frame()) from a table file. Of a columnar table,
+    only the pages of the shard's rows are read from the mapped columns (and the part_col values
+    to hash them); a compressed or pickled column is still read whole.
+    """
+    if not is_columnar(file_path):
+        return partition_frame(read_table_file(file_path), part_col, shard_index, num_shards)
+    # the same version throughout, even if the table is replaced meanwhile
+    path = os.path.realpath(file_path)
+    if part_col is None:
+        rows = _shard_range(read_manifest(path)['row_count'], shard_index, num_shards)
+    else:
+        part_values = read_columnar(path, columns=[part_col])[part_col]
+        rows = np.flatnonzero(_shard_mask(part_values, shard_index, num_shards))
+    return read_columnar(path, rows=rows)
+
+
+class ShardWorker(object):
+    """Holds a partition of every table; runs in its own process.
+
+    :param shard_index:  The index of this worker (from 0)
+    :param num_shards:   The total number of workers
+    """
+
+    def __init__(self, shard_index, num_shards, log_dir=None):
+        self._shard_index = shard_index
+        self._num_shards = num_shards
+        self._pandas_sql = PandasSQL(log_dir)
+
+    def serve(self, conn):
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            request_id, method, args = message
+            try:
+                response = ("ok", getattr(self, method)(*args))
+            except Exception as e:
+                response = ("error", traceback.format_exc(), e)
+            try:
+                conn.send((request_id, response))
+            except Exception as e:
+                # the result or the exception cannot be pickled; nothing has been sent yet
+                trace = response[1] if response[0] == "error" else traceback.format_exc()
+                error = response[2] if response[0] == "error" else e
+                conn.send((request_id,
+                           ("error", trace, ValueError(f"{type(error).__name__}: {error}"))))
+        conn.close()
+
+    def load_table(self, table_name, file_path, if_not_exists, part_col, replicate, replace):
+        if if_not_exists and not replace and table_name in self._pandas_sql._tables:
+            return len(self._pandas_sql.get_df(table_name).index)
+        if replicate:
+            df = read_table_file(file_path)
+        else:
+            df = read_partition(file_path, part_col, self._shard_index, self._num_shards)
+        self._pandas_sql.register_table(table_name, df, replace)
+        return len(df.index)
+
+    def register_table(self, table_name, frame, replace):
+        self._pandas_sql.register_table(table_name, frame, replace)
+        return len(frame.index)
+
+    def drop_table(self, table_name, if_exists):
+        self._pandas_sql.drop_table(table_name, if_exists=if_exists)
+
+    def drop_all_tables(self):
+        self._pandas_sql.drop_all_tables()
+
+    def columns(self, table_name):
+        return self._pandas_sql.columns(table_name)
+
+    def create_cube(self, table_name, dims):
+        return self._pandas_sql.create_cube(table_name, dims)
+
+    def drop_cube(self, table_name, dims):
+        self._pandas_sql.drop_cube(table_name, dims)
+
+    def start_advisor(self, memory_budget, interval):
+        self._pandas_sql.start_advisor(memory_budget, interval)
+
+    def advisor_report(self):
+        return self._pandas_sql.advisor_report()
+
+    def execute(self, query, fraction):
+        return self._pandas_sql.execute(query, fraction)
+
+    def execute_many(self, queries):
+        return self._pandas_sql.execute_many(queries, return_exceptions=True)
+
+    def table_stats(self):
+        return self._pandas_sql.table_stats()
+
+
+def shard_worker_main(conn, shard_index, num_shards, log_dir):
+    ShardWorker(shard_index, num_shards, log_dir).serve(conn)
+
+
+class ShardConnection(object):
+    """The pipe to a worker, carrying many requests at once. The requests are tagged with ids, and
+    a reader thread hands each response to the caller waiting for it.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._pending = {}      # request id -> Future
+        self._closed = False
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def submit(self, method, args):
+        """@return  A Future of the worker's response"""
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closed:
+                raise ValueError("The shard worker has exited.")
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+            self._conn.send((request_id, method, args))
+        return future
+
+    def close(self):
+        with self._lock:
+            if not self._closed:
+                self._conn.send(None)
+
+    def _read(self):
+        while True:
+            try:
+                request_id, response = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future = self._pending.pop(request_id)
+            future.set_result(response)
+        with self._lock:
+            self._closed = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(ValueError("The shard worker has exited."))
+
+
+class ShardedPandasSQL(object):
+    """Offers the interface of PandasSQL, but the tables are hash- or range-partitioned across
+    local worker processes.
+
+    Joins are supported only when the partitions of the joined tables match; that is, when both
+    tables are hash-partitioned on their join columns, or when one side is replicated.
+
+    :param num_shards:  The number of worker processes
+    """
+
+    def __init__(self, num_shards=multiprocessing.cpu_count(), log_dir=None):
+        assert num_shards >= 1
+        self.id = 'pandas'
+        self._logger = init_logger(log_dir)
+        self._num_shards = num_shards
+
+        # table name -> { 'part_col': str or None, 'replicate': bool }
+        self._table_info = {}
+        self._table_versions = {}
+
+        # Processes are spawned (instead of forked) since the coordinator is multi-threaded.
+        context = multiprocessing.get_context('spawn')
+        self._conns = []
+        self._workers = []
+        for i in range(num_shards):
+            parent_conn, child_conn = context.Pipe()
+            worker = context.Process(target=shard_worker_main,
+                                     args=(child_conn, i, num_shards, log_dir), daemon=True)
+            worker.start()
+            self._conns.append(ShardConnection(parent_conn))
+            self._workers.append(worker)
+
+        # Held while a request is sent to the workers (not while they process it), so that every
+        # worker receives the requests in the same order
+        self._send_lock = threading.Lock()
+        self._log(f"Started {num_shards} shard workers.")
+
+    def _log(self, msg):
+        self._logger.debug(msg)
+
+    def close(self):
+        with self._send_lock:
+            for conn in self._conns:
+                conn.close()
+        for worker in self._workers:
+            worker.join()
+        self._log(f"Stopped {self._num_shards} shard workers.")
+
+    def _scatter(self, method, args_per_shard):
+        """Sends a request to the workers and collects their results.
+
+        @param args_per_shard  A list of args (a tuple) for each worker. If the list is shorter
+                               than the number of workers, only the first workers are requested.
+        """
+        assert len(args_per_shard) <= self._num_shards
+        conns = self._conns[0:len(args_per_shard)]
+        with self._send_lock:
+            futures = [conn.submit(method, args) for conn, args in zip(conns, args_per_shard)]
+        responses = [future.result() for future in futures]
+
+        for response in responses:
+            if response[0] == "error":
+                self._logger.error(response[1])
+                raise response[2]
+        return [response[1] for response in responses]
+
+    def _broadcast(self, method, *args):
+        return self._scatter(method, [args] * self._num_shards)
+
+    def drop_all_tables(self):
+        self._broadcast("drop_all_tables")
+        self._table_info = {}
+
+    def columns(self, name):
+        return self._scatter("columns", [(name,)])[0]
+
+    def load_table(self, table_name, file_path, if_not_exists=False, part_col=None,
+                   replicate=False, replace=False):
+        """
+        @param part_col  If None, the rows are range-partitioned. Otherwise, hash-partitioned on
+                         the values of this column.
+        @param replicate  If True, every worker holds a full copy (e.g., for small tables)
+        @param replace  If True, an existing table is replaced. Every worker swaps its partition
+                        between the same two requests (see the module's docstring), so a query
+                        never sees partitions of both versions.
+        @return  The number of rows in the loaded table.
+        """
+        if table_name in self._table_info and not if_not_exists and not replace:
+            raise ValueError(f"The specified table, {table_name}, already exists.")
+        row_counts = self._broadcast("load_table", table_name, file_path, if_not_exists,
+                                     part_col, replicate, replace)
+        if table_name not in self._table_info or replace:
+            self._table_info[table_name] = { 'part_col': part_col, 'replicate': replicate }
+            self._table_versions[table_name] = self._table_versions.get(table_name, 0) + 1
+        self._log(f"The table, {table_name}, has been loaded into {self._num_shards} shards.")
+        return row_counts[0] if replicate else sum(row_counts)
+
+    def register_table(self, table_name, frame, part_col=None, replicate=False, replace=False):
+        if table_name in self._table_info and not replace:
+            raise ValueError(f"The table name ({table_name}) already exists.")
+        args_per_shard = []
+        for i in range(self._num_shards):
+            part = frame if replicate else partition_frame(frame, part_col, i, self._num_shards)
+            args_per_shard.append((table_name, part, replace))
+        self._scatter("register_table", args_per_shard)
+        self._table_info[table_name] = { 'part_col': part_col, 'replicate': replicate }
+        self._table_versions[table_name] = self._table_versions.get(table_name, 0) + 1
+
+    def table_version(self, table_name):
+        """See PandasSQL.table_version()."""
+        if table_name not in self._table_info:
+            return None
+        return self._table_versions[table_name]
+
+    def drop_table(self, name, if_exists=False):
+        if name not in self._table_info and if_exists == False:
+            raise ValueError(f"The specified table, {name}, does not exist.")
+        self._broadcast("drop_table", name, True)
+        self._table_info.pop(name, None)
+
+    def create_cube(self, table_name, dims):
+        """Every shard builds a cube over its own partition.
+
+        @return  The total number of rows in the cubes
+        """
+        return sum(self._broadcast("create_cube", table_name, dims))
+
+    def drop_cube(self, table_name, dims=None):
+        self._broadcast("drop_cube", table_name, dims)
+
+    def start_advisor(self, memory_budget, interval=10):
+        """Every shard runs its own advisor with an equal share of the budget."""
+        self._broadcast("start_advisor", memory_budget // len(self._workers), interval)
+
+    def advisor_report(self):
+        """@return  A list of the shards' advisor reports"""
+        return self._broadcast("advisor_report")
+
+    def table_stats(self):
+        """@return  The row counts and the memory usage summed over the shards"""
+        stats = {}
+        for shard_stats in self._broadcast("table_stats"):
+            for name, s in shard_stats.items():
+                total = stats.setdefault(name, { "rows": 0, "memory": 0 })
+                if not (self._table_info.get(name, {}).get('replicate') and total["rows"] > 0):
+                    total["rows"] += s["rows"]
+                total["memory"] += s["memory"]
+        return stats
+
+    def execute(self, query, fraction=None):
+        """
+        @param query  A query in the verdict query format
+        @param fraction  If not None, every shard processes this fraction of its partition
+        @return  The merged result (pandas DataFrame)
+        """
+        assert_type(query, dict)
+        self._log(f'ShardedPandasSQL received a query: {query}')
+        partial_query, merger = self._plan(query)
+        if merger.replicated_only:
+            # Any single worker has the full answer.
+            return self._scatter("execute", [(query, fraction)])[0]
+        partials = self._broadcast("execute", partial_query, fraction)
+        return merger.merge(partials)
+
+    def execute_many(self, queries, return_exceptions=False):
+        assert_type(queries, (List, tuple))
+        plans = [self._plan(q) for q in queries]
+        partials = self._broadcast("execute_many", [p[0] for p in plans])
+        results = []
+        for i, (partial_query, merger) in enumerate(plans):
+            partials_of_query = [p[i] for p in partials]
+            try:
+                for p in partials_of_query:
+                    if isinstance(p, Exception):
+                        raise p
+                if merger.replicated_only:
+                    results.append(partials_of_query[0])
+                else:
+                    results.append(merger.merge(partials_of_query))
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+
+    def _plan(self, query):
+        """Rewrites the query so that each shard computes a partial answer.
+
+        @return  (partial_query, merger)
+        """
+        query_obj = from_verdict_query(query)
+        assert_type(query_obj, DerivedTable)
+        base_tables = find_base_tables(query_obj, include_samples=True)
+        for table in base_tables:
+            if table.name() not in self._table_info:
+                raise ValueError(f"Tried to access non-existing table {table.name()}")
+        self._verify_joins(query_obj)
+
+        replicated_only = all([self._table_info[t.name()]['replicate'] for t in base_tables])
+        if not query_obj.is_agg():
+            if self._find_agg(query_obj) is not None and not replicated_only:
+                raise ValueError("Only the top-level agg() can be computed over shards.")
+            return query, PartialMerger(None, None, replicated_only)
+
+        # avg(x) is computed as sum(x) / count(x)
+        partial_args = []
+        agg_specs = []
+        for agg_func, alias in query_obj.relop_args():
+            op = agg_func.op()
+            if op == 'avg':
+                arg = agg_func.args()[0]
+                partial_args.append((AggFunc.sum(arg), f'{alias}_sum'))
+                partial_args.append((AggFunc.count(arg), f'{alias}_count'))
+            else:
+                partial_args.append((agg_func, alias))
+            agg_specs.append((op, alias))
+        query_obj.set_relop_args(partial_args)
+        return to_verdict_query(query_obj), PartialMerger(query_obj, agg_specs, replicated_only)
+
+    def _find_agg(self, query_obj):
+        while isinstance(query_obj, DerivedTable):
+            if query_obj.is_agg():
+                return query_obj
+            query_obj = query_obj.source()
+        return None
+
+    def _verify_joins(self, query_obj):
+        """Ensures that every join can be computed within each shard."""
+        if not isinstance(query_obj, DerivedTable):
+            return
+        if query_obj.is_join():
+            left, right = query_obj.source(), query_obj.right_join_table()
+            join_type = query_obj.join_type()
+            if self._is_replicated(right) and join_type in ['inner', 'left']:
+                pass
+            elif self._is_replicated(left) and join_type in ['inner', 'right']:
+                pass
+            elif (self._is_partitioned_on(left, query_obj.left_join_col()) and
+                  self._is_partitioned_on(right, query_obj.right_join_col())):
+                pass
+            else:
+                raise ValueError(f"The join on {query_obj.left_join_col()} and "
+                                 f"{query_obj.right_join_col()} requires the tables to be "
+                                 "hash-partitioned on the join columns, or replicated.")
+            self._verify_joins(right)
+        self._verify_joins(query_obj.source())
+
+    def _is_replicated(self, rel_obj):
+        tables = find_base_tables(rel_obj, include_samples=True)
+        return all([self._table_info[t.name()]['replicate'] for t in tables])
+
+    def _is_partitioned_on(self, rel_obj, join_col):
+        for t in find_base_tables(rel_obj, include_samples=True):
+            info = self._table_info[t.name()]
+            if not info['replicate'] and info['part_col'] != join_col.name():
+                return False
+        return True
+
+
+class PartialMerger(object):
+    """Merges the partial answers computed by the shards.
+
+    :param partial_table:  The partial query (DerivedTable) the shards compute; its top-level agg()
+                           only has sums and counts. None if the query does not end with agg().
+    :param agg_specs:  A list of (agg_type, alias) for the top-level agg() of the original query;
+                       None if the query does not end with agg().
+    """
+
+    def __init__(self, partial_table, agg_specs, replicated_only=False):
+        self.replicated_only = replicated_only
+        self._partial_table = partial_table
+        self._agg_specs = agg_specs
+
+    def merge(self, partials):
+        assert len(partials) > 0
+        if self._agg_specs is None:
+            return pd.concat(partials, axis=0, ignore_index=True)
+
+        # The partial sums and counts are added up per group, as for the answers on summaries.
+        merger = AggMerger(self._partial_table)
+        for partial in partials:
+            merger.merge(partial, 1.0)
+        summed = merger.merged_result()
+        groups_count = len(summed.columns) - \
+                           sum([2 if t == 'avg' else 1 for t, _ in self._agg_specs])
+        group_cols = summed.columns[0:groups_count].to_list()
+
+        merged = summed[group_cols].reset_index(drop=True)
+        for agg_type, alias in self._agg_specs:
+            if agg_type == 'avg':
+                merged[alias] = (summed[f'{alias}_sum'] / summed[f'{alias}_count']).values
+            elif agg_type == 'count':
+                merged[alias] = summed[alias].astype(int).values
+            else:
+                merged[alias] = summed[alias].values
+        return merged
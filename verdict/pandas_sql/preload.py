@@ -0,0 +1,160 @@
+"""Loads the cache files into the Pandas SQL server in the background.
+
+The server serves requests while the files are being loaded. A query on a table that has not been
+loaded yet loads it first (ahead of the other files) instead of failing.
+"""
+
+import concurrent.futures
+import os
+import threading
+import time
+
+
+# The orders in which the cache files are loaded
+PRELOAD_ORDERS = ['mru', 'smallest', 'name']
+
+
+def table_name_of(file_path):
+    """The cache file name (excluding the dir) ends with the name of the table."""
+    return os.path.basename(file_path).split('.')[-1]
+
+
+def order_files(file_paths, order='mru'):
+    """
+    @param order  "mru" (the most recently used first), "smallest" (the smallest first, so that
+                  many tables become ready quickly), or "name"
+    """
+    def stat(path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    if order == 'mru':
+        def last_used(path):
+            s = stat(path)
+            return 0 if s is None else max(s.st_atime, s.st_mtime)
+        return sorted(file_paths, key=last_used, reverse=True)
+    elif order == 'smallest':
+        def size(path):
+            if os.path.isdir(path):
+                # a columnar table
+                return sum(size(os.path.join(path, f)) for f in os.listdir(path))
+            s = stat(path)
+            return 0 if s is None else s.st_size
+        return sorted(file_paths, key=size)
+    elif order == 'name':
+        return sorted(file_paths)
+    else:
+        raise ValueError(f"Unknown preload order: {order}")
+
+
+class CachePreloader(object):
+    """
+    :param engine:  A PandasSQL (or any engine offering load_table())
+    :param file_paths:  The cache files; the table names are derived by table_name_of(). Or a dict
+                        of { table name: path }.
+    :param workers:  The number of files loaded at once
+    :param on_loaded:  If not None, called with (table name, seconds, row count) for each table
+    :param load:  If not None, called with (table name, path) to load a table instead of the
+                  engine's load_table(); returns the row count
+    """
+
+    def __init__(self, engine, file_paths, workers=4, order='mru', on_loaded=None, logger=None,
+                 load=None):
+        assert workers > 0
+        self._engine = engine
+        if isinstance(file_paths, dict):
+            names = {p: n for n, p in file_paths.items()}
+            self._files = {names[p]: p for p in order_files(list(names), order)}
+        else:
+            self._files = {table_name_of(p): p for p in order_files(file_paths, order)}
+        self._load_table = load
+        self._workers = workers
+        self._on_loaded = on_loaded
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._states = {name: 'pending' for name in self._files}   # pending/loading/loaded/failed
+        self._done = {name: threading.Event() for name in self._files}
+        self._errors = {}
+        self._executor = None
+        self._start_time = None
+        self._end_time = None
+
+    def _log(self, msg):
+        if self._logger is not None:
+            self._logger.debug(msg)
+
+    def start(self):
+        """Starts loading in the background."""
+        self._start_time = time.time()
+        if len(self._files) == 0:
+            self._end_time = self._start_time
+            return
+        self._executor = concurrent.futures.ThreadPoolExecutor(self._workers,
+                                                               thread_name_prefix='preload')
+        futures = [self._executor.submit(self._load, name) for name in self._files]
+        self._executor.shutdown(wait=False)
+
+        def finished(_):
+            with self._lock:
+                if all(s in ('loaded', 'failed') for s in self._states.values()):
+                    self._end_time = time.time()
+                    self._log(f"Finished preloading {len(self._files)} cache files in "
+                              f"{self._end_time - self._start_time:.2f} seconds.")
+        for future in futures:
+            future.add_done_callback(finished)
+
+    def run(self):
+        """Loads all the files and waits until they are loaded."""
+        self.start()
+        for done in self._done.values():
+            done.wait()
+
+    def ensure_loaded(self, table_names):
+        """Loads the given tables now if they are still waiting, or waits for them if they are
+        being loaded. The tables that are not preloaded are ignored."""
+        for name in table_names:
+            if name in self._states:
+                self._load(name)
+                self._done[name].wait()
+
+    def _load(self, name):
+        with self._lock:
+            if self._states[name] != 'pending':
+                return
+            self._states[name] = 'loading'
+        start_time = time.time()
+        try:
+            if self._load_table is not None:
+                row_count = self._load_table(name, self._files[name])
+            else:
+                row_count = self._engine.load_table(name, self._files[name], if_not_exists=True)
+            state = 'loaded'
+            if self._on_loaded is not None:
+                self._on_loaded(name, time.time() - start_time, row_count)
+        except Exception as e:
+            state = 'failed'
+            self._errors[name] = f"{type(e).__name__}: {e}"
+            self._log(f"Failed to preload {name}: {e}")
+        with self._lock:
+            self._states[name] = state
+        self._done[name].set()
+
+    def progress(self):
+        with self._lock:
+            states = dict(self._states)
+        counts = {s: 0 for s in ('pending', 'loading', 'loaded', 'failed')}
+        for state in states.values():
+            counts[state] += 1
+        ready = counts['pending'] == 0 and counts['loading'] == 0
+        now = time.time() if self._end_time is None else self._end_time
+        return {
+            "ready": ready,
+            "total": len(states),
+            "loaded": counts['loaded'],
+            "failed": dict(self._errors),
+            "loading": sorted(n for n, s in states.items() if s == 'loading'),
+            "pending": counts['pending'],
+            "elapsed": 0.0 if self._start_time is None else now - self._start_time,
+        }
@@ -0,0 +1,374 @@
+"""The wire formats between PandasSQLClient and the Pandas SQL server.
+
+Two protocols are supported:
+
+1. "arrow" (binary): A request is a framed message whose first frame is the request in JSON. A
+   response is a framed message whose first frame is the response in JSON, where every DataFrame
+   is replaced by a reference to a following frame holding the DataFrame as an Arrow IPC stream.
+   Requires pyarrow.
+
+   With the "shm" transport (for a client on the same host), each DataFrame is written into a
+   shared-memory segment instead (see shm.py), and the response only carries its path.
+
+2. "json" (the fallback): A request is JSON; a response is a pickled dict.
+
+A response of either protocol may be compressed with a codec the client accepts (lz4 or zstd) if it
+is larger than a threshold. The codec is named in ENCODING_HEADER, and the compressed body is
+
+    the length of the uncompressed body (uint64) | the compressed body (an lz4 or zstd frame)
+
+A framed message:
+
+    b'VFR1' | the number of frames (uint32) | the length of each frame (uint64, ...) | frames
+
+A streamed response (STREAM_CONTENT_TYPE; sent with the chunked transfer encoding) is a sequence
+of messages, each an encoded response of either protocol (optionally compressed):
+
+    the content type (uint8) | the codec (uint8) | the length of the body (uint64) | the body
+"""
+
+import builtins
+import json
+import numpy as np
+import pandas as pd
+import pickle
+import struct
+from .shm import is_segment_path, new_segment_path, remove_segment, segment_registry
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+FRAME_CONTENT_TYPE = 'application/x-verdict-frame'
+
+ARROW_CONTENT_TYPE = 'application/x-verdict-arrow'
+
+PICKLE_CONTENT_TYPE = 'application/x-python-pickle'
+
+TRANSPORT_HEADER = 'X-Verdict-Transport'
+
+# The codecs the client accepts (e.g., "lz4, zstd") and, optionally, its threshold in bytes
+ACCEPT_ENCODING_HEADER = 'X-Verdict-Accept-Encoding'
+
+COMPRESS_THRESHOLD_HEADER = 'X-Verdict-Compress-Threshold'
+
+# The codec of a compressed response. The standard Content-Encoding is not used since HTTP clients
+# may decode it on their own.
+ENCODING_HEADER = 'X-Verdict-Encoding'
+
+# The responses smaller than this (in bytes) are not compressed
+DEFAULT_COMPRESS_THRESHOLD = 64 * 1024
+
+FRAME_MAGIC = b'VFR1'
+
+STREAM_CONTENT_TYPE = 'application/x-verdict-stream'
+
+STREAM_MESSAGE_HEADER = struct.Struct('<BBQ')
+
+# The numbers of the content types and the codecs in the header of a streamed message
+STREAM_CONTENT_TYPES = [PICKLE_CONTENT_TYPE, ARROW_CONTENT_TYPE]
+
+STREAM_CODECS = [None, 'lz4', 'zstd']
+
+
+def arrow_available():
+    return pa is not None
+
+
+def supported_protocols():
+    """@return  The protocols this side supports, the preferred first"""
+    return ['arrow', 'json'] if arrow_available() else ['json']
+
+
+def negotiate_protocol(requested, server_protocols):
+    """
+    @param requested  The protocol requested by the client; None if any
+    @param server_protocols  The protocols the server supports (in its ping response)
+    """
+    common = [p for p in supported_protocols() if p in server_protocols]
+    if requested is None:
+        return common[0]
+    elif requested in common:
+        return requested
+    else:
+        raise ValueError(f"The protocol ({requested}) is not supported by both sides.")
+
+
+def available_codecs():
+    """@return  The compression codecs this side supports, the preferred (i.e., faster) first"""
+    codecs = []
+    if lz4_frame is not None or (pa is not None and pa.Codec.is_available('lz4')):
+        codecs.append('lz4')
+    if zstandard is not None or (pa is not None and pa.Codec.is_available('zstd')):
+        codecs.append('zstd')
+    return codecs
+
+
+def negotiate_codec(requested, server_codecs):
+    """
+    @param requested  "lz4", "zstd", "none", or None (the first one supported by both sides)
+    @param server_codecs  The codecs the server supports (in its ping response)
+    @return  The codec; None for no compression
+    """
+    if requested == 'none':
+        return None
+    common = [c for c in available_codecs() if c in server_codecs]
+    if requested is None:
+        return common[0] if len(common) > 0 else None
+    elif requested in common:
+        return requested
+    else:
+        raise ValueError(f"The compression codec ({requested}) is not supported by both sides.")
+
+
+def compress(body, codec):
+    """@return  The compressed body (bytes) in the format described above"""
+    raw = memoryview(body)
+    if codec == 'lz4' and lz4_frame is not None:
+        compressed = lz4_frame.compress(raw)
+    elif codec == 'zstd' and zstandard is not None:
+        compressed = zstandard.ZstdCompressor(level=1).compress(raw)
+    elif codec in ('lz4', 'zstd') and pa is not None:
+        compressed = pa.Codec(codec).compress(raw, asbytes=True)
+    else:
+        raise ValueError(f"Unsupported compression codec: {codec}")
+    return struct.pack('<Q', raw.nbytes) + compressed
+
+
+def decompress(body, codec):
+    view = memoryview(body)
+    size = struct.unpack_from('<Q', view, 0)[0]
+    compressed = view[8:]
+    if codec == 'lz4' and lz4_frame is not None:
+        return lz4_frame.decompress(compressed)
+    elif codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(compressed, max_output_size=size)
+    elif codec in ('lz4', 'zstd') and pa is not None:
+        return pa.Codec(codec).decompress(compressed, decompressed_size=size, asbytes=True)
+    else:
+        raise ValueError(f"Unsupported compression codec: {codec}")
+
+
+def accepted_codec(headers):
+    """@return  (the first codec in the request's ACCEPT_ENCODING_HEADER supported here, the
+                compression threshold); (None, None) if none"""
+    accepted = headers.get(ACCEPT_ENCODING_HEADER)
+    if accepted is None:
+        return None, None
+    codecs = available_codecs()
+    for codec in [c.strip() for c in accepted.split(',')]:
+        if codec in codecs:
+            threshold = headers.get(COMPRESS_THRESHOLD_HEADER)
+            return codec, DEFAULT_COMPRESS_THRESHOLD if threshold is None else int(threshold)
+    return None, None
+
+
+def encode_frames(frames):
+    """
+    @param frames  A list of bytes-like objects
+    @return  A framed message (bytes)
+    """
+    header = FRAME_MAGIC + struct.pack('<I', len(frames))
+    header += struct.pack(f'<{len(frames)}Q', *[memoryview(f).nbytes for f in frames])
+    return b''.join([header] + list(frames))
+
+
+def decode_frames(message):
+    """
+    @param message  A framed message (bytes-like)
+    @return  A list of memoryviews (no copy)
+    """
+    view = memoryview(message)
+    if bytes(view[:4]) != FRAME_MAGIC:
+        raise ValueError("Not a framed message.")
+    count = struct.unpack_from('<I', view, 4)[0]
+    lengths = struct.unpack_from(f'<{count}Q', view, 8)
+    offset = 8 + 8 * count
+    frames = []
+    for length in lengths:
+        frames.append(view[offset:offset+length])
+        offset += length
+    return frames
+
+
+def encode_request(request, protocol, transport='http', codec=None, compress_threshold=None):
+    """
+    @param transport  "http" or "shm" (only with the arrow protocol)
+    @param codec  If not None, the response may be compressed with this codec
+    @param compress_threshold  The responses smaller than this are not compressed; None for the
+                               server's default
+    @return  (HTTP headers, body)
+    """
+    if protocol == 'arrow':
+        headers = { 'Content-Type': FRAME_CONTENT_TYPE, 'Accept': ARROW_CONTENT_TYPE }
+        if transport == 'shm':
+            headers[TRANSPORT_HEADER] = 'shm'
+        body = encode_frames([json.dumps(request).encode('utf-8')])
+    else:
+        headers, body = { 'Content-Type': 'application/json' }, json.dumps(request)
+    if codec is not None:
+        headers[ACCEPT_ENCODING_HEADER] = codec
+        if compress_threshold is not None:
+            headers[COMPRESS_THRESHOLD_HEADER] = str(compress_threshold)
+    return headers, body
+
+
+def decode_request(body, content_type):
+    if content_type == FRAME_CONTENT_TYPE:
+        return json.loads(bytes(decode_frames(body)[0]).decode('utf-8'))
+    else:
+        return json.loads(body)
+
+
+def accepts_arrow(accept):
+    return accept is not None and ARROW_CONTENT_TYPE in accept and arrow_available()
+
+
+def frame_to_arrow(df):
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def arrow_to_frame(frame):
+    return pa.ipc.open_stream(pa.py_buffer(frame)).read_all().to_pandas()
+
+
+def frame_to_segment(df):
+    """Writes the DataFrame into a new shared-memory segment.
+
+    @return  The path of the segment
+    """
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    path = new_segment_path()
+    segment_registry.add(path)
+    try:
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+    except BaseException:
+        remove_segment(path)
+        raise
+    return path
+
+
+def segment_to_frame(path):
+    """Maps the segment and removes its file; the memory is freed once the DataFrame is gone. The
+    columns without nulls are not copied."""
+    if not is_segment_path(path):
+        raise ValueError(f"Not a shared-memory segment: {path}")
+    source = pa.memory_map(path)
+    remove_segment(path)
+    return pa.ipc.open_stream(source).read_all().to_pandas(split_blocks=True)
+
+
+def encode_response(response, accept=None, transport=None):
+    """Encodes a response in Arrow if the client accepts it; otherwise (or if the response has
+    values Arrow cannot represent), pickles it.
+
+    @param accept  The Accept header of the request
+    @param transport  The transport header of the request
+    @return  (content type, body)
+    """
+    if accepts_arrow(accept):
+        frames = []
+        segments = []
+
+        def encode_value(value):
+            if isinstance(value, pd.DataFrame) and transport == 'shm':
+                segments.append(frame_to_segment(value))
+                return {'__shm__': segments[-1]}
+            elif isinstance(value, pd.DataFrame):
+                frames.append(frame_to_arrow(value))
+                return {'__frame__': len(frames)}
+            elif isinstance(value, np.generic):
+                return value.item()
+            elif isinstance(value, Exception):
+                return {'__error__': type(value).__name__, 'message': str(value)}
+            raise TypeError(type(value))
+
+        try:
+            header = json.dumps(response, default=encode_value).encode('utf-8')
+            return ARROW_CONTENT_TYPE, encode_frames([header] + frames)
+        except (TypeError, ValueError, pa.ArrowException):
+            # the frames are pickled along with the rest
+            for path in segments:
+                remove_segment(path)
+    return PICKLE_CONTENT_TYPE, pickle.dumps(response)
+
+
+def stream_message_header(content_type, body, encoding=None):
+    """
+    @param content_type  The content type of the encoded response (see encode_response)
+    @param encoding  The codec the body is compressed with; None if not compressed
+    @return  The header (bytes) to be sent ahead of the body in a streamed response
+    """
+    return STREAM_MESSAGE_HEADER.pack(STREAM_CONTENT_TYPES.index(content_type),
+                                      STREAM_CODECS.index(encoding), len(body))
+
+
+def decode_stream(read):
+    """
+    @param read  read(n) returns the next (at most) n bytes of a streamed response; b'' at its end
+    @return  A generator of the responses in the stream
+    """
+    def read_exactly(n):
+        parts = []
+        while n > 0:
+            part = read(n)
+            if len(part) == 0:
+                break
+            parts.append(part)
+            n -= len(part)
+        return b''.join(parts), n == 0
+
+    while True:
+        header, complete = read_exactly(STREAM_MESSAGE_HEADER.size)
+        if len(header) == 0:
+            return
+        if complete:
+            content_type, codec, length = STREAM_MESSAGE_HEADER.unpack(header)
+            body, complete = read_exactly(length)
+        if not complete:
+            raise ValueError("The streamed response ended in the middle of a message.")
+        yield decode_response(body, STREAM_CONTENT_TYPES[content_type], STREAM_CODECS[codec])
+
+
+def decode_response(body, content_type, encoding=None):
+    """
+    @param encoding  The codec in the response's ENCODING_HEADER; None if not compressed
+    """
+    if encoding is not None:
+        body = decompress(body, encoding)
+    if content_type != ARROW_CONTENT_TYPE:
+        return pickle.loads(body)
+
+    frames = decode_frames(body)
+
+    def decode_value(obj):
+        if '__frame__' in obj:
+            return arrow_to_frame(frames[obj['__frame__']])
+        elif '__shm__' in obj:
+            return segment_to_frame(obj['__shm__'])
+        elif '__error__' in obj:
+            error_class = getattr(builtins, obj['__error__'], None)
+            if isinstance(error_class, type) and issubclass(error_class, Exception):
+                return error_class(obj['message'])
+            return RuntimeError(f"{obj['__error__']}: {obj['message']}")
+        return obj
+
+    return json.loads(bytes(frames[0]).decode('utf-8'), object_hook=decode_value)
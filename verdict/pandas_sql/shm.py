@@ -0,0 +1,82 @@
+"""Shared-memory segments for handing results from the Pandas SQL server to a client on the same
+host.
+
+The server writes a result (an Arrow IPC stream) into a file under SHM_DIR and sends only its path.
+The client memory-maps the file and removes it right away; the memory is released by the OS once
+the client drops the mapped result. The segments never consumed (e.g., the client died) are removed
+by the server after SEGMENT_TTL seconds.
+"""
+
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+SEGMENT_PREFIX = 'verdict-'
+
+# The seconds after which an unconsumed segment is removed
+SEGMENT_TTL = 60
+
+
+def new_segment_path():
+    return os.path.join(SHM_DIR, SEGMENT_PREFIX + uuid.uuid4().hex)
+
+
+def create_probe():
+    """Creates an empty segment. The server reports whether it sees this file, i.e., whether the
+    two sides share the memory."""
+    path = new_segment_path()
+    with open(path, 'wb'):
+        pass
+    return path
+
+
+def remove_segment(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def is_segment_path(path):
+    """Only the segments created by verdict may be checked or removed on behalf of a client."""
+    return os.path.dirname(path) == SHM_DIR and os.path.basename(path).startswith(SEGMENT_PREFIX)
+
+
+class SegmentRegistry(object):
+    """Tracks the segments created by the server so that the unconsumed ones are removed."""
+
+    def __init__(self, ttl=SEGMENT_TTL):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._created = {}          # path -> creation time
+
+    def add(self, path):
+        with self._lock:
+            self._created[path] = time.time()
+        self.reap()
+
+    def reap(self, everything=False):
+        """Removes the segments older than the ttl (or all if everything is True). The consumed
+        ones are already gone.
+
+        @return  The number of the removed unconsumed segments
+        """
+        now = time.time()
+        with self._lock:
+            expired = [p for p, t in self._created.items() if everything or now - t > self._ttl]
+            for path in expired:
+                del self._created[path]
+        removed = 0
+        for path in expired:
+            if os.path.exists(path):
+                remove_segment(path)
+                removed += 1
+        return removed
+
+
+segment_registry = SegmentRegistry()